@@ -0,0 +1,321 @@
+""" Microbenchmark of the DB client / server path.
+
+    DBStoreWorkers is booted in this process and driven through DBClient and BaseDAO by
+    a number of concurrent clients running a weighted mix of operations. Throughput,
+    p50 / p99 latency and peak memory are reported as JSON, so runs of different
+    commits can be compared, e.g.
+
+        python -m benchmarks.db_bench --rows 10000 --ops 50000 -o before.json
+        python -m benchmarks.db_bench --rows 10000 --ops 50000 --baseline before.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then reported by tracemalloc only
+    resource = None
+
+from db_lib import base_dao, DEFAULT_PAGE_SIZE
+from db_lib.base_dao import DBClient, BaseDAO
+from db_store import datastore_workers, wal, expiry, planner, tracing, scheduler, WORKER_MODE_ASYNC, \
+    WORKER_MODE_THREAD, RESULT_FORMAT_NATIVE, RESULT_FORMAT_BINARY, SCHED_LANES
+from db_store.datastore_workers import DBStoreWorkers
+from db_store.scheduler import RequestScheduler
+
+BENCH_DB = "QuickReserve_Bench"
+BENCH_TABLE = "BenchDO"
+BENCH_INDEXES = {"key": True, "group": False}
+PRELOAD_BATCH_SIZE = 1000
+
+OP_SAVE = "save"
+OP_GET_UNIQUE = "get_unique"
+OP_GET_NON_UNIQUE = "get_non_unique"
+OP_DELETE = "delete"
+OP_SCAN = "scan"
+BENCH_OPS = (OP_SAVE, OP_GET_UNIQUE, OP_GET_NON_UNIQUE, OP_DELETE, OP_SCAN)
+DEFAULT_OP_MIX = "save=10,get_unique=60,get_non_unique=20,delete=9,scan=1"
+
+logger = logging.getLogger("db_bench")
+
+
+def parse_op_mix(value):
+    """ "op=weight,..." to {op: weight} """
+    mix = {}
+    for item in value.split(","):
+        op, _, weight = item.partition("=")
+        op = op.strip()
+        if op not in BENCH_OPS:
+            raise argparse.ArgumentTypeError(f"Unsupported op: {op}, supported ops are {', '.join(BENCH_OPS)}")
+        try:
+            mix[op] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Invalid weight of op {op}: {weight}")
+    if not any(w > 0 for w in mix.values()):
+        raise argparse.ArgumentTypeError("At least one op needs a positive weight")
+    return mix
+
+
+def percentile(sorted_values, q):
+    # Nearest rank
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+
+def summarize(latencies, errors, skipped, elapsed):
+    latencies = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {"ops": len(latencies), "errors": errors, "skipped": skipped,
+            "ops_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+            "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50_ms": ms(percentile(latencies, 0.50)),
+            "p99_ms": ms(percentile(latencies, 0.99)),
+            "max_ms": ms(latencies[-1] if latencies else None)}
+
+
+def peak_rss_kb():
+    if not resource:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in kilobytes elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class DBBenchmark(object):
+    """ Clients share one pre-generated sequence of ops, each client takes the next op
+        as soon as its previous one completes. Records saved by the benchmark are tracked
+        so unique gets and deletes always address live records.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.dao = None
+        # (id, key number) of every live record, deletes swap remove a random one
+        self.live = []
+        self.next_key = 0
+        self.handlers = {
+            OP_SAVE: self.save,
+            OP_GET_UNIQUE: self.get_unique,
+            OP_GET_NON_UNIQUE: self.get_non_unique,
+            OP_DELETE: self.delete,
+            OP_SCAN: self.scan,
+        }
+
+    def content(self):
+        n = self.next_key
+        self.next_key += 1
+        return n, {"key": f"k{n}", "group": f"g{n % self.args.groups}", "count": n,
+                   "payload": "x" * self.args.payload}
+
+    async def save(self):
+        n, content = self.content()
+        status, record = await self.dao.asave(content)
+        if status:
+            self.live.append((record.id, n))
+        return status
+
+    async def get_unique(self):
+        if not self.live:
+            return None
+        _, n = self.live[self.rng.randrange(len(self.live))]
+        status, records = await self.dao.aget({"key": f"k{n}"})
+        return status
+
+    async def get_non_unique(self):
+        status, records = await self.dao.aget({"group": f"g{self.rng.randrange(self.args.groups)}"})
+        return status
+
+    async def delete(self):
+        if not self.live:
+            return None
+        i = self.rng.randrange(len(self.live))
+        self.live[i], self.live[-1] = self.live[-1], self.live[i]
+        _id, _ = self.live.pop()
+        status, result = await self.dao.aremove(_id)
+        return status
+
+    async def scan(self):
+        # Unfiltered scan of the whole table, page by page
+        async for status, records in self.dao.ascan(None, self.args.scan_page):
+            if not status:
+                return False
+        return True
+
+    async def preload(self):
+        for start in range(0, self.args.rows, PRELOAD_BATCH_SIZE):
+            batch = [self.content() for _ in range(min(PRELOAD_BATCH_SIZE, self.args.rows - start))]
+            status, items = await self.dao.asave_many([content for _, content in batch])
+            if not status:
+                raise RuntimeError(f"Preload of {BENCH_TABLE} failed, {items}")
+            self.live.extend((record.id, n) for (n, _), (saved, record) in zip(batch, items) if saved)
+
+    def op_sequence(self, count):
+        ops, weights = zip(*self.args.mix.items())
+        return self.rng.choices(ops, weights, k=count)
+
+    async def run_ops(self, ops, stats=None):
+        ops = list(reversed(ops))
+
+        async def client():
+            while ops:
+                op = ops.pop()
+                start = time.perf_counter()
+                status = await self.handlers[op]()
+                elapsed = time.perf_counter() - start
+                if stats is None:
+                    continue
+                if status is None:
+                    stats[op]["skipped"] += 1
+                elif not status:
+                    stats[op]["errors"] += 1
+                else:
+                    stats[op]["latencies"].append(elapsed)
+
+        await asyncio.gather(*(client() for _ in range(self.args.concurrency)))
+
+    async def run(self):
+        args = self.args
+        loop = asyncio.get_running_loop()
+        req_queue = RequestScheduler(dict.fromkeys(SCHED_LANES, args.queue_size))
+        data_dir = tempfile.mkdtemp(prefix="qr_bench_") if args.wal else None
+        db_server = DBStoreWorkers(BENCH_DB, req_queue, data_dir, args.result_format, args.worker_mode)
+        DBClient(req_queue, loop, versions=db_server.versions if args.cache else None)
+        server_worker = asyncio.create_task(db_server.run())
+        await req_queue.put(args.workers)
+        await req_queue.join()
+        try:
+            self.dao = BaseDAO(BENCH_TABLE, BENCH_INDEXES)
+            if args.tracemalloc:
+                tracemalloc.start()
+            await self.preload()
+            await self.run_ops(self.op_sequence(args.warmup))
+
+            if args.tracemalloc:
+                tracemalloc.reset_peak()
+            stats = {op: {"latencies": [], "errors": 0, "skipped": 0} for op in args.mix}
+            start = time.perf_counter()
+            await self.run_ops(self.op_sequence(args.ops), stats)
+            elapsed = time.perf_counter() - start
+            peak_traced = tracemalloc.get_traced_memory()[1] // 1024 if args.tracemalloc else None
+        finally:
+            tracemalloc.stop()
+            server_worker.cancel()
+            if data_dir:
+                shutil.rmtree(data_dir, ignore_errors=True)
+
+        return {
+            "benchmark": "db_bench",
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+            "elapsed_sec": round(elapsed, 3),
+            "live_rows": len(self.live),
+            "total": summarize([t for s in stats.values() for t in s["latencies"]],
+                               sum(s["errors"] for s in stats.values()),
+                               sum(s["skipped"] for s in stats.values()), elapsed),
+            "ops": {op: summarize(s["latencies"], s["errors"], s["skipped"], elapsed) for op, s in stats.items()},
+            "memory": {"peak_rss_kb": peak_rss_kb(), "peak_traced_kb": peak_traced},
+            "scheduler": req_queue.stats(),
+        }
+
+
+def compare(baseline, result):
+    """ Lines of ops/sec and p99 of result against a baseline run """
+    def change(before, after):
+        if not before or after is None:
+            return "n/a"
+        return f"{(after - before) / before * 100:+.1f}%"
+
+    lines = [f"Compared with {baseline.get('commit') or 'baseline'}:"]
+    rows = [("total", baseline.get("total", {}), result["total"])]
+    rows += [(op, baseline.get("ops", {}).get(op, {}), summary) for op, summary in result["ops"].items()]
+    for op, before, after in rows:
+        lines.append(f"  {op:<16} ops/sec {before.get('ops_per_sec')} -> {after['ops_per_sec']} "
+                     f"({change(before.get('ops_per_sec'), after['ops_per_sec'])}), "
+                     f"p99 ms {before.get('p99_ms')} -> {after['p99_ms']} "
+                     f"({change(before.get('p99_ms'), after['p99_ms'])})")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.db_bench",
+                                     description="Benchmark of DB operations served by an in-process db server")
+    parser.add_argument("--rows", type=int, default=10000, help="records loaded before the run")
+    parser.add_argument("--ops", type=int, default=20000, help="operations measured")
+    parser.add_argument("--warmup", type=int, default=1000, help="operations run before measuring")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--mix", type=parse_op_mix, default=DEFAULT_OP_MIX,
+                        help=f"weighted op mix, ops: {', '.join(BENCH_OPS)} (default: {DEFAULT_OP_MIX})")
+    parser.add_argument("--groups", type=int, default=100, help="distinct values of the non-unique index")
+    parser.add_argument("--payload", type=int, default=64, help="size of the non-indexed payload of a record")
+    parser.add_argument("--scan-page", type=int, default=DEFAULT_PAGE_SIZE, help="page size of scans")
+    parser.add_argument("--workers", type=int, default=4, help="db worker pool size")
+    parser.add_argument("--queue-size", type=int, default=100, help="size of every lane of the db request scheduler")
+    parser.add_argument("--worker-mode", choices=(WORKER_MODE_ASYNC, WORKER_MODE_THREAD), default=WORKER_MODE_ASYNC)
+    parser.add_argument("--result-format", choices=(RESULT_FORMAT_NATIVE, RESULT_FORMAT_BINARY),
+                        default=RESULT_FORMAT_NATIVE)
+    parser.add_argument("--wal", action="store_true", help="log writes to a write-ahead log in a temporary dir")
+    parser.add_argument("--cache", action="store_true", help="enable the read cache of DAOs")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also report peak of python allocations while measuring, slows the run down")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="write JSON result to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON result of an earlier run to compare with")
+    args = parser.parse_args(argv)
+    if isinstance(args.mix, str):
+        args.mix = parse_op_mix(args.mix)
+    for name in ("rows", "ops", "concurrency", "groups", "scan_page", "workers", "queue_size"):
+        if getattr(args, name) < (0 if name in ("rows", "ops") else 1):
+            parser.error(f"--{name.replace('_', '-')} is out of range: {getattr(args, name)}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(name)s - %(levelname)s - %(message)s')
+    base_dao.logger = datastore_workers.logger = wal.logger = expiry.logger = planner.logger = tracing.logger = \
+        scheduler.logger = logger
+    # Stages are still marked on every request, only logging of slow ones would skew the numbers
+    tracing.slow_ops.threshold_ms = None
+
+    result = asyncio.run(DBBenchmark(args).run())
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(compare(json.load(f), result), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,4 +4,46 @@ DB_OPERATION_DROP_ENTITY = 2
 DB_OPERATION_ENTITY_GET = 3
 DB_OPERATION_ENTITY_SAVE = 4
 DB_OPERATION_ENTITY_DEL = 5
+DB_OPERATION_ENTITY_MULTI_SAVE = 6
+DB_OPERATION_ENTITY_MULTI_GET = 7
+DB_OPERATION_ENTITY_MULTI_DEL = 8
+DB_OPERATION_ENTITY_AVAILABLE = 9
+DB_OPERATION_ENTITY_EXPLAIN = 10
+DB_OPERATION_ENTITY_JOIN = 11
+DB_OPERATION_ENTITY_SCAN = 12
+DB_OPERATION_ENTITY_SAVE_IF = 13
+# Runtime metrics of db server, table name selects a single table, empty string every table
+DB_OPERATION_STATS = 14
+# Conditional saves of a batch under one lock of the table, indexes are built once for the batch
+DB_OPERATION_ENTITY_BULK_LOAD = 15
+
+# Index kinds declared per attribute, True / False stand for unique / non-unique hash index
+INDEX_ORDERED = "ordered"
+INDEX_ORDERED_UNIQUE = "ordered_unique"
+# Composite indexes span several attributes, declared by a tuple of them. Db server knows one by the
+# attribute names joined by the separator and serves filters covering a prefix of them from it
+COMPOSITE_INDEX_SEPARATOR = "+"
+
+# Comparison operators accepted in place of a plain value in GET filters
+FILTER_OP_GT = "$gt"
+FILTER_OP_GTE = "$gte"
+FILTER_OP_LT = "$lt"
+FILTER_OP_LTE = "$lte"
+FILTER_OP_BETWEEN = "$between"
+
+# State maintained by db server for records of tables having an expiry attribute
+RECORD_STATE_FIELD = "state"
+RECORD_STATE_ACTIVE = "active"
+RECORD_STATE_EXPIRED = "expired"
+
+# Version of a record, bumped by db server on every save and used for compare-and-set
+RECORD_VERSION_FIELD = "version"
+
+# Stages of a request marked by db client, see db_store for the ones marked by db server
+TRACE_STAGE_SENT = "sent"
+TRACE_STAGE_REPLIED = "replied"
+
 MAX_TASK_QUEUE_SIZE = 100
+DEFAULT_PAGE_SIZE = 100
+# Read results kept per DAO, least recently used ones are evicted first
+DAO_READ_CACHE_SIZE = 256
@@ -1,8 +1,19 @@
 import asyncio
+import json
 import logging
+import threading
+import time
+from collections import OrderedDict
 from db_lib import DB_OPERATION_CREATE_ENTITY, DB_OPERATION_ENTITY_SAVE, DB_OPERATION_ENTITY_GET, \
-    DB_OPERATION_ENTITY_DEL
+    DB_OPERATION_ENTITY_DEL, DB_OPERATION_ENTITY_MULTI_SAVE, DB_OPERATION_ENTITY_MULTI_GET, \
+    DB_OPERATION_ENTITY_MULTI_DEL, DB_OPERATION_ENTITY_AVAILABLE, DB_OPERATION_ENTITY_EXPLAIN, \
+    DB_OPERATION_ENTITY_JOIN, DB_OPERATION_ENTITY_SCAN, DB_OPERATION_ENTITY_SAVE_IF, DEFAULT_PAGE_SIZE, \
+    DAO_READ_CACHE_SIZE, DB_OPERATION_STATS, TRACE_STAGE_SENT, TRACE_STAGE_REPLIED, DB_OPERATION_ENTITY_BULK_LOAD, \
+    COMPOSITE_INDEX_SEPARATOR
+from db_store.codec import decode_result
 from db_store.datastore_workers import DBAccessReq, DBAccessResp
+from db_store import tracing
+from db_store.metrics import Metrics
 
 logger = None
 
@@ -17,96 +28,503 @@ class Singleton(type):
 
 
 class DBClient(metaclass=Singleton):
+    """ Requests are queued to the db server running on ev_loop, or when a connection
+        pool (db_store.network.DBConnectionPool) is given, sent over it to a remote one.
+        versions are the TableVersions of a db server running in this process, reads
+        are cached by DAOs only when they are known. Round trip latency of every request
+        is recorded in metrics.
+    """
 
-    def __init__(self, req_queue, ev_loop):
+    def __init__(self, req_queue, ev_loop, pool=None, versions=None):
         self._req_queue = req_queue
         self._loop = ev_loop
+        self._pool = pool
+        self.versions = versions
+        self.metrics = Metrics()
 
     @classmethod
     def get_instance(cls):
         return cls(None, None)
 
     async def _execute_op(self, req):
-        logger.debug("Put req in queue async, waiting for result")
+        req.trace(TRACE_STAGE_SENT)
+        if self._pool:
+            logger.debug("Send req to remote db server, waiting for result")
+            resp = DBAccessResp(*await self._pool.execute(req.entity_name, req.op, req.op_data, req.trace_id,
+                                                          req.remaining()))
+            # Stages within the remote db server are logged by its own slow op log under the same trace id
+            req.trace(TRACE_STAGE_REPLIED)
+            tracing.slow_ops.check(req, resp.status, resp.result, "client")
+        else:
+            logger.debug("Put req in queue async, waiting for result")
+            await self._req_queue.put(req)
+            resp = await req.result
+            logger.debug("Received results successfully from db server workers")
+        self.metrics.record(req.op, req.entity_name, time.perf_counter() - req.submitted_at, status=resp.status)
+        return resp
 
-        await self._req_queue.put(req)
-        logger.debug("Received results successfully from db server workers")
-        return await req.result
+    def _on_db_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
 
-    def create_table_async(self, table_name, indexes):
-        req = DBAccessReq(table_name, DB_OPERATION_CREATE_ENTITY, indexes, self._loop.create_future())
-        logger.debug("Put create table req in queue")
+    def _run_sync(self, req):
+        # Blocking on the db loop would wait for a result only this very loop can produce
+        if self._on_db_loop():
+            raise RuntimeError("Blocking DB access from the DB event loop, use the awaitable DAO api instead")
         async_res = asyncio.run_coroutine_threadsafe(self._execute_op(req), self._loop)
         return async_res.result()
 
+    def call_on_loop(self, fn, *args):
+        """ Result of fn called on the thread of the DB event loop, e.g. to profile that thread """
+        async def call():
+            return fn(*args)
+
+        if self._on_db_loop():
+            return fn(*args)
+        return asyncio.run_coroutine_threadsafe(call(), self._loop).result()
+
+    async def submit(self, table_name, op, data):
+        """ Awaitable access for coroutines running on the DB event loop """
+        if not self._on_db_loop():
+            raise RuntimeError("Awaitable DB access is only supported on the DB event loop")
+        req = DBAccessReq(table_name, op, data, self._loop.create_future())
+        return await self._execute_op(req)
+
+    def create_table_async(self, table_name, table_spec):
+        req = DBAccessReq(table_name, DB_OPERATION_CREATE_ENTITY, table_spec, self._loop.create_future())
+        logger.debug("Put create table req in queue")
+        return self._run_sync(req)
+
     def save_async(self, table_name, content):
         req = DBAccessReq(table_name, DB_OPERATION_ENTITY_SAVE, content, self._loop.create_future())
         logger.debug("Put save entity req in queue")
-        async_res = asyncio.run_coroutine_threadsafe(self._execute_op(req), self._loop)
-        return async_res.result()
+        return self._run_sync(req)
+
+    def save_if_async(self, table_name, save):
+        req = DBAccessReq(table_name, DB_OPERATION_ENTITY_SAVE_IF, save, self._loop.create_future())
+        logger.debug("Put conditional save entity req in queue")
+        return self._run_sync(req)
 
     def get_async(self, table_name, filters):
         req = DBAccessReq(table_name, DB_OPERATION_ENTITY_GET, filters, self._loop.create_future())
         logger.debug("Put get entity req in queue")
-        async_res = asyncio.run_coroutine_threadsafe(self._execute_op(req), self._loop)
-        return async_res.result()
+        return self._run_sync(req)
 
     def del_async(self, table_name, _id):
         req = DBAccessReq(table_name, DB_OPERATION_ENTITY_DEL, _id, self._loop.create_future())
         logger.debug("Put del entity req in queue")
-        async_res = asyncio.run_coroutine_threadsafe(self._execute_op(req), self._loop)
-        return async_res.result()
+        return self._run_sync(req)
+
+    def scan_async(self, table_name, scan):
+        req = DBAccessReq(table_name, DB_OPERATION_ENTITY_SCAN, scan, self._loop.create_future())
+        logger.debug(f"Put scan req for {scan.get('limit')} entities in queue")
+        return self._run_sync(req)
+
+    async def scan(self, table_name, scan):
+        """ Async generator of the responses of consecutive pages, ends after the last or a failed page """
+        scan = dict(scan)
+        while True:
+            resp = await self.submit(table_name, DB_OPERATION_ENTITY_SCAN, scan)
+            yield resp
+            if not resp.status or resp.result[1] is None:
+                return
+            scan["cursor"] = resp.result[1]
+
+    def join_async(self, table_name, join):
+        req = DBAccessReq(table_name, DB_OPERATION_ENTITY_JOIN, join, self._loop.create_future())
+        logger.debug("Put join req in queue")
+        return self._run_sync(req)
+
+    def explain_async(self, table_name, filters):
+        req = DBAccessReq(table_name, DB_OPERATION_ENTITY_EXPLAIN, filters, self._loop.create_future())
+        logger.debug("Put explain req in queue")
+        return self._run_sync(req)
+
+    def get_available_async(self, table_name, group):
+        req = DBAccessReq(table_name, DB_OPERATION_ENTITY_AVAILABLE, group, self._loop.create_future())
+        logger.debug("Put get available entities req in queue")
+        return self._run_sync(req)
+
+    def save_many_async(self, table_name, contents):
+        req = DBAccessReq(table_name, DB_OPERATION_ENTITY_MULTI_SAVE, contents, self._loop.create_future())
+        logger.debug(f"Put multi save req for {len(contents)} entities in queue")
+        return self._run_sync(req)
+
+    def bulk_load_async(self, table_name, saves):
+        req = DBAccessReq(table_name, DB_OPERATION_ENTITY_BULK_LOAD, saves, self._loop.create_future())
+        logger.debug(f"Put bulk load req for {len(saves)} entities in queue")
+        return self._run_sync(req)
+
+    def get_many_async(self, table_name, filters_list):
+        req = DBAccessReq(table_name, DB_OPERATION_ENTITY_MULTI_GET, filters_list, self._loop.create_future())
+        logger.debug(f"Put multi get req for {len(filters_list)} filters in queue")
+        return self._run_sync(req)
+
+    def del_many_async(self, table_name, ids):
+        req = DBAccessReq(table_name, DB_OPERATION_ENTITY_MULTI_DEL, ids, self._loop.create_future())
+        logger.debug(f"Put multi del req for {len(ids)} entities in queue")
+        return self._run_sync(req)
+
+    def stats_async(self, table_name=""):
+        """ Metrics of db server, of table_name only when given """
+        req = DBAccessReq(table_name, DB_OPERATION_STATS, None, self._loop.create_future())
+        logger.debug("Put stats req in queue")
+        return self._run_sync(req)
+
+
+class ReadCache(object):
+    """ LRU cache of the read results of a DAO. An entry stays valid as long as the
+        write versions of the tables it was read from are unchanged. Versions are
+        taken before the read is sent, a write racing with the read only costs a miss.
+    """
+
+    def __init__(self, versions, size=DAO_READ_CACHE_SIZE):
+        self.versions = versions
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Shared by the cli thread and coroutines of the db event loop
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(*args):
+        return json.dumps(args, sort_keys=True, default=str)
+
+    def lookup(self, key, tables):
+        """ (versions to store a fresh result with, cached records or None) """
+        versions = self.versions.get(*tables)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return versions, None
+            if entry[0] != versions:
+                del self.entries[key]
+                self.misses += 1
+                return versions, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return versions, list(entry[1])
+
+    def store(self, key, versions, records):
+        with self.lock:
+            self.entries[key] = (versions, list(records))
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
 
 
 class BaseDAO(object):
+    """ Blocking methods are meant for threads other than the DB event loop (like CLI),
+        their a-prefixed awaitable counterparts run as coroutines on the DB event loop.
+        Indexes are declared by attribute, or by a tuple of attributes for a composite one.
+    """
 
-    def __init__(self, entity_name, indexes=None):
+    def __init__(self, entity_name, indexes=None, expires_on=None, availability=None, shard_key=None,
+                 timestamps=()):
         self.db = DBClient.get_instance()
         self.name = entity_name
-        self.indexes = indexes
+        indexes = indexes or {}
+        self.indexes = {i: kind for i, kind in indexes.items() if not isinstance(i, tuple)}
+        self.composite_indexes = {i: kind for i, kind in indexes.items() if isinstance(i, tuple)}
+        self.expires_on = expires_on
+        self.availability = availability
+        self.shard_key = shard_key
+        self.timestamps = list(timestamps)
         self.entity_initialized = False
+        self.cache = ReadCache(self.db.versions) if self.db.versions else None
 
-    def save(self, obj):
-        if not self.entity_initialized:
-            resp = self.db.create_table_async(self.name, self.indexes)
-            if not isinstance(resp, DBAccessResp):
-                return False, None
+    def _table_spec(self):
+        indexes = dict(self.indexes, **{COMPOSITE_INDEX_SEPARATOR.join(i): kind
+                                        for i, kind in self.composite_indexes.items()})
+        return {"indexes": indexes, "expires_on": self.expires_on, "availability": self.availability,
+                "shard_key": self.shard_key, "timestamps": self.timestamps}
 
-            if not resp.status:
-                return resp.status, resp.result
-
-        resp = self.db.save_async(self.name, obj)
+    def _init_result(self, resp):
         if not isinstance(resp, DBAccessResp):
             return False, None
 
+        self.entity_initialized = resp.status
         return resp.status, resp.result
 
-    def remove(self, _id):
-        if not self.entity_initialized:
-            resp = self.db.create_table_async(self.name, self.indexes)
-            if not isinstance(resp, DBAccessResp):
-                return False, None
+    def _init_entity(self):
+        if self.entity_initialized:
+            return True, None
+        return self._init_result(self.db.create_table_async(self.name, self._table_spec()))
 
-            if not resp.status:
-                return resp.status, resp.result
+    async def _ainit_entity(self):
+        if self.entity_initialized:
+            return True, None
+        return self._init_result(await self.db.submit(self.name, DB_OPERATION_CREATE_ENTITY, self._table_spec()))
 
-        resp = self.db.del_async(self.name, _id)
+    @staticmethod
+    def _result(resp, decode=None):
         if not isinstance(resp, DBAccessResp):
             return False, None
 
-        return resp.status, resp.result
+        if not resp.status or not decode:
+            return resp.status, resp.result
+        return resp.status, decode(resp.result)
+
+    def _cache_lookup(self, tables, *args):
+        """ (key, versions, records) of a read, records are set when served from cache """
+        if not self.cache:
+            return None, None, None
+        key = ReadCache.key(*args)
+        return (key,) + self.cache.lookup(key, tables)
+
+    def _cache_store(self, key, versions, res):
+        status, records = res
+        if key and status:
+            self.cache.store(key, versions, records)
+        return res
+
+    def _related_tables(self, *related):
+        return (self.name,) + related
+
+    def _available_tables(self):
+        # Availability changes with writes of the tracking entity and of the tracked resource
+        return self._related_tables(self.availability["of"]) if self.availability else self._related_tables()
+
+    @staticmethod
+    def _decode_one(result):
+        return decode_result(result)[0]
+
+    @staticmethod
+    def _decode_items(items, single):
+        # Per item status of a batch operation, failed items keep the error returned by server
+        decoded = []
+        for status, result in items:
+            if status and result is not None:
+                result = decode_result(result)
+                if single:
+                    result = result[0]
+            decoded.append((status, result))
+        return decoded
+
+    @staticmethod
+    def _decode_saved_items(items):
+        return BaseDAO._decode_items(items, single=True)
+
+    @staticmethod
+    def _decode_found_items(items):
+        return BaseDAO._decode_items(items, single=False)
+
+    def save(self, obj):
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        return self._result(self.db.save_async(self.name, obj), self._decode_one)
+
+    def save_if(self, obj, none_match=None, version=None):
+        """ Save obj only if no other entity matches none_match filters and, when version is given,
+            the stored entity still has that version. Failure result carries the conflicting entity.
+        """
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        save = {"content": obj, "none_match": none_match, "version": version}
+        return self._result(self.db.save_if_async(self.name, save), self._decode_one)
+
+    def remove(self, _id):
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        return self._result(self.db.del_async(self.name, _id))
 
     def get(self, filters):
-        if not self.entity_initialized:
-            resp = self.db.create_table_async(self.name, self.indexes)
-            if not isinstance(resp, DBAccessResp):
-                return False, None
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        key, versions, records = self._cache_lookup(self._related_tables(), "get", filters)
+        if records is not None:
+            return True, records
+        return self._cache_store(key, versions, self._result(self.db.get_async(self.name, filters), decode_result))
 
-            if not resp.status:
-                return resp.status, resp.result
+    @staticmethod
+    def _scan_spec(filters, limit, cursor, order_by):
+        return {"filters": filters, "limit": limit, "cursor": cursor, "order_by": order_by}
 
-        resp = self.db.get_async(self.name, filters)
-        if not isinstance(resp, DBAccessResp):
-            return False, None
+    @staticmethod
+    def _decode_page(result):
+        records, cursor = result
+        return decode_result(records), cursor
 
-        return resp.status, resp.result
+    def get_page(self, filters=None, limit=DEFAULT_PAGE_SIZE, cursor=None, order_by=None):
+        """ Up to limit records following cursor, result is (records, cursor of next page or None) """
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        scan = self._scan_spec(filters, limit, cursor, order_by)
+        return self._result(self.db.scan_async(self.name, scan), self._decode_page)
+
+    def scan(self, filters=None, limit=DEFAULT_PAGE_SIZE, order_by=None):
+        """ Generator of (status, records) per page, a page is fetched once the previous one is consumed """
+        cursor = None
+        while True:
+            status, result = self.get_page(filters, limit, cursor, order_by)
+            yield status, result[0] if status else result
+            if not status or result[1] is None:
+                return
+            cursor = result[1]
+
+    @staticmethod
+    def _join_spec(related_name, join_key, related_filters, filters):
+        return {"related": related_name, "join_key": join_key, "related_filters": related_filters,
+                "filters": filters}
+
+    def join(self, related_name, join_key, related_filters=None, filters=None):
+        """ Records of this entity whose join_key matches one of the related records selected by related_filters """
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        join = self._join_spec(related_name, join_key, related_filters, filters)
+        key, versions, records = self._cache_lookup(self._related_tables(related_name), "join", join)
+        if records is not None:
+            return True, records
+        return self._cache_store(key, versions, self._result(self.db.join_async(self.name, join), decode_result))
+
+    def explain(self, filters):
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        return self._result(self.db.explain_async(self.name, filters))
+
+    def get_available(self, group):
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        key, versions, records = self._cache_lookup(self._available_tables(), "available", group)
+        if records is not None:
+            return True, records
+        return self._cache_store(key, versions,
+                                 self._result(self.db.get_available_async(self.name, group), decode_result))
+
+    def save_many(self, objs):
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        return self._result(self.db.save_many_async(self.name, list(objs)), self._decode_saved_items)
+
+    @staticmethod
+    def _bulk_saves(objs_conditions):
+        return [{"content": obj, "none_match": none_match, "version": None} for obj, none_match in objs_conditions]
+
+    def bulk_load(self, objs_conditions):
+        """ Conditional saves (see save_if) of (obj, none_match) pairs in one batch, built into the
+            indexes at once. Result holds (status, saved entity or error) of every obj in order.
+        """
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        saves = self._bulk_saves(objs_conditions)
+        return self._result(self.db.bulk_load_async(self.name, saves), self._decode_saved_items)
+
+    def remove_many(self, ids):
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        return self._result(self.db.del_many_async(self.name, list(ids)))
+
+    def get_many(self, filters_list):
+        status, result = self._init_entity()
+        if not status:
+            return status, result
+        return self._result(self.db.get_many_async(self.name, list(filters_list)), self._decode_found_items)
+
+    async def asave(self, obj):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        return self._result(await self.db.submit(self.name, DB_OPERATION_ENTITY_SAVE, obj), self._decode_one)
+
+    async def asave_if(self, obj, none_match=None, version=None):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        save = {"content": obj, "none_match": none_match, "version": version}
+        return self._result(await self.db.submit(self.name, DB_OPERATION_ENTITY_SAVE_IF, save), self._decode_one)
+
+    async def aremove(self, _id):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        return self._result(await self.db.submit(self.name, DB_OPERATION_ENTITY_DEL, _id))
+
+    async def aget(self, filters):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        key, versions, records = self._cache_lookup(self._related_tables(), "get", filters)
+        if records is not None:
+            return True, records
+        resp = await self.db.submit(self.name, DB_OPERATION_ENTITY_GET, filters)
+        return self._cache_store(key, versions, self._result(resp, decode_result))
+
+    async def aget_page(self, filters=None, limit=DEFAULT_PAGE_SIZE, cursor=None, order_by=None):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        scan = self._scan_spec(filters, limit, cursor, order_by)
+        return self._result(await self.db.submit(self.name, DB_OPERATION_ENTITY_SCAN, scan), self._decode_page)
+
+    async def ascan(self, filters=None, limit=DEFAULT_PAGE_SIZE, order_by=None):
+        """ Async generator of (status, records) per page """
+        status, result = await self._ainit_entity()
+        if not status:
+            yield status, result
+            return
+        async for resp in self.db.scan(self.name, self._scan_spec(filters, limit, None, order_by)):
+            status, result = self._result(resp, self._decode_page)
+            yield status, result[0] if status else result
+
+    async def ajoin(self, related_name, join_key, related_filters=None, filters=None):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        join = self._join_spec(related_name, join_key, related_filters, filters)
+        key, versions, records = self._cache_lookup(self._related_tables(related_name), "join", join)
+        if records is not None:
+            return True, records
+        resp = await self.db.submit(self.name, DB_OPERATION_ENTITY_JOIN, join)
+        return self._cache_store(key, versions, self._result(resp, decode_result))
+
+    async def aget_available(self, group):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        key, versions, records = self._cache_lookup(self._available_tables(), "available", group)
+        if records is not None:
+            return True, records
+        resp = await self.db.submit(self.name, DB_OPERATION_ENTITY_AVAILABLE, group)
+        return self._cache_store(key, versions, self._result(resp, decode_result))
+
+    async def asave_many(self, objs):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        resp = await self.db.submit(self.name, DB_OPERATION_ENTITY_MULTI_SAVE, list(objs))
+        return self._result(resp, self._decode_saved_items)
+
+    async def abulk_load(self, objs_conditions):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        resp = await self.db.submit(self.name, DB_OPERATION_ENTITY_BULK_LOAD, self._bulk_saves(objs_conditions))
+        return self._result(resp, self._decode_saved_items)
+
+    async def aremove_many(self, ids):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        return self._result(await self.db.submit(self.name, DB_OPERATION_ENTITY_MULTI_DEL, list(ids)))
+
+    async def aget_many(self, filters_list):
+        status, result = await self._ainit_entity()
+        if not status:
+            return status, result
+        resp = await self.db.submit(self.name, DB_OPERATION_ENTITY_MULTI_GET, list(filters_list))
+        return self._result(resp, self._decode_found_items)
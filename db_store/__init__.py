@@ -4,13 +4,132 @@ DB_OPERATION_DROP_ENTITY = 2
 DB_OPERATION_ENTITY_GET = 3
 DB_OPERATION_ENTITY_SAVE = 4
 DB_OPERATION_ENTITY_DEL = 5
+DB_OPERATION_ENTITY_MULTI_SAVE = 6
+DB_OPERATION_ENTITY_MULTI_GET = 7
+DB_OPERATION_ENTITY_MULTI_DEL = 8
+DB_OPERATION_ENTITY_AVAILABLE = 9
+DB_OPERATION_ENTITY_EXPLAIN = 10
+DB_OPERATION_ENTITY_JOIN = 11
+DB_OPERATION_ENTITY_SCAN = 12
+DB_OPERATION_ENTITY_SAVE_IF = 13
+# Runtime metrics of db server, table name selects a single table, empty string every table
+DB_OPERATION_STATS = 14
+# Conditional saves of a batch under one lock of the table, indexes are built once for the batch
+DB_OPERATION_ENTITY_BULK_LOAD = 15
+
+# Index kinds declared per attribute, True / False stand for unique / non-unique hash index
+INDEX_ORDERED = "ordered"
+INDEX_ORDERED_UNIQUE = "ordered_unique"
+# Composite indexes span several attributes, declared by a tuple of them. Db server knows one by the
+# attribute names joined by the separator and serves filters covering a prefix of them from it
+COMPOSITE_INDEX_SEPARATOR = "+"
+
+# Comparison operators accepted in place of a plain value in GET filters
+FILTER_OP_GT = "$gt"
+FILTER_OP_GTE = "$gte"
+FILTER_OP_LT = "$lt"
+FILTER_OP_LTE = "$lte"
+FILTER_OP_BETWEEN = "$between"
+
+# State maintained by db server for records of tables having an expiry attribute
+RECORD_STATE_FIELD = "state"
+RECORD_STATE_ACTIVE = "active"
+RECORD_STATE_EXPIRED = "expired"
+
+# Version of a record, bumped by db server on every save and used for compare-and-set
+RECORD_VERSION_FIELD = "version"
 
 # ERROR Messages returned by DB server
 TABLE_NOT_FOUND = "Table {} does not exist"
 ENTITY_NOT_FOUND = "Entity with id : {} does not exist"
 DUPLICATE_ENTITY_FOUND = "Entity: {} information overlap with other entities"
 UNSUPPORTED_DB_OPERATION = "DB Operation: {} is not supported"
+AVAILABILITY_NOT_TRACKED = "Availability is not tracked by table {}"
+INDEX_NOT_ORDERED = "Attribute {} has no ordered index to order by"
+INVALID_SCAN_REQUEST = "Invalid limit or cursor in scan request: {}"
+SHARD_KEY_IMMUTABLE = "Shard key {} of an entity can not be modified"
+SHARD_UNAVAILABLE = "DB shard: {} is not reachable"
+CONDITION_FAILED = "Entity: {} conflicts with an existing entity"
+VERSION_MISMATCH = "Entity with id : {} was modified concurrently"
+CONDITION_NOT_SHARD_LOCAL = "Condition of a conditional save on {} has to pin the shard key of the entity"
+INVALID_DB_REQUEST = "Invalid request for DB operation: {}"
+DB_SERVER_UNAVAILABLE = "DB server: {} is not reachable"
+DB_SERVER_OVERLOADED = "DB server is overloaded, {} request is shed - please retry later"
+REQUEST_TIMED_OUT = "Request timed out waiting in {} queue of DB server"
 
 # constants to be used by DB Server
 MAX_TASK_QUEUE_SIZE = 100
+DEFAULT_PAGE_SIZE = 100
 DEFAULT_UUID_LEN = 36
+
+# Scheduling - requests wait for db server workers in a lane per kind of operation, lanes are listed
+# in the order of priority and served by weighted round robin. A request put to a full lane is shed,
+# one still waiting past its deadline (timeout in seconds, unless the client gave one) times out.
+SCHED_LANE_WRITE = "write"
+SCHED_LANE_READ = "read"
+SCHED_LANE_SCAN = "scan"
+SCHED_LANES = (SCHED_LANE_WRITE, SCHED_LANE_READ, SCHED_LANE_SCAN)
+SCHED_LANE_SIZES = {SCHED_LANE_WRITE: MAX_TASK_QUEUE_SIZE, SCHED_LANE_READ: MAX_TASK_QUEUE_SIZE, SCHED_LANE_SCAN: 20}
+SCHED_LANE_WEIGHTS = {SCHED_LANE_WRITE: 4, SCHED_LANE_READ: 4, SCHED_LANE_SCAN: 1}
+SCHED_LANE_TIMEOUTS = {SCHED_LANE_WRITE: 10, SCHED_LANE_READ: 5, SCHED_LANE_SCAN: 10}
+
+# Worker pool execution - tasks of the event loop, or threads guarded by striped locks
+WORKER_MODE_ASYNC = "async"
+WORKER_MODE_THREAD = "thread"
+DEFAULT_LOCK_STRIPES = 64
+
+# Multi-version reads - a read sees the records as of the snapshot it took, versions replaced meanwhile
+# are kept until no snapshot can read them and collected every MVCC_GC_INTERVAL seconds. Pages of a scan
+# share the snapshot of its first page, it is released after the last page or SNAPSHOT_LEASE idle seconds.
+MVCC_GC_INTERVAL = 1
+SNAPSHOT_LEASE = 60
+
+# Durability - write ahead log and snapshot of db server
+WAL_FILE_NAME = "quick_reserve.wal"
+SNAPSHOT_FILE_NAME = "quick_reserve.snapshot"
+WAL_SNAPSHOT_INTERVAL = 10000
+WAL_OP_CREATE_TABLE = "create"
+WAL_OP_SAVE_RECORD = "save"
+WAL_OP_DEL_RECORD = "del"
+
+# Sharding - every shard process keeps its durable state in its own directory of data dir
+SHARD_DIR_NAME = "shard_{}"
+SHARD_LOG_FILE = "quick_reserve_shard_{}.log"
+
+# Network front-end of DB server, TCP "host:port" or "unix:path" addresses
+DEFAULT_DB_ADDRESS = "127.0.0.1:7711"
+DB_CONNECTION_POOL_SIZE = 4
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Tracing - stages a request passes, in order, from DBClient to the reply of db server. Requests taking
+# longer than the slow op threshold from submission to reply are logged with time spent between stages.
+TRACE_STAGE_SUBMITTED = "submitted"
+TRACE_STAGE_SENT = "sent"
+TRACE_STAGE_RECEIVED = "received"
+TRACE_STAGE_STARTED = "started"
+TRACE_STAGE_LOCKED = "locked"
+TRACE_STAGE_EXECUTED = "executed"
+TRACE_STAGE_HANDLED = "handled"
+TRACE_STAGE_DURABLE = "durable"
+TRACE_STAGE_REPLIED = "replied"
+DEFAULT_SLOW_OP_MS = 100
+SLOW_OP_DATA_LIMIT = 300
+
+# Result formats returned by DB server
+RESULT_FORMAT_NATIVE = "native"
+RESULT_FORMAT_BINARY = "binary"
+
+# Records store timestamps as integer seconds since epoch, this format is used to display them
+# and to read the strings records were saved with before
+TIMESTAMP_FORMAT = "%d/%m/%YT%H:%M:%S"
+
+# Query planner access paths
+PLAN_ACCESS_INDEX = "index"
+PLAN_ACCESS_RANGE = "range"
+PLAN_ACCESS_COMPOSITE = "composite"
+PLAN_ACCESS_RESIDUAL = "residual"
+PLAN_ACCESS_SCAN = "scan"
+RANGE_TO_RESIDUAL_FACTOR = 8
+JOIN_INDEX_NESTED_LOOP = "index_nested_loop"
+JOIN_HASH = "hash_join"
+JOIN_FILTER_PROBE = "filter_probe"
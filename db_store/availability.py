@@ -0,0 +1,75 @@
+import threading
+
+from db_store import RECORD_STATE_FIELD, RECORD_STATE_ACTIVE
+
+
+class AvailabilityIndex(object):
+    """ Keeps, per group (e.g. model_name), the keys (e.g. reg_no) of resource
+        records which have no active record in the tracking table. It is fed
+        by change listeners of both tables, so a lookup costs in proportion
+        to the number of available resources.
+    """
+
+    def __init__(self, tracker, resource, key, group_by):
+        self.tracker = tracker
+        self.resource = resource
+        self.key = key
+        self.group_by = group_by
+        self.busy = {}
+        self.resources = {}
+        self.free = {}
+        # Writers of the tracker and of the resource table may run in parallel in thread worker mode
+        self.lock = threading.Lock()
+
+    @property
+    def spec(self):
+        return {"of": self.resource, "key": self.key, "group_by": self.group_by}
+
+    def __mark_free(self, key):
+        if key not in self.resources or self.busy.get(key):
+            return
+        group, _ = self.resources[key]
+        self.free.setdefault(group, set()).add(key)
+
+    def __mark_busy(self, key):
+        if key not in self.resources:
+            return
+        group, _ = self.resources[key]
+        keys = self.free.get(group)
+        if not keys or key not in keys:
+            return
+        keys.remove(key)
+        if not keys:
+            del self.free[group]
+
+    def on_resource_change(self, record_id, old, new):
+        with self.lock:
+            self.__resource_changed(record_id, old, new)
+
+    def __resource_changed(self, record_id, old, new):
+        if old is not None:
+            self.__mark_busy(old.get(self.key))
+            self.resources.pop(old.get(self.key), None)
+        if new is not None:
+            self.resources[new.get(self.key)] = (new.get(self.group_by), record_id)
+            self.__mark_free(new.get(self.key))
+
+    def on_tracker_change(self, record_id, old, new):
+        with self.lock:
+            self.__tracker_changed(old, new)
+
+    def __tracker_changed(self, old, new):
+        if old is not None and old.get(RECORD_STATE_FIELD) == RECORD_STATE_ACTIVE:
+            key = old.get(self.key)
+            self.busy[key] -= 1
+            if not self.busy[key]:
+                del self.busy[key]
+                self.__mark_free(key)
+        if new is not None and new.get(RECORD_STATE_FIELD) == RECORD_STATE_ACTIVE:
+            key = new.get(self.key)
+            self.busy[key] = self.busy.get(key, 0) + 1
+            self.__mark_busy(key)
+
+    def get_available_record_ids(self, group):
+        with self.lock:
+            return [self.resources[key][1] for key in self.free.get(group, ())]
@@ -0,0 +1,155 @@
+import json
+import struct
+from collections import namedtuple
+from types import MappingProxyType
+
+from db_store import RESULT_FORMAT_NATIVE, RESULT_FORMAT_BINARY
+
+# Binary result layout (all integers little endian)
+#   header : magic(2s) version(B) record count(I) key count(H)
+#   keys   : key count times length(H) + utf-8 bytes
+#   record : id length(H) + id, field count(H), fields
+#   field  : key position(H), type tag(B), value
+RESULT_MAGIC = b"QR"
+RESULT_VERSION = 1
+
+TAG_NONE = 0
+TAG_TRUE = 1
+TAG_FALSE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STR = 5
+TAG_JSON = 6
+
+_HEADER = struct.Struct("<2sBIH")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+
+
+class RecordView(namedtuple("RecordView", ["id", "content"])):
+    """ Immutable view of a record returned to db clients """
+    __slots__ = ()
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record.id, MappingProxyType(record.content))
+
+    def as_dict(self):
+        return {"id": self.id, "content": dict(self.content)}
+
+
+def _pack_str(buf, value, length_struct=_U16):
+    data = value.encode("utf-8")
+    buf += length_struct.pack(len(data))
+    buf += data
+
+
+def _pack_value(buf, value):
+    if value is None:
+        buf.append(TAG_NONE)
+    elif value is True:
+        buf.append(TAG_TRUE)
+    elif value is False:
+        buf.append(TAG_FALSE)
+    elif isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        buf.append(TAG_INT)
+        buf += _INT.pack(value)
+    elif isinstance(value, float):
+        buf.append(TAG_FLOAT)
+        buf += _FLOAT.pack(value)
+    elif isinstance(value, str):
+        buf.append(TAG_STR)
+        _pack_str(buf, value, _U32)
+    else:
+        buf.append(TAG_JSON)
+        _pack_str(buf, json.dumps(value), _U32)
+
+
+def encode_records(records):
+    keys = {}
+    body = bytearray()
+    count = 0
+    for r in records:
+        count += 1
+        _pack_str(body, r.id)
+        body += _U16.pack(len(r.content))
+        for key, value in r.content.items():
+            pos = keys.get(key)
+            if pos is None:
+                pos = keys[key] = len(keys)
+            body += _U16.pack(pos)
+            _pack_value(body, value)
+
+    buf = bytearray(_HEADER.pack(RESULT_MAGIC, RESULT_VERSION, count, len(keys)))
+    for key in keys:
+        _pack_str(buf, key)
+    buf += body
+    return bytes(buf)
+
+
+def _unpack_str(view, offset, length_struct=_U16):
+    (length,) = length_struct.unpack_from(view, offset)
+    offset += length_struct.size
+    return str(view[offset:offset + length], "utf-8"), offset + length
+
+
+def _unpack_value(view, offset):
+    tag = view[offset]
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    if tag == TAG_TRUE:
+        return True, offset
+    if tag == TAG_FALSE:
+        return False, offset
+    if tag == TAG_INT:
+        return _INT.unpack_from(view, offset)[0], offset + _INT.size
+    if tag == TAG_FLOAT:
+        return _FLOAT.unpack_from(view, offset)[0], offset + _FLOAT.size
+    value, offset = _unpack_str(view, offset, _U32)
+    if tag == TAG_JSON:
+        value = json.loads(value)
+    return value, offset
+
+
+def decode_records(data):
+    view = memoryview(data)
+    magic, version, count, key_count = _HEADER.unpack_from(view, 0)
+    if magic != RESULT_MAGIC or version != RESULT_VERSION:
+        raise ValueError(f"Unsupported result encoding: {bytes(magic)}:{version}")
+
+    offset = _HEADER.size
+    keys = []
+    for _ in range(key_count):
+        key, offset = _unpack_str(view, offset)
+        keys.append(key)
+
+    records = []
+    for _ in range(count):
+        record_id, offset = _unpack_str(view, offset)
+        (field_count,) = _U16.unpack_from(view, offset)
+        offset += _U16.size
+        content = {}
+        for _ in range(field_count):
+            (pos,) = _U16.unpack_from(view, offset)
+            value, offset = _unpack_value(view, offset + _U16.size)
+            content[keys[pos]] = value
+        records.append(RecordView(record_id, MappingProxyType(content)))
+    return records
+
+
+def encode_result(records, result_format):
+    if result_format == RESULT_FORMAT_BINARY:
+        return encode_records(records)
+    if result_format == RESULT_FORMAT_NATIVE:
+        return [RecordView.from_record(r) for r in records]
+    raise ValueError(f"Unsupported result format: {result_format}")
+
+
+def decode_result(result):
+    """ Client side counterpart of encode_result, native results are passed through """
+    if isinstance(result, (bytes, bytearray, memoryview)):
+        return decode_records(result)
+    return result
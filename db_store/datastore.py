@@ -1,26 +1,215 @@
+import itertools
+import threading
+import time
 import uuid
+from contextlib import contextmanager
+from functools import partial
+from bisect import bisect_left, bisect_right, insort
 
-# TBD: Add locks while accessing database
-# TBD: Compress the data
+from db_store import INDEX_ORDERED, INDEX_ORDERED_UNIQUE, FILTER_OP_GT, FILTER_OP_GTE, FILTER_OP_LT, \
+    FILTER_OP_LTE, FILTER_OP_BETWEEN, RECORD_STATE_FIELD, SNAPSHOT_LEASE, COMPOSITE_INDEX_SEPARATOR
+from db_store.availability import AvailabilityIndex
+
+# Stores are not synchronized themselves, in thread worker mode db_store.locks guards every write.
+# Reads of a TableView may run along with a writer, they rely on the record stamps instead.
+
+# Marks a column value absent for a record, None is a legitimate field value
+MISSING = object()
+# Sorts above the sort key of any value, bounds the keys of a composite index sharing a prefix
+KEY_ABOVE_ALL = (3,)
+
+
+def range_bounds(condition):
+    """ Translate a comparison filter into (low, low_inclusive, high, high_inclusive) """
+    low, low_inclusive, high, high_inclusive = None, True, None, True
+    if FILTER_OP_BETWEEN in condition:
+        low, high = condition[FILTER_OP_BETWEEN]
+    if FILTER_OP_GTE in condition:
+        low, low_inclusive = condition[FILTER_OP_GTE], True
+    if FILTER_OP_GT in condition:
+        low, low_inclusive = condition[FILTER_OP_GT], False
+    if FILTER_OP_LTE in condition:
+        high, high_inclusive = condition[FILTER_OP_LTE], True
+    if FILTER_OP_LT in condition:
+        high, high_inclusive = condition[FILTER_OP_LT], False
+    return low, low_inclusive, high, high_inclusive
+
+
+def matches(value, condition):
+    """ Residual evaluation of a filter condition on a field value """
+    if not isinstance(condition, dict):
+        return value == condition
+    if value is None:
+        return False
+    low, low_inclusive, high, high_inclusive = range_bounds(condition)
+    key = sort_key(value)
+    if low is not None:
+        low_key = sort_key(low)
+        if key[0] != low_key[0] or key < low_key or (key == low_key and not low_inclusive):
+            return False
+    if high is not None:
+        high_key = sort_key(high)
+        if key[0] != high_key[0] or key > high_key or (key == high_key and not high_inclusive):
+            return False
+    return True
+
+
+def sort_key(value):
+    # Numbers and numeric strings ("2020" from CLI) compare as numbers, everything else as text
+    if isinstance(value, bool) or value is None:
+        return 2, str(value)
+    if isinstance(value, (int, float)):
+        return 0, value
+    if isinstance(value, str):
+        try:
+            return 0, float(value)
+        except ValueError:
+            return 1, value
+    return 2, str(value)
+
+
+def key_range(keys, condition):
+    """ (start, end) slice of sorted keys within the bounds of a range filter """
+    low, low_inclusive, high, high_inclusive = range_bounds(condition)
+    low_key = sort_key(low) if low is not None else None
+    high_key = sort_key(high) if high is not None else None
+    # An open end stays within the type class of the other bound, "N/A" is not above 2020
+    group = (low_key or high_key or (0,))[0]
+
+    if low_key is None:
+        start = bisect_left(keys, (group,))
+    elif low_inclusive:
+        start = bisect_left(keys, low_key)
+    else:
+        start = bisect_right(keys, low_key)
+
+    if high_key is None:
+        end = bisect_left(keys, (group + 1,))
+    elif high_inclusive:
+        end = bisect_right(keys, high_key)
+    else:
+        end = bisect_left(keys, high_key)
+    return start, max(start, end)
+
+
+class VersionClock(object):
+    """ Stamps the writes of a DBStore in the order they are applied, and keeps the stamps of
+        open snapshots. A snapshot at stamp S sees every write stamped up to S, taking it
+        waits for those of them still being applied. Writes starting while a snapshot is
+        open keep the versions they replace, until no snapshot can read them anymore.
+        A leased snapshot outlives the request taking it (pages of a scan), it is held until
+        released or idle for SNAPSHOT_LEASE seconds.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.stamp = 0
+        self.writing = set()
+        # Stamp of open snapshots -> number of readers, lease id -> [stamp, idle deadline]
+        self.active = {}
+        self.leases = {}
+        self.lease_ids = itertools.count(1)
+
+    def begin_write(self):
+        """ (stamp of the write, whether the versions it replaces have to be kept) """
+        with self.cond:
+            self.stamp += 1
+            self.writing.add(self.stamp)
+            return self.stamp, bool(self.active)
+
+    def end_write(self, stamp):
+        with self.cond:
+            self.writing.discard(stamp)
+            if self.active:
+                self.cond.notify_all()
+
+    def acquire(self):
+        with self.cond:
+            at = self.stamp
+            self.active[at] = self.active.get(at, 0) + 1
+            # Writes still being applied were stamped before, later ones keep what they replace
+            self.cond.wait_for(lambda: not self.writing or min(self.writing) > at)
+            return at
+
+    def release(self, at):
+        with self.cond:
+            self.active[at] -= 1
+            if not self.active[at]:
+                del self.active[at]
+
+    def lease(self):
+        """ (lease id, stamp) of a new snapshot held for later requests """
+        at = self.acquire()
+        with self.cond:
+            lease_id = next(self.lease_ids)
+            self.leases[lease_id] = [at, time.monotonic() + SNAPSHOT_LEASE]
+        return lease_id, at
+
+    def renew(self, lease_id):
+        """ Stamp of a leased snapshot, None once it is released or expired """
+        with self.cond:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return None
+            lease[1] = time.monotonic() + SNAPSHOT_LEASE
+            return lease[0]
+
+    def end_lease(self, lease_id):
+        with self.cond:
+            lease = self.leases.pop(lease_id, None)
+        if lease:
+            self.release(lease[0])
+
+    def expire_leases(self):
+        now = time.monotonic()
+        with self.cond:
+            expired = [lease_id for lease_id, (_, deadline) in self.leases.items() if deadline <= now]
+        for lease_id in expired:
+            self.end_lease(lease_id)
+        return len(expired)
+
+    def active_stamps(self):
+        with self.cond:
+            return sorted(self.active)
+
+    def stats(self):
+        with self.cond:
+            return {"open": sum(self.active.values()), "leased": len(self.leases)}
 
 
 class DBStore(object):
     def __init__(self, name):
         self.name = name
         self.tables = {}
+        self.availability = {}
+        self.clock = VersionClock()
 
-    def register_table(self, table_name, indexes=None):
+    def register_table(self, table_name, indexes=None, expires_on=None, availability=None):
+        """ Registers a table with its indexes, indexes new to a registered table are added to it.
+            Result is the names of the indexes added.
+        """
         if table_name in self.tables:
-            return
-        ts = TableStore(table_name)
+            table = self.tables[table_name]
+            return [index for index, kind in (indexes or {}).items() if table.register_index(index, kind)]
+        ts = TableStore(table_name, expires_on, self.clock)
         self.tables[table_name] = ts
+        if availability:
+            ai = AvailabilityIndex(table_name, availability["of"], availability["key"], availability["group_by"])
+            self.availability[table_name] = ai
+            ts.add_listener(ai.on_tracker_change)
+            if ai.resource in self.tables:
+                self.tables[ai.resource].add_listener(ai.on_resource_change)
+        for ai in self.availability.values():
+            if ai.resource == table_name:
+                ts.add_listener(ai.on_resource_change)
         if not indexes:
             indexes = {"id": True}
         else:
             indexes["id"] = True
+        if expires_on:
+            indexes[RECORD_STATE_FIELD] = False
 
-        for index, unique in indexes.items():
-            ts.register_index(index, unique)
+        return [index for index, kind in indexes.items() if ts.register_index(index, kind)]
 
     def drop_table(self, table_name):
         if table_name not in self.tables:
@@ -40,17 +229,98 @@ class DBStore(object):
     def get_tables(self):
         return self.tables
 
+    def get_availability(self, table_name):
+        return self.availability.get(table_name)
+
+    @contextmanager
+    def snapshot(self):
+        """ Stamp of a snapshot of every table, open until exit """
+        at = self.clock.acquire()
+        try:
+            yield at
+        finally:
+            self.clock.release(at)
+
+    def collect_versions(self):
+        """ Expires idle leases, then drops the record versions no open snapshot can read.
+            Result is (leases expired, versions dropped).
+        """
+        expired = self.clock.expire_leases()
+        active = self.clock.active_stamps()
+        return expired, sum(table.collect_versions(active) for table in list(self.tables.values()))
+
 
 class TableStore(object):
-    def __init__(self, name):
+    """ Columnar storage of the records of a table. Schema grows with the
+        fields seen in the saved content, every field is one column list
+        indexed by the slot of the record. Records are materialized only
+        when a caller asks for them.
+        Every slot carries the stamp of the write which stored its record.
+        While snapshots are open, a write first keeps the content it replaces
+        as a version of the record, and its old index values in ghost indexes,
+        so a TableView reads the table as it was at the stamp of its snapshot.
+    """
+
+    def __init__(self, name, expires_on=None, clock=None):
         self.name = name
+        self.expires_on = expires_on
+        self.clock = clock or VersionClock()
         self.indexes = {}
-        self.records = {}
+        self.schema = []
+        self.columns = {}
+        self.slots = {}
+        self.record_ids = []
+        self.free_slots = []
+        self.listeners = []
+        self.stamps = []
+        # Replaced versions (valid from, valid to, slot, content) by record id, ids of records deleted
+        # by slot and ghost indexes, rebuilt by collect_versions and written under versions_lock
+        self.versions = {}
+        self.removed = {}
+        self.ghosts = {}
+        self.versions_lock = threading.Lock()
 
-    def register_index(self, index_name, is_unique):
+    def register_index(self, index_name, kind):
+        """ Adds an index holding the records stored so far, result is whether it was added """
         if index_name in self.indexes:
-            return
-        self.indexes[index_name] = IndexStore(index_name, is_unique)
+            return False
+        fields = index_name.split(COMPOSITE_INDEX_SEPARATOR)
+        if len(fields) > 1:
+            index = CompositeIndexStore(index_name, fields, kind in (True, INDEX_ORDERED_UNIQUE))
+        elif kind in (INDEX_ORDERED, INDEX_ORDERED_UNIQUE):
+            index = OrderedIndexStore(index_name, kind == INDEX_ORDERED_UNIQUE)
+        else:
+            index = IndexStore(index_name, bool(kind))
+
+        # Built before readers can find it, writers are held off by the lock of the caller
+        if isinstance(index, OrderedIndexStore):
+            index.defer_keys()
+        for _, record_id in self.iter_slots():
+            index.register_indexed_record_id(index.record_value(partial(self.get_field, record_id)), record_id)
+        if isinstance(index, OrderedIndexStore):
+            index.merge_keys()
+        with self.versions_lock:
+            if self.versions:
+                # Versions kept for open snapshots are found by them through the ghost
+                ghost = self.ghosts[index_name] = index.empty_copy()
+                for record_id, kept in self.versions.items():
+                    for _, _, _, content in kept:
+                        ghost.register_indexed_record_id(index.record_value(content.get), record_id)
+            # Replaced rather than grown, readers may be iterating the indexes
+            self.indexes = {**self.indexes, index_name: index}
+        return True
+
+    @contextmanager
+    def bulk_indexing(self):
+        """ Keys new to ordered indexes are merged into them once on exit, instead of an insort per record """
+        ordered = [o for o in self.indexes.values() if isinstance(o, OrderedIndexStore)]
+        for o in ordered:
+            o.defer_keys()
+        try:
+            yield
+        finally:
+            for o in ordered:
+                o.merge_keys()
 
     def del_index(self, index_name):
         if index_name not in self.indexes:
@@ -60,10 +330,75 @@ class TableStore(object):
     def get_indexed(self, index_name):
         return self.indexes.get(index_name, None)
 
-    def add_record(self, content, record=None):
-        # TBD: Handle unique values
+    def composite_indexes(self):
+        return [o for o in list(self.indexes.values()) if isinstance(o, CompositeIndexStore)]
+
+    def add_listener(self, listener):
+        """ listener(record_id, old_content, new_content) is called after every change,
+            records already stored are replayed to it as additions
+        """
+        self.listeners.append(listener)
+        for record in self.iter_records():
+            listener(record.id, None, record.content)
+
+    def __notify(self, record_id, old, new):
+        for listener in self.listeners:
+            listener(record_id, old, new)
+
+    def __add_column(self, field):
+        self.schema.append(field)
+        # Replaced rather than grown, readers of other records may be iterating the columns
+        self.columns = {**self.columns, field: [MISSING] * len(self.record_ids)}
+
+    def __write_slot(self, slot, content):
+        for field in content:
+            if field not in self.columns:
+                self.__add_column(field)
+        for field, column in self.columns.items():
+            column[slot] = content.get(field, MISSING)
+
+    def __allocate_slot(self, record_id, stamp):
+        # Stamp and columns of a slot are in place before a reader can find its record id
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.stamps[slot] = stamp
+            self.record_ids[slot] = record_id
+        else:
+            slot = len(self.record_ids)
+            self.stamps.append(stamp)
+            for column in self.columns.values():
+                column.append(MISSING)
+            self.record_ids.append(record_id)
+        self.slots[record_id] = slot
+        return slot
+
+    def __materialize(self, slot):
+        content = {}
+        for field, column in self.columns.items():
+            value = column[slot]
+            if value is not MISSING:
+                content[field] = value
+        return content
+
+    def __track_version(self, record_id, slot, content, deleted, removed, ghosts):
+        # Old index values of the record stay found through the ghosts, a deleted record through its slot
+        if deleted:
+            removed.setdefault(slot, set()).add(record_id)
+        for field, index in list(self.indexes.items()):
+            ghost = ghosts.get(field)
+            if ghost is None:
+                ghost = ghosts[field] = index.empty_copy()
+            ghost.register_indexed_record_id(index.record_value(content.get), record_id)
+
+    def __keep_version(self, record_id, slot, content, stamp, deleted=False):
+        """ Content a write stamped stamp replaces, kept for the snapshots taken before """
+        with self.versions_lock:
+            self.versions.setdefault(record_id, []).append((self.stamps[slot], stamp, slot, content))
+            self.__track_version(record_id, slot, content, deleted, self.removed, self.ghosts)
+
+    def add_record(self, content, record=None, record_id=None):
         if not record:
-            record = Record(content)
+            record = Record(content, record_id)
         else:
             content["created_at"] = record.content["created_at"]
             record.content = content
@@ -72,69 +407,643 @@ class TableStore(object):
         for i, o in self.indexes.items():
             if not isinstance(o, IndexStore):
                 continue
-            if not o.validate_uniqueness(content[i], record.id):
+            if not o.validate_uniqueness(o.record_value(content.get), record.id):
                 return None
 
-        self.records[record.id] = record
-        for i, o in self.indexes.items():
-            if not isinstance(o, IndexStore):
-                continue
-            o.register_indexed_record_id(content[i], record.id)
+        old = None
+        slot = self.slots.get(record.id)
+        stamp, keep = self.clock.begin_write()
+        try:
+            if slot is None:
+                slot = self.__allocate_slot(record.id, stamp)
+            else:
+                if self.listeners or keep:
+                    old = self.__materialize(slot)
+                if keep:
+                    self.__keep_version(record.id, slot, old, stamp)
+                self.stamps[slot] = stamp
+                # Update in place, drop the index entries of the old values first
+                old_field = partial(self.get_field, record.id)
+                for i, o in self.indexes.items():
+                    if not isinstance(o, IndexStore):
+                        continue
+                    o.del_indexed_record_id(o.record_value(old_field), record.id)
+
+            self.__write_slot(slot, content)
+            for i, o in self.indexes.items():
+                if not isinstance(o, IndexStore):
+                    continue
+                o.register_indexed_record_id(o.record_value(content.get), record.id)
+        finally:
+            self.clock.end_write(stamp)
+        if self.listeners:
+            self.__notify(record.id, old, content)
         return record
 
     def del_record(self, record_id):
-        if record_id not in self.records:
+        slot = self.slots.get(record_id)
+        if slot is None:
             return
-        for i, o in self.indexes.items():
-            if not isinstance(o, IndexStore):
-                continue
-            o.del_indexed_record_id(self.records[record_id].content[i], record_id)
+        stamp, keep = self.clock.begin_write()
+        try:
+            old = self.__materialize(slot) if self.listeners or keep else None
+            if keep:
+                self.__keep_version(record_id, slot, old, stamp, deleted=True)
+            self.stamps[slot] = stamp
+            old_field = partial(self.get_field, record_id)
+            for i, o in self.indexes.items():
+                if not isinstance(o, IndexStore):
+                    continue
+                o.del_indexed_record_id(o.record_value(old_field), record_id)
+
+            for column in self.columns.values():
+                column[slot] = MISSING
+            self.record_ids[slot] = None
+            self.free_slots.append(slot)
+            del self.slots[record_id]
+        finally:
+            self.clock.end_write(stamp)
+        if self.listeners:
+            self.__notify(record_id, old, None)
 
-        del self.records[record_id]
+    def restore_record(self, record_id, content):
+        # Used while replaying durable state, record keeps the id it was acknowledged with
+        if record_id in self.slots:
+            self.del_record(record_id)
+        return self.add_record(content, record_id=record_id)
+
+    def update_fields(self, record_id, fields):
+        slot = self.slots.get(record_id)
+        if slot is None:
+            return None
+        content = self.__materialize(slot)
+        content.update(fields)
+        return self.add_record(content, Record(content, record_id))
+
+    def get_field(self, record_id, field):
+        slot = self.slots.get(record_id)
+        if slot is None or field not in self.columns:
+            return None
+        value = self.columns[field][slot]
+        return None if value is MISSING else value
 
     def get_record(self, record_id):
-        return self.records.get(record_id)
+        slot = self.slots.get(record_id)
+        if slot is None:
+            return None
+        return Record(self.__materialize(slot), record_id)
+
+    def iter_records(self):
+        for slot, record_id in enumerate(self.record_ids):
+            if record_id is None:
+                continue
+            yield Record(self.__materialize(slot), record_id)
 
     def get_records(self):
-        return self.records
+        return {r.id: r for r in self.iter_records()}
+
+    def record_count(self):
+        return len(self.slots)
+
+    def get_slot(self, record_id):
+        return self.slots.get(record_id)
+
+    def iter_slots(self, start=0):
+        """ (slot, record id) of every record from slot start on, in slot order """
+        for slot in range(start, len(self.record_ids)):
+            record_id = self.record_ids[slot]
+            if record_id is not None:
+                yield slot, record_id
+
+    def iter_field(self, field):
+        """ (record id, value) of every record, read straight from the column """
+        column = self.columns.get(field)
+        for slot, record_id in enumerate(self.record_ids):
+            if record_id is None:
+                continue
+            value = column[slot] if column is not None else MISSING
+            yield record_id, None if value is MISSING else value
+
+    def view(self, at):
+        return TableView(self, at)
+
+    def __version_at(self, record_id, at):
+        for valid_from, valid_to, slot, content in tuple(self.versions.get(record_id, ())):
+            if valid_from <= at < valid_to:
+                return slot, content
+        return None, None
+
+    def content_at(self, record_id, at):
+        """ Content of a record as of snapshot stamp at, None when it did not exist then """
+        slot = self.slots.get(record_id)
+        if slot is not None:
+            stamp = self.stamps[slot]
+            if stamp <= at:
+                content = self.__materialize(slot)
+                # A write of the slot started meanwhile has kept the content it replaced
+                if self.stamps[slot] == stamp:
+                    return content
+        return self.__version_at(record_id, at)[1]
+
+    def field_at(self, record_id, field, at):
+        """ Value of a field as of snapshot stamp at, MISSING when the record did not exist then """
+        slot = self.slots.get(record_id)
+        if slot is not None:
+            stamp = self.stamps[slot]
+            if stamp <= at:
+                column = self.columns.get(field)
+                value = column[slot] if column is not None else MISSING
+                if self.stamps[slot] == stamp:
+                    return None if value is MISSING else value
+        content = self.__version_at(record_id, at)[1]
+        return MISSING if content is None else content.get(field)
+
+    def changed_since(self, record_ids, at):
+        """ Those of record_ids written or deleted after snapshot stamp at. Writers stamp a slot
+            before they touch the indexes, index entries of the other ones are as of at.
+        """
+        slots, stamps, changed = self.slots, self.stamps, set()
+        for record_id in record_ids:
+            slot = slots.get(record_id)
+            if slot is None or stamps[slot] > at:
+                changed.add(record_id)
+        return changed
+
+    def slot_at(self, record_id, at):
+        slot = self.slots.get(record_id)
+        if slot is not None and self.stamps[slot] <= at:
+            return slot
+        return self.__version_at(record_id, at)[0]
+
+    def iter_slots_at(self, at, start=0):
+        """ (slot, record id) of every record existing at snapshot stamp at, from slot start on """
+        for slot in range(start, len(self.record_ids)):
+            record_id = self.record_ids[slot]
+            if record_id is not None and self.stamps[slot] <= at:
+                yield slot, record_id
+                continue
+            # Record of the slot was written since at, or the one it had then is deleted
+            for candidate in sorted({record_id, *self.removed.get(slot, ())} - {None}):
+                if self.__version_at(candidate, at)[1] is not None:
+                    yield slot, candidate
+                    break
+
+    def collect_versions(self, active):
+        """ Drops the versions no snapshot at the stamps of active (sorted) can read, returns how many """
+        if not self.versions:
+            return 0
+        dropped = 0
+        with self.versions_lock:
+            versions, removed, ghosts = {}, {}, {}
+            for record_id, kept in self.versions.items():
+                needed = [v for v in kept if readable(v[0], v[1], active)]
+                dropped += len(kept) - len(needed)
+                if not needed:
+                    continue
+                versions[record_id] = needed
+                for _, _, slot, content in needed:
+                    self.__track_version(record_id, slot, content, self.slots.get(record_id) != slot,
+                                         removed, ghosts)
+            # Replaced as a whole, views may be reading the current ones
+            self.versions, self.removed, self.ghosts = versions, removed, ghosts
+        return dropped
+
+    def version_count(self):
+        return sum(len(kept) for kept in list(self.versions.values()))
+
+
+class TableView(object):
+    """ Read only view of a TableStore as of snapshot stamp at, offering the read methods the
+        planners use. It may be read while a writer changes the table on another thread.
+    """
+
+    def __init__(self, table, at):
+        self.table = table
+        self.at = at
+        self.name = table.name
+
+    def get_indexed(self, index_name):
+        index = self.table.get_indexed(index_name)
+        return SnapshotIndex(self, index) if index else None
+
+    def composite_indexes(self):
+        return [SnapshotIndex(self, index) for index in self.table.composite_indexes()]
+
+    def record_count(self):
+        return self.table.record_count()
+
+    def get_field(self, record_id, field):
+        value = self.table.field_at(record_id, field, self.at)
+        return None if value is MISSING else value
+
+    def get_record(self, record_id):
+        content = self.table.content_at(record_id, self.at)
+        return Record(content, record_id) if content is not None else None
+
+    def iter_records(self):
+        for _, record_id in self.iter_slots():
+            record = self.get_record(record_id)
+            if record:
+                yield record
+
+    def get_slot(self, record_id):
+        return self.table.slot_at(record_id, self.at)
+
+    def iter_slots(self, start=0):
+        return self.table.iter_slots_at(self.at, start)
+
+    def iter_field(self, field):
+        for _, record_id in self.iter_slots():
+            value = self.table.field_at(record_id, field, self.at)
+            if value is not MISSING:
+                yield record_id, value
+
+
+class SnapshotIndex(object):
+    """ Index of a TableView. Record ids are collected from the index, then from its ghost
+        holding the values replaced while snapshots were open, and kept when their value
+        as of the snapshot matches. Index is read before ghost, as writers fill the ghost
+        before they drop an index entry.
+    """
+
+    def __init__(self, view, index):
+        self.view = view
+        self.index = index
+        self.name = index.name
+        self.fields = index.fields
+        self.is_unique = index.is_unique
+        self.kind = index.kind
+        self.keys = None
+
+    def distinct_count(self):
+        return self.index.distinct_count()
+
+    def average_rows(self):
+        return self.index.average_rows()
+
+    def estimate_rows(self, value):
+        return self.index.estimate_rows(value)
+
+    def __value(self, record_id):
+        return self.index.record_value(partial(self.view.table.field_at, record_id, at=self.view.at))
+
+    def __ghost(self):
+        return self.view.table.ghosts.get(self.name)
+
+    def __sorted_keys(self):
+        if self.keys is None:
+            self.keys = self.index.copy_keys()
+        return self.keys
+
+    def estimate_range_rows(self, condition):
+        start, end = key_range(self.__sorted_keys(), condition)
+        return round((end - start) * self.index.average_rows())
+
+    def __as_of_snapshot(self, record_ids, ghost_ids, match):
+        # Only records changed since the snapshot, or found by the ghost, need their value checked
+        suspects = self.view.table.changed_since(record_ids, self.view.at)
+        suspects.update(ghost_ids)
+        record_ids -= suspects
+        record_ids.update(_id for _id in suspects if self.__matches(_id, match))
+        return record_ids
+
+    def __matches(self, record_id, match):
+        value = self.__value(record_id)
+        return value is not MISSING and match(value)
+
+    def get_indexed_record_ids(self, value):
+        record_ids = set(self.index.get_indexed_record_ids(value) or ())
+        ghost = self.__ghost()
+        ghost_ids = ghost.get_indexed_record_ids(value) or () if ghost else ()
+        return self.__as_of_snapshot(record_ids, ghost_ids, lambda v: matches(v, value))
+
+    def get_range_record_ids(self, condition):
+        record_ids = self.index.range_record_ids(self.__sorted_keys(), condition)
+        ghost = self.__ghost()
+        ghost_ids = ghost.range_record_ids(ghost.copy_keys(), condition) if ghost else ()
+        return self.__as_of_snapshot(record_ids, ghost_ids, lambda v: matches(v, condition))
+
+    def prefix_conditions(self, filters):
+        return self.index.prefix_conditions(filters)
+
+    def estimate_prefix_rows(self, conditions):
+        return self.index.estimate_prefix_rows(conditions, self.__sorted_keys)
+
+    def prefix_record_ids(self, conditions):
+        record_ids = self.index.prefix_record_ids(conditions, self.__sorted_keys)
+        ghost = self.__ghost()
+        ghost_ids = ghost.prefix_record_ids(conditions, ghost.copy_keys) if ghost else ()
+        return self.__as_of_snapshot(record_ids, ghost_ids, lambda v: self.index.matches_prefix(v, conditions))
+
+    def iter_ordered(self, after=None):
+        """ As OrderedIndexStore.iter_ordered, records are placed by their value as of the snapshot """
+        keys = set(self.__sorted_keys())
+        ghost = self.__ghost()
+        if ghost:
+            keys.update(ghost.copy_keys())
+        keys = sorted(keys)
+        start = bisect_left(keys, after[0]) if after else 0
+        for key in keys[start:]:
+            record_ids = self.index.key_record_ids(key)
+            ghost = self.__ghost()
+            suspects = self.view.table.changed_since(record_ids, self.view.at)
+            if ghost:
+                suspects.update(ghost.key_record_ids(key))
+            for record_id in sorted(record_ids | suspects):
+                if after and key == after[0] and record_id <= after[1]:
+                    continue
+                if record_id in suspects:
+                    value = self.__value(record_id)
+                    if value is MISSING or sort_key(value) != key:
+                        continue
+                yield key, record_id
 
 
 class IndexStore(object):
+    """ Hash index from field value to record ids. Unique indexes keep the
+        record id itself instead of a single element set. Entry count and
+        number of distinct values are the statistics used by query planner.
+    """
+
     def __init__(self, name, is_unique):
         self.name = name
+        self.fields = (name,)
         self.is_unique = is_unique
         self.indexed_values = {}
+        self.entry_count = 0
+
+    @property
+    def kind(self):
+        return self.is_unique
+
+    def record_value(self, get_field):
+        """ Value a record is indexed by, get_field(field) reads a field of the record """
+        return get_field(self.name)
+
+    def empty_copy(self):
+        """ Non-unique index of the same kind, e.g. the ghost of this one """
+        return IndexStore(self.name, False)
+
+    def distinct_count(self):
+        return len(self.indexed_values)
+
+    def average_rows(self):
+        return self.entry_count / len(self.indexed_values) if self.indexed_values else 0
+
+    def estimate_rows(self, value):
+        if self.is_unique:
+            return 1 if value in self.indexed_values else 0
+        return len(self.indexed_values.get(value, ()))
 
     def validate_uniqueness(self, value, record_id):
         if not self.is_unique:
             return True
-        record_ids = self.indexed_values.get(value)
-        if not record_ids or len(record_ids - {record_id}) == 0:
-            return True
-        return False
+        indexed_id = self.indexed_values.get(value)
+        return indexed_id is None or indexed_id == record_id
 
     def register_indexed_record_id(self, value, record_id):
+        if self.is_unique:
+            if self.indexed_values.get(value) != record_id:
+                self.entry_count += 1
+            self.indexed_values[value] = record_id
+            return
         if not self.indexed_values.get(value):
             self.indexed_values[value] = set()
         if record_id in self.indexed_values[value]:
             return
         self.indexed_values[value].add(record_id)
+        self.entry_count += 1
 
     def get_indexed_record_ids(self, value):
+        if self.is_unique:
+            indexed_id = self.indexed_values.get(value)
+            return {indexed_id} if indexed_id is not None else None
         return self.indexed_values.get(value)
 
     def del_indexed_record_id(self, value, record_id):
+        if self.is_unique:
+            if self.indexed_values.get(value) == record_id:
+                del self.indexed_values[value]
+                self.entry_count -= 1
+            return
         if not self.indexed_values.get(value) or \
                 record_id not in self.indexed_values[value]:
             return
         self.indexed_values[value].remove(record_id)
+        self.entry_count -= 1
+        if not self.indexed_values[value]:
+            del self.indexed_values[value]
+
+
+class OrderedIndexStore(IndexStore):
+    """ Hash index which also keeps the distinct values sorted, to serve
+        range filters by bisecting instead of scanning the table. While keys
+        are deferred (bulk loads) new ones are collected and sorted in at once
+        by merge_keys, a range lookup meanwhile merges them first.
+    """
+
+    def __init__(self, name, is_unique):
+        super().__init__(name, is_unique)
+        self.sorted_keys = []
+        self.key_values = {}
+        self.pending_keys = None
+
+    @property
+    def kind(self):
+        return INDEX_ORDERED_UNIQUE if self.is_unique else INDEX_ORDERED
+
+    def empty_copy(self):
+        return OrderedIndexStore(self.name, False)
+
+    def key_of(self, value):
+        return sort_key(value)
+
+    def register_indexed_record_id(self, value, record_id):
+        super().register_indexed_record_id(value, record_id)
+        key = self.key_of(value)
+        if key not in self.key_values:
+            if self.pending_keys is None:
+                insort(self.sorted_keys, key)
+            else:
+                self.pending_keys.add(key)
+            self.key_values[key] = set()
+        self.key_values[key].add(value)
+
+    def del_indexed_record_id(self, value, record_id):
+        super().del_indexed_record_id(value, record_id)
+        if value in self.indexed_values:
+            return
+        key = self.key_of(value)
+        values = self.key_values.get(key)
+        if not values or value not in values:
+            return
+        values.remove(value)
+        if not values:
+            del self.key_values[key]
+            if self.pending_keys and key in self.pending_keys:
+                self.pending_keys.remove(key)
+            else:
+                del self.sorted_keys[bisect_left(self.sorted_keys, key)]
+
+    def defer_keys(self):
+        if self.pending_keys is None:
+            self.pending_keys = set()
+
+    def merge_keys(self, keep_deferring=False):
+        if self.pending_keys:
+            # Two sorted runs, timsort merges them in linear time
+            self.sorted_keys = sorted(self.sorted_keys + sorted(self.pending_keys))
+        self.pending_keys = set() if keep_deferring else None
+
+    def copy_keys(self):
+        """ Sorted keys with the pending ones merged in, the index itself is left as it is. Safe
+            to call while another thread writes the index.
+        """
+        # Pending keys are read first, merge_keys replaces sorted keys before it drops them
+        pending = self.pending_keys
+        keys = list(self.sorted_keys)
+        if pending:
+            keys = sorted(set(keys).union(list(pending)))
+        return keys
+
+    def key_record_ids(self, key):
+        record_ids = set()
+        for value in tuple(self.key_values.get(key, ())):
+            record_ids.update(self.get_indexed_record_ids(value) or ())
+        return record_ids
+
+    def range_record_ids(self, keys, condition):
+        """ Record ids of the values within a range filter, keys are the sorted keys to bisect """
+        record_ids = set()
+        start, end = key_range(keys, condition)
+        for key in keys[start:end]:
+            record_ids.update(self.key_record_ids(key))
+        return record_ids
+
+    def merged_keys(self):
+        """ Sorted keys, pending ones are merged into the index first """
+        if self.pending_keys:
+            self.merge_keys(keep_deferring=True)
+        return self.sorted_keys
+
+    def estimate_range_rows(self, condition):
+        start, end = key_range(self.merged_keys(), condition)
+        return round((end - start) * self.average_rows())
+
+    def iter_ordered(self, after=None):
+        """ (sort key, record id) of every indexed record in index order, record ids
+            sharing a sort key are ordered among themselves. Iteration resumes past
+            the (sort key, record id) position given by after.
+        """
+        keys = self.merged_keys()
+        start = bisect_left(keys, after[0]) if after else 0
+        for key in keys[start:]:
+            for record_id in sorted(self.key_record_ids(key)):
+                if after and key == after[0] and record_id <= after[1]:
+                    continue
+                yield key, record_id
+
+    def get_range_record_ids(self, condition):
+        return self.range_record_ids(self.merged_keys(), condition)
+
+
+class CompositeIndexStore(OrderedIndexStore):
+    """ Index of a tuple of fields, a record is indexed by the tuple of its values and
+        uniqueness holds for the whole tuple. Keys are the tuples of the sort keys of
+        the values, sorted so that filters on a leading prefix of the fields are served
+        by bisecting: equalities, the last of them may be replaced by a range.
+    """
+
+    def __init__(self, name, fields, is_unique):
+        super().__init__(name, is_unique)
+        self.fields = tuple(fields)
+
+    @property
+    def kind(self):
+        return self.is_unique
+
+    def record_value(self, get_field):
+        value = tuple(get_field(field) for field in self.fields)
+        # A record missing as of a snapshot misses every field
+        return MISSING if MISSING in value else value
+
+    def empty_copy(self):
+        return CompositeIndexStore(self.name, self.fields, False)
+
+    def key_of(self, value):
+        return tuple(sort_key(v) for v in value)
+
+    def prefix_conditions(self, filters):
+        """ Conditions of filters on the leading fields, in their order, up to the first range.
+            Empty when the first field is not filtered.
+        """
+        conditions = []
+        for field in self.fields:
+            if field not in filters:
+                break
+            conditions.append(filters[field])
+            if isinstance(filters[field], dict):
+                break
+        return conditions
+
+    def __is_point(self, conditions):
+        return len(conditions) == len(self.fields) and not isinstance(conditions[-1], dict)
+
+    @staticmethod
+    def __key_range(keys, conditions):
+        equalities = conditions[:-1] if isinstance(conditions[-1], dict) else conditions
+        prefix = tuple(sort_key(c) for c in equalities)
+        start = bisect_left(keys, prefix)
+        end = bisect_left(keys, prefix + (KEY_ABOVE_ALL,), start)
+        if len(equalities) < len(conditions):
+            # Keys sharing the prefix are sorted by the value of the next field
+            low, high = key_range([key[len(prefix)] for key in keys[start:end]], conditions[-1])
+            start, end = start + low, start + high
+        return start, end
+
+    def estimate_prefix_rows(self, conditions, keys=None):
+        """ As prefix_record_ids, estimated from the number of keys in the prefix """
+        if self.__is_point(conditions):
+            return self.estimate_rows(tuple(conditions))
+        start, end = self.__key_range((keys or self.merged_keys)(), conditions)
+        return round((end - start) * self.average_rows())
+
+    def prefix_record_ids(self, conditions, keys=None):
+        """ Record ids matching conditions of prefix_conditions, keys() are the sorted keys to
+            bisect (merged keys of the index by default), a lookup of every field skips them.
+        """
+        if self.__is_point(conditions):
+            return set(self.get_indexed_record_ids(tuple(conditions)) or ())
+        keys = (keys or self.merged_keys)()
+        start, end = self.__key_range(keys, conditions)
+        record_ids = set()
+        for key in keys[start:end]:
+            for value in tuple(self.key_values.get(key, ())):
+                # Values sharing a sort key may differ, 2020 and "2020"
+                if self.matches_prefix(value, conditions):
+                    record_ids.update(self.get_indexed_record_ids(value) or ())
+        return record_ids
+
+    @staticmethod
+    def matches_prefix(value, conditions):
+        return all(matches(v, c) for v, c in zip(value, conditions))
+
+
+def readable(valid_from, valid_to, active):
+    """ Whether a version valid from / to stamps is seen by a snapshot at one of the sorted stamps active """
+    i = bisect_left(active, valid_from)
+    return i < len(active) and active[i] < valid_to
 
 
 class Record(object):
     """ Represent a physical record of an entity
         having unique system generated id
     """
+    __slots__ = ("id", "content")
 
-    def __init__(self, content):
-        self.id = str(uuid.uuid4())
+    def __init__(self, content, record_id=None):
+        self.id = record_id or str(uuid.uuid4())
         self.content = content
+
+    def as_dict(self):
+        return {"id": self.id, "content": self.content}
@@ -1,22 +1,64 @@
 import asyncio
+import itertools
 import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 
-from db_store import MAX_TASK_QUEUE_SIZE, TABLE_NOT_FOUND, DEFAULT_UUID_LEN, \
+from db_store import TABLE_NOT_FOUND, DEFAULT_UUID_LEN, \
     ENTITY_NOT_FOUND, DUPLICATE_ENTITY_FOUND, DB_OPERATION_CREATE_ENTITY, \
     DB_OPERATION_ENTITY_SAVE, \
-    DB_OPERATION_ENTITY_GET, DB_OPERATION_ENTITY_DEL, UNSUPPORTED_DB_OPERATION
+    DB_OPERATION_ENTITY_GET, DB_OPERATION_ENTITY_DEL, UNSUPPORTED_DB_OPERATION, \
+    DB_OPERATION_ENTITY_MULTI_SAVE, DB_OPERATION_ENTITY_MULTI_GET, DB_OPERATION_ENTITY_MULTI_DEL, \
+    DB_OPERATION_ENTITY_AVAILABLE, AVAILABILITY_NOT_TRACKED, DB_OPERATION_ENTITY_EXPLAIN, \
+    DB_OPERATION_ENTITY_JOIN, DB_OPERATION_ENTITY_SCAN, DB_OPERATION_ENTITY_SAVE_IF, CONDITION_FAILED, \
+    VERSION_MISMATCH, RECORD_VERSION_FIELD, INDEX_NOT_ORDERED, INVALID_SCAN_REQUEST, DEFAULT_PAGE_SIZE, \
+    WAL_OP_CREATE_TABLE, WAL_OP_SAVE_RECORD, WAL_OP_DEL_RECORD, RESULT_FORMAT_NATIVE, RECORD_STATE_FIELD, \
+    WORKER_MODE_ASYNC, WORKER_MODE_THREAD, INVALID_DB_REQUEST, DB_OPERATION_STATS, TRACE_STAGE_SUBMITTED, \
+    TRACE_STAGE_STARTED, TRACE_STAGE_LOCKED, TRACE_STAGE_EXECUTED, TRACE_STAGE_HANDLED, \
+    TRACE_STAGE_DURABLE, TRACE_STAGE_REPLIED, DB_OPERATION_ENTITY_BULK_LOAD, MVCC_GC_INTERVAL, INDEX_ORDERED, \
+    INDEX_ORDERED_UNIQUE
+from db_store.codec import encode_result
 from db_store.datastore import DBStore
+from db_store.expiry import ExpiryScheduler
+from db_store.locks import LockManager
+from db_store.metrics import Metrics
+from db_store import tracing
+from db_store.planner import QueryPlan, JoinPlan, ScanPlan
+from db_store.timestamps import to_epoch
+from db_store.wal import WriteAheadLog
 
 logger = None
 
 
 class DBAccessReq(object):
-    def __init__(self, entity_name, op, data, fut):
+    def __init__(self, entity_name, op, data, fut, trace_id=None, timeout=None):
         self.entity_name = entity_name
         self.op = op
         self.op_data = data
         self.result = fut
+        # Latency recorded by db server covers the wait in its queues
+        self.submitted_at = time.perf_counter()
+        # Requests sent on behalf of another one (by a remote client, to shards) keep its trace id
+        self.trace_id = trace_id or tracing.new_trace_id()
+        self.stages = [(TRACE_STAGE_SUBMITTED, self.submitted_at)]
+        # Seconds the request may wait for a worker, db server applies the default of its lane when not given
+        self.deadline = self.submitted_at + timeout if timeout is not None else None
+
+    def trace(self, stage):
+        # A stage passed once per item of a batch is kept with the time it was passed last
+        if self.stages[-1][0] == stage:
+            self.stages[-1] = (stage, time.perf_counter())
+        else:
+            self.stages.append((stage, time.perf_counter()))
+
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.perf_counter()
+
+    def expired(self):
+        return self.deadline is not None and time.perf_counter() >= self.deadline
 
 
 class DBAccessResp(object):
@@ -25,25 +67,166 @@ class DBAccessResp(object):
         self.result = result
 
 
+class TableVersions(object):
+    """ Write version of every table, bumped by db server on each mutation. Clients sharing
+        the process read it to tell whether a result read earlier is still current.
+    """
+
+    def __init__(self):
+        self.versions = {}
+        self.clock = itertools.count(1)
+
+    def bump(self, table_name):
+        self.versions[table_name] = next(self.clock)
+
+    def get(self, *table_names):
+        return tuple(self.versions.get(t, 0) for t in table_names)
+
+
 class DBStoreWorkers(object):
-    def __init__(self, name, req_queue):
+    """ Serves db access requests by a pool of workers. In async mode workers are tasks
+        of the event loop, running one operation at a time. In thread mode operations run
+        on a thread pool in parallel, writes guarded by the striped locks of LockManager
+        and reads run on snapshots of the tables, neither holding up the other.
+        Workers take requests from req_queue, a db_store.scheduler.RequestScheduler.
+    """
+
+    def __init__(self, name, req_queue, data_dir=None, result_format=RESULT_FORMAT_NATIVE,
+                 worker_mode=WORKER_MODE_ASYNC):
         self.name = name
         self.req_queue = req_queue
         self.db = DBStore(name)
         self.worker_count = None
-        self.task_queue_size = MAX_TASK_QUEUE_SIZE
         self.workers = {}
+        self.wal = WriteAheadLog(data_dir) if data_dir else None
+        self.result_format = result_format
+        self.versions = TableVersions()
+        self.worker_mode = worker_mode
+        self.executor = None
+        self.metrics = Metrics()
+        self.locks = LockManager(self.db) if worker_mode == WORKER_MODE_THREAD else None
+        # lsn of the last wal entry written by, and the request of the operation running on this thread
+        self.op_lsn = threading.local()
+        self.op_req = threading.local()
+        self.expiry = ExpiryScheduler(self.db, self.__on_record_expired, self.locks)
+        self.handlers = {
+            DB_OPERATION_CREATE_ENTITY: self.__add_table,
+            DB_OPERATION_ENTITY_SAVE: self.__add_update_object,
+            DB_OPERATION_ENTITY_SAVE_IF: self.__conditional_add_update_object,
+            DB_OPERATION_ENTITY_GET: self.__get_one_or_more_object,
+            DB_OPERATION_ENTITY_DEL: self.__del_one_object,
+            DB_OPERATION_ENTITY_SCAN: self.__scan_objects,
+            DB_OPERATION_ENTITY_JOIN: self.__join_objects,
+            DB_OPERATION_ENTITY_EXPLAIN: self.__explain_query,
+            DB_OPERATION_ENTITY_AVAILABLE: self.__get_available_objects,
+            DB_OPERATION_STATS: self.__get_stats,
+            DB_OPERATION_ENTITY_BULK_LOAD: self.__bulk_load_objects,
+        }
+        # Batches are executed item by item, every item locked on its own
+        self.batch_ops = {
+            DB_OPERATION_ENTITY_MULTI_SAVE: DB_OPERATION_ENTITY_SAVE,
+            DB_OPERATION_ENTITY_MULTI_GET: DB_OPERATION_ENTITY_GET,
+            DB_OPERATION_ENTITY_MULTI_DEL: DB_OPERATION_ENTITY_DEL,
+        }
+
+    def __log(self, entry):
+        # Every mutation is logged after it is applied, readers caching the table see a new version
+        self.versions.bump(entry["table"])
+        if self.wal:
+            self.op_lsn.value = self.wal.log(entry)
+
+    def __trace(self, stage):
+        req = getattr(self.op_req, "value", None)
+        if req:
+            req.trace(stage)
+
+    def __encode(self, records):
+        # Store and index work of the request is done, what remains is encoding its result
+        self.__trace(TRACE_STAGE_EXECUTED)
+        return encode_result(records, self.result_format)
 
     @staticmethod
     def __db_error_message(code, value):
         return json.dumps({"_error": code.format(value)})
 
-    def __add_table(self, table_name, indexes):
-        if self.db.get_table(table_name):
+    @staticmethod
+    def __db_conflict_message(code, value, record):
+        # Conflicting record is returned along, client can explain the failure without another request
+        return json.dumps({"_error": code.format(value), "conflict": record.as_dict()})
+
+    @contextmanager
+    def __read_views(self, *tables):
+        """ The tables as of one point in time, for the duration of a read. Async workers run a
+            read within one task step, nothing changes under it, so they read the tables as they are.
+        """
+        if not self.locks:
+            yield tables
+            return
+        with self.db.snapshot() as at:
+            yield [table.view(at) for table in tables]
+
+    def __on_record_expired(self, table, record):
+        self.__log({"op": WAL_OP_SAVE_RECORD, "table": table.name, "id": record.id, "content": record.content})
+
+    def __migrate_timestamps(self, table, fields):
+        """ Timestamps of records saved as TIMESTAMP_FORMAT strings are rewritten as epoch seconds """
+        migrated = 0
+        for field in fields or ():
+            legacy = [(record_id, value) for record_id, value in table.iter_field(field) if isinstance(value, str)]
+            for record_id, value in legacy:
+                epoch = to_epoch(value)
+                if epoch is None:
+                    continue
+                record = table.update_fields(record_id, {field: epoch})
+                if not record:
+                    continue
+                self.__log({"op": WAL_OP_SAVE_RECORD, "table": table.name, "id": record.id,
+                            "content": record.content})
+                migrated += 1
+        if migrated:
+            logger.info(f"Migrated {migrated} timestamps of table:{table.name} to epoch seconds")
+
+    def __add_table(self, table_name, table_spec):
+        table_spec = table_spec or {}
+        restored = self.db.get_table(table_name)
+        if restored:
+            # Table restored from durable state may hold records of an older format
+            self.__migrate_timestamps(restored, table_spec.get("timestamps"))
+        # Indexes declared since a restored table was created are built from its records
+        added = self.db.register_table(table_name, table_spec.get("indexes"), table_spec.get("expires_on"),
+                                       table_spec.get("availability"))
+        if restored and not added:
             return True, None
-        self.db.register_table(table_name, indexes)
+        if restored:
+            logger.info(f"Added indexes {added} to table:{table_name}")
+        table = self.db.get_table(table_name)
+        self.__log({"op": WAL_OP_CREATE_TABLE, "table": table_name, "expires_on": table.expires_on,
+                    "availability": table_spec.get("availability"),
+                    "indexes": {i: o.kind for i, o in table.indexes.items()}})
         return True, None
 
+    def __get_stats(self, table_name, _):
+        """ Metrics of this server, along with size and index fan-out of its tables """
+        stats = self.metrics.as_dict(table_name)
+        # Async workers share the thread of the event loop, thread workers run in parallel
+        capacity = stats["uptime_sec"] * (self.worker_count if self.executor else 1)
+        tables = {}
+        for name, table in list(self.db.get_tables().items()):
+            if table_name and name != table_name:
+                continue
+            tables[name] = {"records": table.record_count(),
+                            "indexes": {field: {"kind": index.kind, "distinct": index.distinct_count(),
+                                                "avg_rows": round(index.average_rows(), 2)}
+                                        for field, index in list(table.indexes.items())}}
+        snapshots = dict(self.db.clock.stats(),
+                         versions=sum(table.version_count() for table in list(self.db.get_tables().values())))
+        stats.update({"server": self.name, "worker_mode": self.worker_mode, "workers": self.worker_count,
+                      "utilization": round(self.metrics.busy / capacity, 4) if capacity else 0,
+                      "queues": self.req_queue.stats(),
+                      "snapshots": snapshots,
+                      "tables": tables})
+        return True, stats
+
     def __add_update_object(self, table_name, content):
         table = self.db.get_table(table_name)
         if not table:
@@ -55,43 +238,147 @@ class DBStoreWorkers(object):
             if not record:
                 return False, self.__db_error_message(ENTITY_NOT_FOUND, content["id"])
 
+        if table.expires_on:
+            content[RECORD_STATE_FIELD] = self.expiry.initial_state(table, content)
+        content[RECORD_VERSION_FIELD] = record.content.get(RECORD_VERSION_FIELD, 0) + 1 if record else 1
+
         record = table.add_record(content, record)
         if not record:
             return False, self.__db_error_message(DUPLICATE_ENTITY_FOUND, table_name)
 
-        return True, json.dumps(record.__dict__)
+        if table.expires_on:
+            self.expiry.schedule(table, record)
+
+        self.__log({"op": WAL_OP_SAVE_RECORD, "table": table_name, "id": record.id, "content": record.content})
+        return True, self.__encode([record])
+
+    def __conditional_add_update_object(self, table_name, save):
+        """ Save applied only when no other record matches none_match filters and, for an
+            update, the stored version is the expected one. Check and save run within one
+            task step, or under the write locks of the record in thread mode, so no other
+            request can interleave.
+        """
+        table = self.db.get_table(table_name)
+        if not table:
+            return False, self.__db_error_message(TABLE_NOT_FOUND, table_name)
+
+        content = save["content"]
+        _id = content.get("id")
+        if save.get("version") is not None:
+            current = table.get_record(_id) if _id else None
+            if not current:
+                return False, self.__db_error_message(ENTITY_NOT_FOUND, _id)
+            if current.content.get(RECORD_VERSION_FIELD, 0) != save["version"]:
+                return False, self.__db_conflict_message(VERSION_MISMATCH, _id, current)
+
+        for conflict_id in QueryPlan(table, save["none_match"]).execute() if save.get("none_match") else ():
+            if conflict_id != _id:
+                return False, self.__db_conflict_message(CONDITION_FAILED, table_name, table.get_record(conflict_id))
+
+        return self.__add_update_object(table_name, content)
+
+    def __bulk_load_objects(self, table_name, saves):
+        """ Conditional saves of a batch, applied in order under one lock of the table. Keys new
+            to ordered indexes are sorted in once for the batch, result holds status of every save.
+        """
+        table = self.db.get_table(table_name)
+        if not table:
+            return False, self.__db_error_message(TABLE_NOT_FOUND, table_name)
+        with table.bulk_indexing():
+            return True, [self.__conditional_add_update_object(table_name, save) for save in saves or []]
 
     def __get_one_or_more_object(self, table_name, filters):
         table = self.db.get_table(table_name)
         if not table:
             return False, self.__db_error_message(TABLE_NOT_FOUND, table_name)
-        record_ids = set()
-        records = []
+        with self.__read_views(table) as (view,):
+            if not filters:
+                return True, self.__encode(view.iter_records())
 
-        if not filters:
-            records = [json.dumps(r.__dict__) for r in list(table.get_records().values())]
-            return True, records
+            records = []
+            for _id in QueryPlan(view, filters).execute():
+                r = view.get_record(_id)
+                if not r:
+                    return False, self.__db_error_message(ENTITY_NOT_FOUND, _id)
+                records.append(r)
 
-        for _f, v in filters.items():
-            indexed = table.get_indexed(_f)
-            if not indexed:
-                logger.debug(f'No indexed value found for attr={_f}, value={v}')
-                continue
+            return True, self.__encode(records)
 
-            ids = indexed.get_indexed_record_ids(v)
-            if not ids:
-                logger.error(f'Not object found for attr={_f}, value={v}')
-                continue
-            record_ids = record_ids.union(ids)
-            logger.debug(f'Found ids:{ids} for attr={_f}, value={v}')
+    def __scan_objects(self, table_name, scan):
+        table = self.db.get_table(table_name)
+        if not table:
+            return False, self.__db_error_message(TABLE_NOT_FOUND, table_name)
+        order_by = scan.get("order_by")
+        index = table.get_indexed(order_by) if order_by else None
+        if order_by and (not index or index.kind not in (INDEX_ORDERED, INDEX_ORDERED_UNIQUE)):
+            return False, self.__db_error_message(INDEX_NOT_ORDERED, order_by)
+
+        limit = scan.get("limit") or DEFAULT_PAGE_SIZE
+        # Cursor holds the lease of the snapshot every page is read from, and the position reached
+        cursor = scan.get("cursor")
+        lease, after = (cursor.get("snapshot"), cursor.get("after")) if isinstance(cursor, dict) else (None, cursor)
+        at = self.db.clock.renew(lease) if isinstance(lease, int) else None
+        if at is None:
+            if lease is not None:
+                logger.info(f"Snapshot lease:{lease} of a scan of {table_name} expired, scan goes on at a new one")
+            lease, at = self.db.clock.lease()
+
+        position = None
+        try:
+            if int(limit) <= 0:
+                raise ValueError(limit)
+            view = table.view(at)
+            record_ids, position = ScanPlan(view, scan.get("filters"), order_by).page(after, int(limit))
+            records = [view.get_record(_id) for _id in record_ids]
+            next_cursor = {"snapshot": lease, "after": position} if position is not None else None
+            return True, (self.__encode(records), next_cursor)
+        except (TypeError, ValueError, IndexError):
+            return False, self.__db_error_message(INVALID_SCAN_REQUEST, scan)
+        finally:
+            if position is None:
+                self.db.clock.end_lease(lease)
+
+    def __join_objects(self, table_name, join):
+        table = self.db.get_table(table_name)
+        if not table:
+            return False, self.__db_error_message(TABLE_NOT_FOUND, table_name)
+        related = self.db.get_table(join["related"])
+        if not related:
+            # Related entity was never written to, nothing can join with it
+            return True, self.__encode([])
+
+        with self.__read_views(table, related) as (view, related_view):
+            records = []
+            for _id in JoinPlan(view, related_view, join["join_key"], join.get("related_filters"),
+                                join.get("filters")).execute():
+                r = view.get_record(_id)
+                if not r:
+                    return False, self.__db_error_message(ENTITY_NOT_FOUND, _id)
+                records.append(r)
+
+            return True, self.__encode(records)
+
+    def __explain_query(self, table_name, filters):
+        table = self.db.get_table(table_name)
+        if not table:
+            return False, self.__db_error_message(TABLE_NOT_FOUND, table_name)
+        return True, QueryPlan(table, filters or {}).describe()
+
+    def __get_available_objects(self, table_name, group):
+        availability = self.db.get_availability(table_name)
+        if not availability:
+            return False, self.__db_error_message(AVAILABILITY_NOT_TRACKED, table_name)
+        resource = self.db.get_table(availability.resource)
+        if not resource:
+            return True, self.__encode([])
 
-        for _id in record_ids:
-            r = table.get_record(_id)
+        records = []
+        for _id in availability.get_available_record_ids(group):
+            r = resource.get_record(_id)
             if not r:
                 return False, self.__db_error_message(ENTITY_NOT_FOUND, _id)
-            records.append(json.dumps(r.__dict__))
-
-        return True, records
+            records.append(r)
+        return True, self.__encode(records)
 
     def __del_one_object(self, table_name, _id):
         table = self.db.get_table(table_name)
@@ -101,26 +388,103 @@ class DBStoreWorkers(object):
             return False, self.__db_error_message(ENTITY_NOT_FOUND, _id)
 
         table.del_record(_id)
+        self.__log({"op": WAL_OP_DEL_RECORD, "table": table_name, "id": _id})
 
         return True, None
 
-    async def __process_requests(self, task_queue):
+    def __multi_op(self, op, table_name, items):
+        # Whole batch is executed as a single task, result holds status of every item in order
+        if not self.db.get_table(table_name):
+            return False, self.__db_error_message(TABLE_NOT_FOUND, table_name)
+        return True, [self.__execute(op, table_name, item) for item in items or []]
+
+    def __lock(self, op, table_name, data):
+        if not self.locks or op == DB_OPERATION_STATS:
+            return nullcontext()
+        if op == DB_OPERATION_CREATE_ENTITY:
+            related = [a.tracker for a in self.db.availability.values() if a.resource == table_name]
+            if data and data.get("availability"):
+                related.append(data["availability"]["of"])
+            return self.locks.write_tables(table_name, *related)
+        if op in (DB_OPERATION_ENTITY_SAVE, DB_OPERATION_ENTITY_SAVE_IF, DB_OPERATION_ENTITY_DEL):
+            return self.locks.write_record(table_name)
+        if op == DB_OPERATION_ENTITY_BULK_LOAD:
+            # A batch holds the table on its own, rather than taking key locks of every record
+            return self.locks.write_tables(table_name)
+        if op in (DB_OPERATION_ENTITY_GET, DB_OPERATION_ENTITY_SCAN, DB_OPERATION_ENTITY_JOIN):
+            # Reads run on a snapshot, writers of the table go on meanwhile
+            return nullcontext()
+        if op == DB_OPERATION_ENTITY_AVAILABLE:
+            availability = self.db.get_availability(table_name)
+            return self.locks.read_tables(table_name, *([availability.resource] if availability else []))
+        return self.locks.read_tables(table_name)
+
+    def __execute(self, op, table_name, data):
+        if op in self.batch_ops:
+            return self.__multi_op(self.batch_ops[op], table_name, data)
+        handler = self.handlers.get(op)
+        if not handler:
+            return False, self.__db_error_message(UNSUPPORTED_DB_OPERATION, op)
+        with self.__lock(op, table_name, data):
+            if self.locks:
+                self.__trace(TRACE_STAGE_LOCKED)
+            return handler(table_name, data)
+
+    def __execute_task(self, task):
+        started = time.perf_counter()
+        task.trace(TRACE_STAGE_STARTED)
+        self.op_lsn.value = 0
+        self.op_req.value = task
+        try:
+            status, result = self.__execute(task.op, task.entity_name, task.op_data)
+        finally:
+            self.op_req.value = None
+        task.trace(TRACE_STAGE_HANDLED)
+        return status, result, self.op_lsn.value, time.perf_counter() - started
+
+    async def __process_requests(self):
+        loop = asyncio.get_running_loop()
         while True:
-            task = await task_queue.get()
+            # Scheduler picks the request, lane by lane, and answers the ones waiting past their deadline
+            task = await self.req_queue.get()
+            if not isinstance(task, DBAccessReq):
+                logger.error("Received invalid db access request")
+                continue
             logger.debug(f"Recieved TASK:{task.op}, {task.op_data}")
-            if task.op == DB_OPERATION_CREATE_ENTITY:
-                status, result = self.__add_table(task.entity_name, task.op_data)
-            elif task.op == DB_OPERATION_ENTITY_SAVE:
-                status, result = self.__add_update_object(task.entity_name, task.op_data)
-            elif task.op == DB_OPERATION_ENTITY_GET:
-                status, result = self.__get_one_or_more_object(task.entity_name, task.op_data)
-            elif task.op == DB_OPERATION_ENTITY_DEL:
-                status, result = self.__del_one_object(task.entity_name, task.op_data)
-            else:
-                status, result = False, self.__db_error_message(UNSUPPORTED_DB_OPERATION, task.op)
+            try:
+                if self.executor:
+                    status, result, lsn, busy = await loop.run_in_executor(self.executor, self.__execute_task, task)
+                else:
+                    status, result, lsn, busy = self.__execute_task(task)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                # Malformed op data (e.g. from a network client) must not take the worker down
+                logger.error(f"Failed TASK:{task.op} on {task.entity_name}, {e!r}")
+                status, result, busy = False, self.__db_error_message(INVALID_DB_REQUEST, task.op), 0.0
+                # Part of a batch may have been applied before, acknowledge only once it is durable
+                lsn = self.wal.last_lsn if self.wal else 0
 
+            # Acknowledge writes only once they are durable, fsync is shared with other queued writes
+            if lsn:
+                await self.wal.wait_durable(lsn)
+                task.trace(TRACE_STAGE_DURABLE)
+
+            task.trace(TRACE_STAGE_REPLIED)
+            self.metrics.record(task.op, task.entity_name, time.perf_counter() - task.submitted_at, busy, status)
+            tracing.slow_ops.check(task, status, result, self.name)
             logger.debug(f"Returning result to client")
             task.result.set_result(DBAccessResp(status, result))
+            if not self.executor:
+                # Taking the next request does not yield while requests are waiting, let the reply go out first
+                await asyncio.sleep(0)
+
+    async def __collect_versions(self):
+        while True:
+            await asyncio.sleep(MVCC_GC_INTERVAL)
+            expired, dropped = self.db.collect_versions()
+            if expired:
+                logger.info(f"Released {expired} snapshot(s) of scans idle past their lease")
+            if dropped:
+                logger.debug(f"Collected {dropped} record versions no snapshot reads anymore")
 
     async def run(self):
         try:
@@ -129,23 +493,35 @@ class DBStoreWorkers(object):
                 self.worker_count = 1
                 logger.warning("Invalid worker count is sent, falling back to 1 default worker")
 
-            task_queue = asyncio.Queue(maxsize=self.task_queue_size)
+            if self.wal:
+                self.wal.replay(self.db)
+                self.wal.open()
+                self.workers["wal_writer"] = asyncio.create_task(self.wal.run(self.db, self.locks))
+                logger.info(f"DB durability enabled with wal at:{self.wal.wal_path}")
+
+            self.expiry.rearm()
+            self.workers["expiry_scheduler"] = asyncio.create_task(self.expiry.run())
+            self.workers["version_collector"] = asyncio.create_task(self.__collect_versions())
+
+            if self.worker_mode == WORKER_MODE_THREAD:
+                self.executor = ThreadPoolExecutor(max_workers=self.worker_count, thread_name_prefix=self.name)
+                logger.info(f"DB workers run on a pool of {self.worker_count} threads")
+
+            # Workers take requests from req_queue (a RequestScheduler) themselves
+            processors = []
             for i in range(self.worker_count):
-                self.workers["workers_" + str(i)] = asyncio.create_task(self.__process_requests(task_queue))
+                processors.append(asyncio.create_task(self.__process_requests()))
+                self.workers["workers_" + str(i)] = processors[-1]
                 logger.info(f"DB worker:{i} is successfully started")
 
             self.req_queue.task_done()
-
-            while True:
-                db_req = await self.req_queue.get()
-                logger.debug(f"Receieved new db access request:{db_req}")
-                if not isinstance(db_req, DBAccessReq):
-                    logger.error("Received invalid db access request")
-                    continue
-
-                await task_queue.put(db_req)
+            await asyncio.gather(*processors)
         except asyncio.CancelledError:
             pass
         finally:
             for name, worker in self.workers.items():
                 worker.cancel()
+            if self.executor:
+                self.executor.shutdown(wait=False)
+            if self.wal:
+                self.wal.close()
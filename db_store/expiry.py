@@ -0,0 +1,97 @@
+import asyncio
+import heapq
+import threading
+import time
+from contextlib import nullcontext
+
+from db_store import RECORD_STATE_FIELD, RECORD_STATE_ACTIVE, RECORD_STATE_EXPIRED
+from db_store.timestamps import to_epoch
+
+logger = None
+
+
+class ExpiryScheduler(object):
+    """ Moves records of tables declared with an expiry attribute to expired
+        state once it is reached. Pending expiries are kept in a heap ordered
+        by expiry time, entries made stale by updates or deletes are skipped
+        when they surface.
+    """
+
+    def __init__(self, db, on_expired=None, locks=None):
+        self.db = db
+        self.on_expired = on_expired
+        self.locks = locks
+        self.heap = []
+        self.heap_lock = threading.Lock()
+        self.wakeup = None
+        self.loop = None
+
+    def initial_state(self, table, content):
+        expires_at = to_epoch(content.get(table.expires_on))
+        if expires_at is not None and expires_at <= time.time():
+            return RECORD_STATE_EXPIRED
+        return RECORD_STATE_ACTIVE
+
+    def schedule(self, table, record):
+        if record.content.get(RECORD_STATE_FIELD) != RECORD_STATE_ACTIVE:
+            return
+        expires_at = to_epoch(record.content.get(table.expires_on))
+        if expires_at is None:
+            return
+        with self.heap_lock:
+            heapq.heappush(self.heap, (expires_at, table.name, record.id))
+            earliest = self.heap[0][2] == record.id
+        if self.wakeup and earliest:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def rearm(self):
+        # Called on startup, state of replayed records is recomputed against current time
+        for table in self.db.get_tables().values():
+            if not table.expires_on:
+                continue
+            for record in list(table.iter_records()):
+                state = self.initial_state(table, record.content)
+                if record.content.get(RECORD_STATE_FIELD) != state:
+                    record = table.update_fields(record.id, {RECORD_STATE_FIELD: state})
+                self.schedule(table, record)
+
+    def __expire(self, expires_at, table_name, record_id):
+        table = self.db.get_table(table_name)
+        if not table or table.get_field(record_id, RECORD_STATE_FIELD) != RECORD_STATE_ACTIVE:
+            return
+        if to_epoch(table.get_field(record_id, table.expires_on)) != expires_at:
+            return
+
+        record = table.update_fields(record_id, {RECORD_STATE_FIELD: RECORD_STATE_EXPIRED})
+        logger.debug(f"Record:{record_id} of table:{table_name} expired")
+        if record and self.on_expired:
+            self.on_expired(table, record)
+
+    def __expire_all(self, due):
+        for expires_at, table_name, record_id in due:
+            lock = self.locks.write_record(table_name) if self.locks else nullcontext()
+            with lock:
+                self.__expire(expires_at, table_name, record_id)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            due = []
+            with self.heap_lock:
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap))
+            if due and self.locks:
+                # Expiry waits on the writer lock of the table like any writer, off the event loop
+                await self.loop.run_in_executor(None, self.__expire_all, due)
+            else:
+                self.__expire_all(due)
+
+            with self.heap_lock:
+                timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,96 @@
+import threading
+from contextlib import contextmanager, ExitStack
+
+from db_store import DEFAULT_LOCK_STRIPES
+
+# Lock modes, intention modes are taken on a table by operations locking single keys of it
+LOCK_INTENTION_SHARED = "IS"
+LOCK_INTENTION_EXCLUSIVE = "IX"
+LOCK_SHARED = "S"
+LOCK_EXCLUSIVE = "X"
+
+LOCK_COMPATIBILITY = {
+    LOCK_INTENTION_SHARED: {LOCK_INTENTION_SHARED, LOCK_INTENTION_EXCLUSIVE, LOCK_SHARED},
+    LOCK_INTENTION_EXCLUSIVE: {LOCK_INTENTION_SHARED, LOCK_INTENTION_EXCLUSIVE},
+    LOCK_SHARED: {LOCK_INTENTION_SHARED, LOCK_SHARED},
+    LOCK_EXCLUSIVE: set(),
+}
+
+
+class StripeLock(object):
+    """ Lock held in one of the modes above by any number of compatible holders """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.holders = {mode: 0 for mode in LOCK_COMPATIBILITY}
+
+    def __compatible(self, mode):
+        return all(not count or held in LOCK_COMPATIBILITY[mode] for held, count in self.holders.items())
+
+    def acquire(self, mode):
+        with self.cond:
+            self.cond.wait_for(lambda: self.__compatible(mode))
+            self.holders[mode] += 1
+
+    def release(self, mode):
+        with self.cond:
+            self.holders[mode] -= 1
+            self.cond.notify_all()
+
+
+class LockManager(object):
+    """ Striped locks guarding DBStore when worker pool runs on threads.
+        - record writes: table IX + table writer mutex
+        - availability lookups, wal snapshots: table S
+        - table creation, bulk loads: table X
+        Gets, scans and joins take no lock, they read a snapshot of the tables (DBStore.snapshot).
+        Locks are always taken in the order table stripes, writer mutexes, each in ascending
+        stripe order, so no two operations can wait on each other.
+    """
+
+    def __init__(self, db, stripes=DEFAULT_LOCK_STRIPES):
+        self.db = db
+        self.table_locks = [StripeLock() for _ in range(stripes)]
+        self.writer_locks = [threading.Lock() for _ in range(stripes)]
+        self.catalog_lock = threading.Lock()
+
+    @staticmethod
+    def __stripe(locks, *parts):
+        return hash(parts) % len(locks)
+
+    @staticmethod
+    def __acquire_all(stack, locks, stripes, mode):
+        for stripe in sorted(set(stripes)):
+            locks[stripe].acquire(mode)
+            stack.callback(locks[stripe].release, mode)
+
+    def __table_stripes(self, table_names):
+        return [self.__stripe(self.table_locks, t) for t in table_names]
+
+    @contextmanager
+    def read_tables(self, *table_names):
+        with ExitStack() as stack:
+            self.__acquire_all(stack, self.table_locks, self.__table_stripes(table_names), LOCK_SHARED)
+            yield
+
+    @contextmanager
+    def write_record(self, table_name):
+        # Writers of the table are serialized, stored content can not change under the check of a conditional save
+        with ExitStack() as stack:
+            stripe = self.__stripe(self.table_locks, table_name)
+            self.__acquire_all(stack, self.table_locks, [stripe], LOCK_INTENTION_EXCLUSIVE)
+            stack.enter_context(self.writer_locks[stripe])
+            yield
+
+    @contextmanager
+    def read_catalog(self):
+        """ Every table shared and no table created meanwhile, for a consistent snapshot """
+        with self.catalog_lock, self.read_tables(*self.db.get_tables()):
+            yield
+
+    @contextmanager
+    def write_tables(self, *table_names):
+        with ExitStack() as stack:
+            stack.enter_context(self.catalog_lock)
+            self.__acquire_all(stack, self.table_locks, self.__table_stripes(table_names), LOCK_EXCLUSIVE)
+            yield
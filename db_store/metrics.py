@@ -0,0 +1,110 @@
+import time
+from bisect import bisect_left
+
+from db_store import DB_OPERATION_CREATE_ENTITY, DB_OPERATION_DROP_ENTITY, DB_OPERATION_ENTITY_GET, \
+    DB_OPERATION_ENTITY_SAVE, DB_OPERATION_ENTITY_DEL, DB_OPERATION_ENTITY_MULTI_SAVE, \
+    DB_OPERATION_ENTITY_MULTI_GET, DB_OPERATION_ENTITY_MULTI_DEL, DB_OPERATION_ENTITY_AVAILABLE, \
+    DB_OPERATION_ENTITY_EXPLAIN, DB_OPERATION_ENTITY_JOIN, DB_OPERATION_ENTITY_SCAN, DB_OPERATION_ENTITY_SAVE_IF, \
+    DB_OPERATION_STATS, DB_OPERATION_ENTITY_BULK_LOAD
+
+DB_OPERATION_NAMES = {
+    DB_OPERATION_CREATE_ENTITY: "create",
+    DB_OPERATION_DROP_ENTITY: "drop",
+    DB_OPERATION_ENTITY_GET: "get",
+    DB_OPERATION_ENTITY_SAVE: "save",
+    DB_OPERATION_ENTITY_DEL: "del",
+    DB_OPERATION_ENTITY_MULTI_SAVE: "multi_save",
+    DB_OPERATION_ENTITY_MULTI_GET: "multi_get",
+    DB_OPERATION_ENTITY_MULTI_DEL: "multi_del",
+    DB_OPERATION_ENTITY_AVAILABLE: "available",
+    DB_OPERATION_ENTITY_EXPLAIN: "explain",
+    DB_OPERATION_ENTITY_JOIN: "join",
+    DB_OPERATION_ENTITY_SCAN: "scan",
+    DB_OPERATION_ENTITY_SAVE_IF: "save_if",
+    DB_OPERATION_STATS: "stats",
+    DB_OPERATION_ENTITY_BULK_LOAD: "bulk_load",
+}
+
+# Upper bounds (seconds) of latency histogram buckets, doubling from 16us to ~33s, and one overflow bucket
+LATENCY_BUCKETS = tuple(2 ** i / 1000000 for i in range(4, 26))
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+class LatencyHistogram(object):
+    """ Fixed log scale buckets, recording is a bisect and a few additions """
+    __slots__ = ("buckets", "count", "total", "max")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """ Upper bound of the bucket holding the q-th latency, at most the largest one seen """
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(LATENCY_BUCKETS[i], self.max) if i < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def as_dict(self):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "mean_ms": _ms(self.total / self.count), "p50_ms": _ms(self.percentile(0.5)),
+                "p99_ms": _ms(self.percentile(0.99)), "max_ms": _ms(self.max)}
+
+
+class OpMetrics(object):
+    __slots__ = ("latency", "busy", "errors")
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        # Time spent executing, latency also includes waiting in queues and for durability
+        self.busy = 0.0
+        self.errors = 0
+
+
+class Metrics(object):
+    """ Counters and latency histograms per DB_OPERATION_* and table. Updated only
+        from the db event loop thread, so recording takes no lock.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ops = {}
+        self.busy = 0.0
+
+    def record(self, op, table_name, latency, busy=0.0, status=True):
+        metrics = self.ops.get((op, table_name))
+        if metrics is None:
+            metrics = self.ops[(op, table_name)] = OpMetrics()
+        metrics.latency.record(latency)
+        metrics.busy += busy
+        self.busy += busy
+        if not status:
+            metrics.errors += 1
+
+    def uptime(self):
+        return time.monotonic() - self.started
+
+    def as_dict(self, table_name=None):
+        ops = []
+        for (op, table), metrics in sorted(self.ops.items(), key=lambda item: (str(item[0][1]), item[0][0])):
+            if table_name and table != table_name:
+                continue
+            ops.append({"op": DB_OPERATION_NAMES.get(op, str(op)), "table": table, "errors": metrics.errors,
+                        "busy_ms": _ms(metrics.busy), **metrics.latency.as_dict()})
+        return {"uptime_sec": round(self.uptime(), 3), "busy_sec": round(self.busy, 3), "ops": ops}
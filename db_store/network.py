@@ -0,0 +1,265 @@
+import asyncio
+import json
+import struct
+from functools import partial
+
+from db_store import MAX_FRAME_SIZE, INVALID_DB_REQUEST, DB_SERVER_UNAVAILABLE, DB_CONNECTION_POOL_SIZE
+from db_store.codec import RecordView, encode_records
+from db_store.datastore_workers import DBAccessReq
+
+logger = None
+
+# Frame layout (all integers little endian)
+#   header : magic(2s) version(B) request number(I) json length(I) blob count(H)
+#   body   : json, then blob count times length(I) + bytes
+# Requests carry [table name, op, data, trace id, timeout], responses [status, result]. Binary values
+# (encoded records) travel as blobs referenced from the json by {"$blob": position}.
+FRAME_MAGIC = b"QN"
+FRAME_VERSION = 1
+WIRE_BLOB = "$blob"
+
+_FRAME_HEADER = struct.Struct("<2sBIIH")
+_U32 = struct.Struct("<I")
+
+
+def parse_address(address):
+    """ "host:port" for TCP, "unix:path" for a unix socket """
+    if address.startswith("unix:"):
+        return None, address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port)), None
+
+
+def _to_wire(value, blobs):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        blobs.append(bytes(value))
+        return {WIRE_BLOB: len(blobs) - 1}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(v, RecordView) for v in value):
+            # Native results of a local db server are sent in the binary record format
+            return _to_wire(encode_records(value), blobs)
+        return [_to_wire(v, blobs) for v in value]
+    if isinstance(value, dict):
+        return {k: _to_wire(v, blobs) for k, v in value.items()}
+    return value
+
+
+def encode_frame(req_no, message):
+    blobs = []
+    body = json.dumps(_to_wire(message, blobs)).encode("utf-8")
+    buf = bytearray(_FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, req_no, len(body), len(blobs)))
+    buf += body
+    for blob in blobs:
+        buf += _U32.pack(len(blob))
+        buf += blob
+    if len(buf) > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {len(buf)} bytes exceeds limit of {MAX_FRAME_SIZE}")
+    return bytes(buf)
+
+
+async def read_frame(reader):
+    """ (request number, message) of the next frame, ValueError on anything but a well formed frame """
+    magic, version, req_no, body_len, blob_count = _FRAME_HEADER.unpack(
+        await reader.readexactly(_FRAME_HEADER.size))
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame: {magic}:{version}")
+
+    size = body_len
+    if size > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame exceeds limit of {MAX_FRAME_SIZE} bytes")
+    body = await reader.readexactly(body_len)
+    blobs = []
+    for _ in range(blob_count):
+        (blob_len,) = _U32.unpack(await reader.readexactly(_U32.size))
+        size += blob_len
+        if size > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame exceeds limit of {MAX_FRAME_SIZE} bytes")
+        blobs.append(await reader.readexactly(blob_len))
+
+    def from_wire(obj):
+        if len(obj) == 1 and WIRE_BLOB in obj:
+            position = obj[WIRE_BLOB]
+            if not isinstance(position, int) or not 0 <= position < len(blobs):
+                raise ValueError(f"Frame refers to missing blob {position}")
+            return blobs[position]
+        return obj
+
+    return req_no, json.loads(body, object_hook=from_wire)
+
+
+class DBNetworkServer(object):
+    """ Serves the DB_OPERATION_* protocol over TCP or a unix socket, forwarding
+        requests to the db server reading req_queue (DBStoreWorkers or its sharded
+        counterpart). Clients may pipeline requests on a connection, responses are
+        sent as soon as they are ready and matched by request number.
+    """
+
+    def __init__(self, req_queue, address):
+        self.req_queue = req_queue
+        self.address = address
+
+    @staticmethod
+    def __valid_request(message):
+        # Trace id and timeout (seconds) are optional, a request without them is traced under an id of
+        # this server and times out by the default of its scheduler lane
+        return isinstance(message, list) and 3 <= len(message) <= 5 and isinstance(message[0], str) \
+            and isinstance(message[1], int) and not isinstance(message[1], bool) \
+            and (len(message) < 4 or message[3] is None or isinstance(message[3], str)) \
+            and (len(message) < 5 or message[4] is None
+                 or (isinstance(message[4], (int, float)) and not isinstance(message[4], bool)))
+
+    async def __serve_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        peer = writer.get_extra_info("peername") or self.address
+
+        def reply(req_no, status, result):
+            if writer.is_closing():
+                return
+            try:
+                frame = encode_frame(req_no, [status, result])
+            except (TypeError, ValueError) as e:
+                logger.error(f"Response to request:{req_no} of {peer} can not be sent, {e}")
+                frame = encode_frame(req_no, [False, json.dumps({"_error": str(e)})])
+            writer.write(frame)
+
+        def on_done(req_no, fut):
+            resp = fut.result()
+            reply(req_no, resp.status, resp.result)
+
+        logger.info(f"DB client connected from {peer}")
+        try:
+            while True:
+                req_no, message = await read_frame(reader)
+                if not self.__valid_request(message):
+                    reply(req_no, False, json.dumps({"_error": INVALID_DB_REQUEST.format(message)}))
+                    continue
+                fut = loop.create_future()
+                fut.add_done_callback(partial(on_done, req_no))
+                await self.req_queue.put(DBAccessReq(*message[:3], fut, *message[3:]))
+                # Stop reading requests of a client which does not read its responses
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as e:
+            logger.warning(f"Closing connection of {peer}, {e}")
+        finally:
+            writer.close()
+            logger.info(f"DB client disconnected from {peer}")
+
+    async def run(self):
+        tcp, path = parse_address(self.address)
+        try:
+            if path:
+                server = await asyncio.start_unix_server(self.__serve_connection, path)
+            else:
+                server = await asyncio.start_server(self.__serve_connection, *tcp)
+        except OSError as e:
+            logger.error(f"DB server can not listen at {self.address}, {e}")
+            return
+        logger.info(f"DB server listening at {self.address}")
+        async with server:
+            await server.serve_forever()
+
+
+class DBConnection(object):
+    """ Client side of one connection. Requests are numbered and written without
+        waiting for earlier responses, a reader task resolves the future of each.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.connecting = None
+        self.pending = {}
+        self.req_no = 0
+
+    async def __connect(self):
+        tcp, path = parse_address(self.address)
+        if path:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(*tcp)
+        # Requests of a lost connection are failed by its own reader, not those of the new one
+        self.reader, self.writer, self.pending = reader, writer, {}
+        self.reader_task = asyncio.create_task(self.__read_responses(reader, writer, self.pending))
+
+    async def connect(self):
+        if self.writer and not self.writer.is_closing():
+            return
+        # Concurrent requests of a fresh connection wait for the same connect
+        if not self.connecting or self.connecting.done():
+            self.connecting = asyncio.ensure_future(self.__connect())
+        await asyncio.shield(self.connecting)
+
+    def __error(self):
+        return json.dumps({"_error": DB_SERVER_UNAVAILABLE.format(self.address)})
+
+    async def __read_responses(self, reader, writer, pending):
+        try:
+            while True:
+                req_no, (status, result) = await read_frame(reader)
+                fut = pending.pop(req_no, None)
+                if fut and not fut.done():
+                    fut.set_result((status, result))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, TypeError) as e:
+            logger.error(f"Connection to DB server {self.address} is lost, {e!r}")
+        finally:
+            writer.close()
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_result((False, self.__error()))
+            pending.clear()
+
+    def load(self):
+        return len(self.pending)
+
+    async def execute(self, table_name, op, data, trace_id=None, timeout=None):
+        try:
+            await self.connect()
+        except OSError as e:
+            logger.error(f"DB server {self.address} is not reachable, {e}")
+            return False, self.__error()
+
+        self.req_no += 1
+        try:
+            frame = encode_frame(self.req_no, [table_name, op, data, trace_id, timeout])
+        except (TypeError, ValueError) as e:
+            return False, json.dumps({"_error": INVALID_DB_REQUEST.format(e)})
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[self.req_no] = fut
+        self.writer.write(frame)
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            # Reader of the connection fails every pending request
+            pass
+        return await fut
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+        if self.reader_task:
+            self.reader_task.cancel()
+
+
+class DBConnectionPool(object):
+    """ Connections to a db server shared by all DAOs of a client process,
+        a request goes to the connection with the fewest responses pending.
+    """
+
+    def __init__(self, address, size=DB_CONNECTION_POOL_SIZE):
+        self.address = address
+        self.connections = [DBConnection(address) for _ in range(max(1, size))]
+
+    async def connect(self):
+        await asyncio.gather(*(c.connect() for c in self.connections))
+
+    async def execute(self, table_name, op, data, trace_id=None, timeout=None):
+        connection = min(self.connections, key=DBConnection.load)
+        return await connection.execute(table_name, op, data, trace_id, timeout)
+
+    async def close(self):
+        for connection in self.connections:
+            await connection.close()
@@ -0,0 +1,221 @@
+from bisect import bisect_left
+
+from db_store import PLAN_ACCESS_INDEX, PLAN_ACCESS_RANGE, PLAN_ACCESS_RESIDUAL, PLAN_ACCESS_SCAN, \
+    PLAN_ACCESS_COMPOSITE, RANGE_TO_RESIDUAL_FACTOR, JOIN_INDEX_NESTED_LOOP, JOIN_HASH, JOIN_FILTER_PROBE, \
+    DEFAULT_PAGE_SIZE, INDEX_ORDERED, INDEX_ORDERED_UNIQUE
+from db_store.datastore import matches
+
+logger = None
+
+
+class PlanStep(object):
+    def __init__(self, access, field, condition, estimated_rows, index=None):
+        self.access = access
+        self.field = field
+        self.condition = condition
+        self.estimated_rows = estimated_rows
+        self.index = index
+
+    def describe(self):
+        return {"access": self.access, "field": self.field, "condition": self.condition,
+                "estimated_rows": self.estimated_rows}
+
+
+class QueryPlan(object):
+    """ Filters of a GET are ANDed. Indexed filters are applied from the most
+        selective one, narrowing the candidate record ids, filters without a
+        usable index are evaluated as residual predicates on the candidates.
+        Filters on a leading prefix of the fields of a composite index are
+        served by one lookup of it, the index covering most of them is taken.
+        Plans run on a TableStore or on a TableView of a snapshot alike.
+    """
+
+    def __init__(self, table, filters):
+        self.table = table
+        self.index_steps = []
+        self.residual_steps = []
+
+        composite = self.__composite_step(filters)
+        if composite:
+            self.index_steps.append(composite)
+            filters = {f: c for f, c in filters.items() if f not in composite.condition}
+
+        for field, condition in filters.items():
+            index = table.get_indexed(field)
+            if isinstance(condition, dict) and index and index.kind in (INDEX_ORDERED, INDEX_ORDERED_UNIQUE):
+                self.index_steps.append(PlanStep(PLAN_ACCESS_RANGE, field, condition,
+                                                 index.estimate_range_rows(condition), index))
+            elif index and not isinstance(condition, dict):
+                self.index_steps.append(PlanStep(PLAN_ACCESS_INDEX, field, condition,
+                                                 index.estimate_rows(condition), index))
+            else:
+                self.residual_steps.append(PlanStep(PLAN_ACCESS_RESIDUAL, field, condition, None))
+
+        self.index_steps.sort(key=lambda step: step.estimated_rows)
+
+        # A wide range costs more to materialize than checking it on the few candidates left
+        if self.index_steps:
+            first = self.index_steps[0].estimated_rows
+            for step in self.index_steps[1:]:
+                if step.access == PLAN_ACCESS_RANGE and step.estimated_rows > RANGE_TO_RESIDUAL_FACTOR * first:
+                    step.access = PLAN_ACCESS_RESIDUAL
+                    self.residual_steps.append(step)
+            self.index_steps = [s for s in self.index_steps if s.access != PLAN_ACCESS_RESIDUAL]
+
+    def __composite_step(self, filters):
+        best = None
+        for index in self.table.composite_indexes():
+            conditions = index.prefix_conditions(filters)
+            # An index of its own serves a filter of the first field alone as well
+            if not conditions or (len(conditions) == 1 and self.table.get_indexed(index.fields[0])):
+                continue
+            step = PlanStep(PLAN_ACCESS_COMPOSITE, index.name, dict(zip(index.fields, conditions)),
+                            index.estimate_prefix_rows(conditions), index)
+            rank = (len(step.condition), -step.estimated_rows)
+            if not best or rank > (len(best.condition), -best.estimated_rows):
+                best = step
+        return best
+
+    def estimated_rows(self):
+        if self.index_steps:
+            return min(step.estimated_rows for step in self.index_steps)
+        return self.table.record_count()
+
+    def describe(self):
+        steps = [step.describe() for step in self.index_steps]
+        if not self.index_steps:
+            steps.append({"access": PLAN_ACCESS_SCAN, "field": None, "condition": None,
+                          "estimated_rows": self.table.record_count()})
+        steps.extend(step.describe() for step in self.residual_steps)
+        return {"table": self.table.name, "steps": steps, "estimated_rows": self.estimated_rows()}
+
+    def __candidates(self):
+        if not self.index_steps:
+            residual = self.residual_steps[0]
+            return [_id for _id, value in self.table.iter_field(residual.field)
+                    if matches(value, residual.condition)], self.residual_steps[1:]
+
+        record_ids = None
+        for step in self.index_steps:
+            if step.access == PLAN_ACCESS_RANGE:
+                ids = step.index.get_range_record_ids(step.condition)
+            elif step.access == PLAN_ACCESS_COMPOSITE:
+                ids = step.index.prefix_record_ids(list(step.condition.values()))
+            else:
+                ids = step.index.get_indexed_record_ids(step.condition)
+            if not ids:
+                logger.debug(f'No object found for attr={step.field}, value={step.condition}')
+                return [], []
+            record_ids = set(ids) if record_ids is None else record_ids & ids
+            if not record_ids:
+                return [], []
+        return record_ids, self.residual_steps
+
+    def execute(self):
+        record_ids, residual_steps = self.__candidates()
+        for step in residual_steps:
+            record_ids = [_id for _id in record_ids if matches(self.table.get_field(_id, step.field), step.condition)]
+        return record_ids
+
+
+class JoinPlan(object):
+    """ Records of table whose join_key value is found in the related records
+        selected by related_filters. Related side is always reduced to the set
+        of its join values, the table side is then read by the cheapest of
+        - index nested loop: postings of every join value in the index of table
+        - filter probe: records selected by filters of table, probed against join values
+        - hash join: one pass over the join_key column of table
+    """
+
+    def __init__(self, table, related, join_key, related_filters, filters):
+        self.table = table
+        self.related = related
+        self.join_key = join_key
+        self.related_filters = related_filters or {}
+        self.filters = filters or {}
+
+    def __join_values(self):
+        if self.related_filters:
+            record_ids = QueryPlan(self.related, self.related_filters).execute()
+            return {self.related.get_field(_id, self.join_key) for _id in record_ids}
+        return {value for _, value in self.related.iter_field(self.join_key)}
+
+    def __strategy(self, join_values, plan):
+        costs = {JOIN_HASH: self.table.record_count()}
+        index = self.table.get_indexed(self.join_key)
+        if index:
+            costs[JOIN_INDEX_NESTED_LOOP] = sum(index.estimate_rows(v) for v in join_values)
+        if plan:
+            costs[JOIN_FILTER_PROBE] = plan.estimated_rows()
+        return min(costs, key=costs.get)
+
+    def execute(self):
+        join_values = self.__join_values()
+        if not join_values:
+            return []
+
+        plan = QueryPlan(self.table, self.filters) if self.filters else None
+        strategy = self.__strategy(join_values, plan)
+        logger.debug(f'Joining {self.table.name} with {self.related.name} on {self.join_key} '
+                     f'for {len(join_values)} values using {strategy}')
+
+        if strategy == JOIN_FILTER_PROBE:
+            return [_id for _id in plan.execute() if self.table.get_field(_id, self.join_key) in join_values]
+
+        if strategy == JOIN_INDEX_NESTED_LOOP:
+            index = self.table.get_indexed(self.join_key)
+            record_ids = []
+            for v in join_values:
+                record_ids.extend(index.get_indexed_record_ids(v) or ())
+        else:
+            record_ids = [_id for _id, value in self.table.iter_field(self.join_key) if value in join_values]
+
+        for field, condition in self.filters.items():
+            record_ids = [_id for _id in record_ids if matches(self.table.get_field(_id, field), condition)]
+        return record_ids
+
+
+class ScanPlan(object):
+    """ Pages through the records of a table matching filters, in slot order or
+        in the order of an ordered index. The position returned with a page is
+        the one of its last record. Paged on a TableView, every page reads the
+        records as of the same snapshot.
+    """
+
+    def __init__(self, table, filters=None, order_by=None):
+        self.table = table
+        self.order_by = order_by
+        self.plan = None
+        self.residual = filters or {}
+
+        # Selective indexed filters are resolved upfront, only record ids are materialized
+        if self.residual and not order_by:
+            plan = QueryPlan(table, self.residual)
+            if plan.index_steps:
+                self.plan, self.residual = plan, {}
+
+    def __positions(self, cursor):
+        if self.order_by:
+            after = (tuple(cursor[0]), cursor[1]) if cursor else None
+            for key, record_id in self.table.get_indexed(self.order_by).iter_ordered(after):
+                yield [key, record_id], record_id
+            return
+
+        start = cursor + 1 if cursor is not None else 0
+        if not self.plan:
+            yield from self.table.iter_slots(start)
+            return
+        positions = sorted((self.table.get_slot(_id), _id) for _id in self.plan.execute())
+        yield from positions[bisect_left(positions, (start,)):]
+
+    def page(self, cursor=None, limit=DEFAULT_PAGE_SIZE):
+        """ Up to limit record ids following position cursor, and the position of the next page if any """
+        record_ids, last = [], None
+        for position, record_id in self.__positions(cursor):
+            if any(not matches(self.table.get_field(record_id, f), c) for f, c in self.residual.items()):
+                continue
+            if len(record_ids) == limit:
+                return record_ids, last
+            record_ids.append(record_id)
+            last = position
+        return record_ids, None
@@ -0,0 +1,148 @@
+import asyncio
+import contextvars
+import json
+from collections import deque
+
+from db_store import SCHED_LANE_WRITE, SCHED_LANE_READ, SCHED_LANE_SCAN, SCHED_LANES, SCHED_LANE_SIZES, \
+    SCHED_LANE_WEIGHTS, SCHED_LANE_TIMEOUTS, DB_SERVER_OVERLOADED, REQUEST_TIMED_OUT, TRACE_STAGE_RECEIVED, \
+    TRACE_STAGE_REPLIED, DB_OPERATION_CREATE_ENTITY, DB_OPERATION_DROP_ENTITY, DB_OPERATION_ENTITY_SAVE, \
+    DB_OPERATION_ENTITY_SAVE_IF, DB_OPERATION_ENTITY_DEL, DB_OPERATION_ENTITY_MULTI_SAVE, \
+    DB_OPERATION_ENTITY_MULTI_DEL, DB_OPERATION_ENTITY_GET, DB_OPERATION_ENTITY_SCAN, DB_OPERATION_ENTITY_JOIN, \
+    DB_OPERATION_ENTITY_AVAILABLE, DB_OPERATION_ENTITY_BULK_LOAD
+from db_store.datastore_workers import DBAccessReq, DBAccessResp
+
+logger = None
+
+# Deadline of the request a coroutine works for, requests it sends on (e.g. to shards) get the time left
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+WRITE_OPS = {DB_OPERATION_CREATE_ENTITY, DB_OPERATION_DROP_ENTITY, DB_OPERATION_ENTITY_SAVE,
+             DB_OPERATION_ENTITY_SAVE_IF, DB_OPERATION_ENTITY_DEL, DB_OPERATION_ENTITY_MULTI_SAVE,
+             DB_OPERATION_ENTITY_MULTI_DEL, DB_OPERATION_ENTITY_BULK_LOAD}
+SCAN_OPS = {DB_OPERATION_ENTITY_SCAN, DB_OPERATION_ENTITY_JOIN, DB_OPERATION_ENTITY_AVAILABLE}
+
+
+def lane_of(req):
+    if req.op in WRITE_OPS:
+        return SCHED_LANE_WRITE
+    # A get without filters reads the whole table
+    if req.op in SCAN_OPS or (req.op == DB_OPERATION_ENTITY_GET and not req.op_data):
+        return SCHED_LANE_SCAN
+    return SCHED_LANE_READ
+
+
+class RequestScheduler(asyncio.Queue):
+    """ Queue between db clients and the workers of db server, a request put by a client
+        is taken by the worker serving it. Requests wait in a lane per kind of operation
+        (writes, point reads, scans), lanes are served by weighted round robin so a burst
+        of scans holds up writes by no more than one scan per round. Anything else put,
+        e.g. the worker count at startup, is served first.
+        A request put to a full lane waits for room until its deadline (put_nowait does not
+        wait), it is then answered with DB_SERVER_OVERLOADED. Requests taken after their
+        deadline are answered with REQUEST_TIMED_OUT, neither of them is run.
+    """
+
+    def __init__(self, lane_sizes=None, lane_weights=None, lane_timeouts=None):
+        self.lane_sizes = dict(SCHED_LANE_SIZES, **(lane_sizes or {}))
+        self.lane_weights = {lane: max(1, weight) for lane, weight in
+                             dict(SCHED_LANE_WEIGHTS, **(lane_weights or {})).items()}
+        self.lane_timeouts = dict(SCHED_LANE_TIMEOUTS, **(lane_timeouts or {}))
+        self.peaks = dict.fromkeys(SCHED_LANES, 0)
+        self.shed = dict.fromkeys(SCHED_LANES, 0)
+        self.expired = dict.fromkeys(SCHED_LANES, 0)
+        super().__init__()
+
+    # Storage hooks of asyncio.Queue, it keeps the waiting putters / getters and task accounting
+    def _init(self, maxsize):
+        self.control = deque()
+        self.lanes = {lane: deque() for lane in SCHED_LANES}
+        # Futures of requests waiting for room in a full lane
+        self.putters = {lane: deque() for lane in SCHED_LANES}
+        self.credits = dict(self.lane_weights)
+
+    def _put(self, item):
+        if not isinstance(item, DBAccessReq):
+            self.control.append(item)
+            return
+        lane = lane_of(item)
+        self.lanes[lane].append(item)
+        if len(self.lanes[lane]) > self.peaks[lane]:
+            self.peaks[lane] = len(self.lanes[lane])
+
+    def _get(self):
+        if self.control:
+            return self.control.popleft()
+        while True:
+            for lane in SCHED_LANES:
+                if self.lanes[lane] and self.credits[lane]:
+                    self.credits[lane] -= 1
+                    self.__wake_putter(lane)
+                    return self.lanes[lane].popleft()
+            # Lanes holding requests are out of credits, next round
+            self.credits.update(self.lane_weights)
+
+    def qsize(self):
+        return len(self.control) + sum(len(lane) for lane in self.lanes.values())
+
+    def empty(self):
+        return not self.qsize()
+
+    def __wake_putter(self, lane):
+        while self.putters[lane]:
+            putter = self.putters[lane].popleft()
+            if not putter.done():
+                putter.set_result(None)
+                return
+
+    def __full(self, req):
+        lane = lane_of(req)
+        if req.deadline is None:
+            req.deadline = req.submitted_at + self.lane_timeouts[lane]
+        return len(self.lanes[lane]) >= self.lane_sizes[lane]
+
+    async def put(self, item):
+        if not isinstance(item, DBAccessReq):
+            return self.put_nowait(item)
+        while self.__full(item):
+            putter = asyncio.get_running_loop().create_future()
+            self.putters[lane_of(item)].append(putter)
+            try:
+                await asyncio.wait_for(putter, item.remaining())
+            except asyncio.TimeoutError:
+                break
+            except asyncio.CancelledError:
+                # Room this putter was woken for goes to the next one
+                if putter.done() and not putter.cancelled():
+                    self.__wake_putter(lane_of(item))
+                raise
+        self.put_nowait(item)
+
+    def put_nowait(self, item):
+        if isinstance(item, DBAccessReq):
+            lane = lane_of(item)
+            if self.__full(item):
+                self.shed[lane] += 1
+                self.__reject(item, DB_SERVER_OVERLOADED, lane)
+                return
+            item.trace(TRACE_STAGE_RECEIVED)
+        super().put_nowait(item)
+
+    async def get(self):
+        while True:
+            item = await super().get()
+            if not isinstance(item, DBAccessReq) or not item.expired():
+                return item
+            lane = lane_of(item)
+            self.expired[lane] += 1
+            self.__reject(item, REQUEST_TIMED_OUT, lane)
+
+    @staticmethod
+    def __reject(req, code, lane):
+        logger.debug(f"Rejected request:{req.trace_id} {req.op} on {req.entity_name}, {code.format(lane)}")
+        req.trace(TRACE_STAGE_REPLIED)
+        if not req.result.done():
+            req.result.set_result(DBAccessResp(False, json.dumps({"_error": code.format(lane), "lane": lane})))
+
+    def stats(self):
+        return {lane: {"queued": len(self.lanes[lane]), "peak": self.peaks[lane], "shed": self.shed[lane],
+                       "expired": self.expired[lane]} for lane in SCHED_LANES}
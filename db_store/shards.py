@@ -0,0 +1,474 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from functools import partial
+
+from db_store import ENTITY_NOT_FOUND, UNSUPPORTED_DB_OPERATION, SHARD_KEY_IMMUTABLE, \
+    SHARD_UNAVAILABLE, SHARD_DIR_NAME, SHARD_LOG_FILE, RESULT_FORMAT_BINARY, DB_OPERATION_CREATE_ENTITY, \
+    DB_OPERATION_ENTITY_SAVE, DB_OPERATION_ENTITY_GET, DB_OPERATION_ENTITY_DEL, DB_OPERATION_ENTITY_MULTI_SAVE, \
+    DB_OPERATION_ENTITY_MULTI_GET, DB_OPERATION_ENTITY_MULTI_DEL, DB_OPERATION_ENTITY_AVAILABLE, \
+    DB_OPERATION_ENTITY_EXPLAIN, DB_OPERATION_ENTITY_JOIN, DB_OPERATION_ENTITY_SCAN, DB_OPERATION_ENTITY_SAVE_IF, \
+    CONDITION_NOT_SHARD_LOCAL, DEFAULT_PAGE_SIZE, INVALID_DB_REQUEST, DB_OPERATION_STATS, TRACE_STAGE_REPLIED, \
+    DB_OPERATION_ENTITY_BULK_LOAD
+from db_store import datastore_workers, wal, expiry, planner, tracing, scheduler
+from db_store.codec import decode_result
+from db_store.datastore import matches, sort_key
+from db_store.datastore_workers import DBStoreWorkers, DBAccessReq, DBAccessResp
+from db_store.metrics import Metrics
+from db_store.scheduler import RequestScheduler
+
+logger = None
+
+# Request number of the message a shard sends once it is ready to serve
+SHARD_READY_REQ_NO = 0
+
+
+def run_shard(shard_id, conn, data_dir, worker_count, log_level, slow_op_ms):
+    """ Entry point of a shard process """
+    logging.basicConfig(level=log_level, filename=SHARD_LOG_FILE.format(shard_id), filemode='w',
+                        format='%(name)s - %(levelname)s - %(message)s')
+    shard_logger = logging.getLogger(f"shard_{shard_id}")
+    datastore_workers.logger = wal.logger = expiry.logger = planner.logger = tracing.logger = scheduler.logger = \
+        shard_logger
+    tracing.slow_ops.threshold_ms = slow_op_ms
+    asyncio.run(_serve_shard(shard_id, conn, data_dir, worker_count))
+
+
+async def _serve_shard(shard_id, conn, data_dir, worker_count):
+    loop = asyncio.get_running_loop()
+    req_queue = RequestScheduler()
+    # Results cross the process boundary, binary records are far cheaper to pickle than objects
+    db_server = DBStoreWorkers(f"shard_{shard_id}", req_queue, data_dir, RESULT_FORMAT_BINARY)
+    server_worker = asyncio.create_task(db_server.run())
+    await req_queue.put(worker_count)
+    await req_queue.join()
+
+    def reply(req_no, fut):
+        resp = fut.result()
+        conn.send((req_no, resp.status, resp.result))
+
+    def submit(req_no, table_name, op, data, trace_id, timeout):
+        fut = loop.create_future()
+        fut.add_done_callback(partial(reply, req_no))
+        asyncio.create_task(req_queue.put(DBAccessReq(table_name, op, data, fut, trace_id, timeout)))
+
+    def read_requests():
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                # Router went away, nothing is left to serve
+                loop.call_soon_threadsafe(server_worker.cancel)
+                return
+            loop.call_soon_threadsafe(submit, *msg)
+
+    conn.send((SHARD_READY_REQ_NO, True, None))
+    threading.Thread(target=read_requests, name=f"shard_{shard_id}_reader", daemon=True).start()
+    await server_worker
+
+
+class ShardConnection(object):
+    """ Router side of a shard process. Requests are numbered and sent over
+        the pipe, a reader thread resolves the future waiting for each response.
+    """
+
+    def __init__(self, shard_id, ctx, loop, data_dir, worker_count, log_level, slow_op_ms):
+        self.shard_id = shard_id
+        self.loop = loop
+        self.conn, child_conn = ctx.Pipe()
+        self.ready = loop.create_future()
+        self.pending = {SHARD_READY_REQ_NO: self.ready}
+        self.req_no = SHARD_READY_REQ_NO
+        self.process = ctx.Process(target=run_shard, name=f"qr_shard_{shard_id}", daemon=True,
+                                   args=(shard_id, child_conn, data_dir, worker_count, log_level, slow_op_ms))
+        self.process.start()
+        child_conn.close()
+        threading.Thread(target=self.__read_responses, name=f"shard_{shard_id}_router", daemon=True).start()
+
+    def __resolve(self, req_no, status, result):
+        fut = self.pending.pop(req_no, None)
+        if fut and not fut.done():
+            fut.set_result((status, result))
+
+    def __fail_pending(self):
+        error = json.dumps({"_error": SHARD_UNAVAILABLE.format(self.shard_id)})
+        for req_no in list(self.pending):
+            self.__resolve(req_no, False, error)
+
+    def __read_responses(self):
+        while True:
+            try:
+                req_no, status, result = self.conn.recv()
+            except (EOFError, OSError):
+                logger.error(f"Shard:{self.shard_id} is not reachable anymore")
+                self.loop.call_soon_threadsafe(self.__fail_pending)
+                return
+            self.loop.call_soon_threadsafe(self.__resolve, req_no, status, result)
+
+    async def execute(self, table_name, op, data):
+        if not self.process.is_alive():
+            return False, json.dumps({"_error": SHARD_UNAVAILABLE.format(self.shard_id)})
+        self.req_no += 1
+        fut = self.loop.create_future()
+        self.pending[self.req_no] = fut
+        # Sent on behalf of the request routed by the calling task, shard traces it under the same id
+        # and gives up on it once the deadline of that request has passed
+        deadline = scheduler.current_deadline.get()
+        timeout = None if deadline is None else deadline - time.perf_counter()
+        self.conn.send((self.req_no, table_name, op, data, tracing.current_trace_id.get(), timeout))
+        return await fut
+
+
+class ShardedDBStoreWorkers(object):
+    """ Drop-in replacement of DBStoreWorkers spreading the records of every
+        table over shard processes. A record lives on the shard picked by the
+        hash of its shard key, tables declared without one live on first shard.
+        Requests pinning the shard key are routed to a single shard, others are
+        fanned out and the results merged. Tables related by joins or
+        availability tracking are expected to share their shard key.
+    """
+
+    def __init__(self, name, req_queue, data_dir=None, shard_count=None, log_level=logging.INFO):
+        self.name = name
+        self.req_queue = req_queue
+        self.data_dir = data_dir
+        self.shard_count = shard_count or os.cpu_count() or 1
+        self.log_level = log_level
+        self.shards = []
+        self.shard_keys = {}
+        self.tasks = set()
+        self.metrics = Metrics()
+
+    def __shard_data_dir(self, shard_id):
+        if not self.data_dir:
+            return None
+        return os.path.join(self.data_dir, SHARD_DIR_NAME.format(shard_id))
+
+    def __shard_of(self, value):
+        # Stable across processes and restarts unlike hash()
+        return zlib.crc32(str(value).encode("utf-8")) % len(self.shards)
+
+    def __pinned_shard(self, table_name, content):
+        """ Single shard serving content (a record or filters), None when every shard has to """
+        shard_key = self.shard_keys.get(table_name)
+        if not shard_key:
+            return 0
+        content = content or {}
+        if shard_key not in content or isinstance(content[shard_key], dict):
+            return None
+        return self.__shard_of(content[shard_key])
+
+    def __target_shards(self, table_name, content):
+        shard = self.__pinned_shard(table_name, content)
+        return range(len(self.shards)) if shard is None else [shard]
+
+    @staticmethod
+    def __error(result):
+        try:
+            return json.loads(result).get("_error")
+        except (TypeError, ValueError, AttributeError):
+            return None
+
+    async def __fan_out(self, shards, table_name, op, data):
+        return await asyncio.gather(*(self.shards[s].execute(table_name, op, data) for s in shards))
+
+    @staticmethod
+    def __merge_records(responses):
+        records = []
+        for status, result in responses:
+            if not status:
+                return False, result
+            records.extend(decode_result(result))
+        return True, records
+
+    async def __create_table(self, table_name, table_spec):
+        self.shard_keys[table_name] = (table_spec or {}).get("shard_key")
+        for status, result in await self.__fan_out(range(len(self.shards)), table_name, DB_OPERATION_CREATE_ENTITY,
+                                                   table_spec):
+            if not status:
+                return status, result
+        return True, None
+
+    async def __check_moved(self, table_name, content, status, result):
+        # A record is not found on its shard when its shard key was changed by the update
+        if status or not content.get("id") or self.__error(result) != ENTITY_NOT_FOUND.format(content["id"]):
+            return status, result
+        _, records = self.__merge_records(await self.__fan_out(range(len(self.shards)), table_name,
+                                                               DB_OPERATION_ENTITY_GET, {"id": content["id"]}))
+        if records:
+            return False, json.dumps({"_error": SHARD_KEY_IMMUTABLE.format(self.shard_keys[table_name])})
+        return status, result
+
+    async def __save(self, table_name, content):
+        shard = self.__pinned_shard(table_name, content) or 0
+        status, result = await self.shards[shard].execute(table_name, DB_OPERATION_ENTITY_SAVE, content)
+        return await self.__check_moved(table_name, content, status, result)
+
+    async def __save_if(self, table_name, save):
+        # Condition is evaluated atomically by a single shard, it can only see records of that shard
+        shard = self.__pinned_shard(table_name, save["content"]) or 0
+        if save.get("none_match") and self.__pinned_shard(table_name, save["none_match"]) != shard:
+            return False, json.dumps({"_error": CONDITION_NOT_SHARD_LOCAL.format(table_name)})
+        status, result = await self.shards[shard].execute(table_name, DB_OPERATION_ENTITY_SAVE_IF, save)
+        return await self.__check_moved(table_name, save["content"], status, result)
+
+    async def __get(self, table_name, filters):
+        shards = self.__target_shards(table_name, filters)
+        if len(shards) == 1:
+            return await self.shards[shards[0]].execute(table_name, DB_OPERATION_ENTITY_GET, filters)
+        return self.__merge_records(await self.__fan_out(shards, table_name, DB_OPERATION_ENTITY_GET, filters))
+
+    async def __del(self, table_name, _id):
+        responses = await self.__fan_out(range(len(self.shards)), table_name, DB_OPERATION_ENTITY_DEL, _id)
+        for status, result in responses:
+            if status:
+                return status, result
+        return responses[0]
+
+    async def __multi(self, table_name, op, items, targets):
+        """ Item i is sent to shards targets[i] in one batch per shard, result of item i lists its responses """
+        per_shard = {}
+        for i, shards in enumerate(targets):
+            for s in shards:
+                per_shard.setdefault(s, []).append(i)
+        shard_ids = list(per_shard)
+        responses = await asyncio.gather(*(self.shards[s].execute(table_name, op, [items[i] for i in per_shard[s]])
+                                           for s in shard_ids))
+        item_results = [[] for _ in items]
+        for s, (status, result) in zip(shard_ids, responses):
+            if not status:
+                return False, result
+            for i, item_result in zip(per_shard[s], result):
+                item_results[i].append(item_result)
+        return True, item_results
+
+    async def __multi_save(self, table_name, contents):
+        targets = [[self.__pinned_shard(table_name, c) or 0] for c in contents]
+        status, item_results = await self.__multi(table_name, DB_OPERATION_ENTITY_MULTI_SAVE, contents, targets)
+        if not status:
+            return status, item_results
+        return True, [await self.__check_moved(table_name, c, *r[0]) for c, r in zip(contents, item_results)]
+
+    async def __bulk_load(self, table_name, saves):
+        # Every shard loads its part of the batch, conditions are checked as for a single conditional save
+        shards = [self.__pinned_shard(table_name, s["content"]) or 0 for s in saves]
+        local = [i for i, s in enumerate(saves)
+                 if not s.get("none_match") or self.__pinned_shard(table_name, s["none_match"]) == shards[i]]
+        status, item_results = await self.__multi(table_name, DB_OPERATION_ENTITY_BULK_LOAD,
+                                                  [saves[i] for i in local], [[shards[i]] for i in local])
+        if not status:
+            return status, item_results
+        results = [(False, json.dumps({"_error": CONDITION_NOT_SHARD_LOCAL.format(table_name)}))] * len(saves)
+        for i, r in zip(local, item_results):
+            results[i] = await self.__check_moved(table_name, saves[i]["content"], *r[0])
+        return True, results
+
+    async def __multi_get(self, table_name, filters_list):
+        targets = [self.__target_shards(table_name, f) for f in filters_list]
+        status, item_results = await self.__multi(table_name, DB_OPERATION_ENTITY_MULTI_GET, filters_list, targets)
+        if not status:
+            return status, item_results
+        return True, [r[0] if len(r) == 1 else self.__merge_records(r) for r in item_results]
+
+    async def __multi_del(self, table_name, ids):
+        targets = [range(len(self.shards))] * len(ids)
+        status, item_results = await self.__multi(table_name, DB_OPERATION_ENTITY_MULTI_DEL, ids, targets)
+        if not status:
+            return status, item_results
+        return True, [next((r for r in results if r[0]), results[0]) for results in item_results]
+
+    async def __explain(self, table_name, filters):
+        shards = self.__target_shards(table_name, filters)
+        if len(shards) == 1:
+            return await self.shards[shards[0]].execute(table_name, DB_OPERATION_ENTITY_EXPLAIN, filters)
+        plans = []
+        for status, result in await self.__fan_out(shards, table_name, DB_OPERATION_ENTITY_EXPLAIN, filters):
+            if not status:
+                return status, result
+            plans.append(result)
+        return True, {"table": table_name, "shards": plans,
+                      "estimated_rows": sum(plan["estimated_rows"] for plan in plans)}
+
+    async def __stats(self, table_name):
+        shards = []
+        for status, result in await self.__fan_out(range(len(self.shards)), table_name, DB_OPERATION_STATS, None):
+            if not status:
+                return status, result
+            shards.append(result)
+        # Latency seen by router includes the round trips to shard processes
+        return True, {**self.metrics.as_dict(table_name), "server": self.name,
+                      "queues": self.req_queue.stats(), "routing": len(self.tasks),
+                      "shards": shards}
+
+    async def __available(self, table_name, group):
+        return self.__merge_records(await self.__fan_out(range(len(self.shards)), table_name,
+                                                         DB_OPERATION_ENTITY_AVAILABLE, group))
+
+    async def __join(self, table_name, join):
+        join_key = join["join_key"]
+        if self.shard_keys.get(table_name) == self.shard_keys.get(join["related"]):
+            if not self.shard_keys.get(table_name):
+                return await self.shards[0].execute(table_name, DB_OPERATION_ENTITY_JOIN, join)
+            if self.shard_keys[table_name] == join_key:
+                # Joined records are co-located, every shard joins its own part
+                return self.__merge_records(await self.__fan_out(range(len(self.shards)), table_name,
+                                                                 DB_OPERATION_ENTITY_JOIN, join))
+
+        status, related = await self.__get(join["related"], join.get("related_filters"))
+        if not status:
+            return status, related
+        filters = join.get("filters") or {}
+        join_values = {r.content.get(join_key) for r in decode_result(related)}
+        filters_list = [{**filters, join_key: v} for v in join_values
+                        if join_key not in filters or matches(v, filters[join_key])]
+        status, items = await self.__multi_get(table_name, filters_list)
+        if not status:
+            return status, items
+        records = {}
+        for status, result in items:
+            if status:
+                records.update((r.id, r) for r in decode_result(result))
+        return True, list(records.values())
+
+    async def __scan_in_order(self, table_name, scan):
+        # Cursor keeps the position reached on every shard, and the snapshot lease each shard pages from,
+        # pages of all shards are merged by sort key
+        limit, order_by = scan.get("limit") or DEFAULT_PAGE_SIZE, scan["order_by"]
+        cursor = scan.get("cursor") or {"after": [None] * len(self.shards), "done": [],
+                                        "snapshots": [None] * len(self.shards)}
+        shards = [s for s in range(len(self.shards)) if s not in cursor["done"]]
+        responses = await asyncio.gather(*(self.shards[s].execute(
+            table_name, DB_OPERATION_ENTITY_SCAN,
+            {**scan, "cursor": {"snapshot": cursor["snapshots"][s], "after": cursor["after"][s]}}) for s in shards))
+
+        candidates = []
+        for s, (status, result) in zip(shards, responses):
+            if not status:
+                return status, result
+            records, _ = result
+            candidates.extend((sort_key(r.content.get(order_by)), r.id, s, r) for r in decode_result(records))
+        candidates.sort(key=lambda c: c[:2])
+        page = candidates[:limit]
+
+        after, done, snapshots = list(cursor["after"]), list(cursor["done"]), list(cursor["snapshots"])
+        for key, record_id, s, _ in page:
+            after[s] = [key, record_id]
+        for s, (_, (records, next_cursor)) in zip(shards, responses):
+            snapshots[s] = next_cursor["snapshot"] if next_cursor else None
+            taken = sum(1 for c in page if c[2] == s)
+            if next_cursor is None and taken == len(decode_result(records)):
+                done.append(s)
+        next_cursor = {"after": after, "done": done, "snapshots": snapshots} if len(done) < len(self.shards) \
+            else None
+        return True, ([c[3] for c in page], next_cursor)
+
+    async def __scan(self, table_name, scan):
+        shards = self.__target_shards(table_name, scan.get("filters"))
+        if len(shards) == 1:
+            return await self.shards[shards[0]].execute(table_name, DB_OPERATION_ENTITY_SCAN, scan)
+        if scan.get("order_by"):
+            return await self.__scan_in_order(table_name, scan)
+
+        # Shards are walked one after the other, a page is filled up across shard boundaries
+        limit = scan.get("limit") or DEFAULT_PAGE_SIZE
+        cursor = scan.get("cursor") or {"shard": 0, "cursor": None}
+        shard, shard_cursor, records = cursor["shard"], cursor["cursor"], []
+        while shard < len(self.shards) and len(records) < limit:
+            status, result = await self.shards[shard].execute(
+                table_name, DB_OPERATION_ENTITY_SCAN, {**scan, "limit": limit - len(records), "cursor": shard_cursor})
+            if not status:
+                return status, result
+            page, shard_cursor = result
+            records.extend(decode_result(page))
+            if shard_cursor is None:
+                shard += 1
+        next_cursor = {"shard": shard, "cursor": shard_cursor} if shard < len(self.shards) else None
+        return True, (records, next_cursor)
+
+    async def __route(self, req):
+        tracing.current_trace_id.set(req.trace_id)
+        scheduler.current_deadline.set(req.deadline)
+        try:
+            status, result = await self.__route_op(req.op, req.entity_name, req.op_data)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            # Malformed op data (e.g. from a network client) is answered, not left waiting
+            logger.error(f"Failed routing of {req.op} on {req.entity_name}, {e!r}")
+            status, result = False, json.dumps({"_error": INVALID_DB_REQUEST.format(req.op)})
+        req.trace(TRACE_STAGE_REPLIED)
+        self.metrics.record(req.op, req.entity_name, time.perf_counter() - req.submitted_at, status=status)
+        tracing.slow_ops.check(req, status, result, self.name)
+        req.result.set_result(DBAccessResp(status, result))
+
+    async def __route_op(self, op, table_name, data):
+        if op == DB_OPERATION_CREATE_ENTITY:
+            status, result = await self.__create_table(table_name, data)
+        elif op == DB_OPERATION_ENTITY_SAVE:
+            status, result = await self.__save(table_name, data)
+        elif op == DB_OPERATION_ENTITY_SAVE_IF:
+            status, result = await self.__save_if(table_name, data)
+        elif op == DB_OPERATION_ENTITY_GET:
+            status, result = await self.__get(table_name, data)
+        elif op == DB_OPERATION_ENTITY_DEL:
+            status, result = await self.__del(table_name, data)
+        elif op == DB_OPERATION_ENTITY_SCAN:
+            status, result = await self.__scan(table_name, data)
+        elif op == DB_OPERATION_ENTITY_JOIN:
+            status, result = await self.__join(table_name, data)
+        elif op == DB_OPERATION_ENTITY_EXPLAIN:
+            status, result = await self.__explain(table_name, data)
+        elif op == DB_OPERATION_ENTITY_AVAILABLE:
+            status, result = await self.__available(table_name, data)
+        elif op == DB_OPERATION_ENTITY_MULTI_SAVE:
+            status, result = await self.__multi_save(table_name, data)
+        elif op == DB_OPERATION_ENTITY_MULTI_GET:
+            status, result = await self.__multi_get(table_name, data)
+        elif op == DB_OPERATION_ENTITY_BULK_LOAD:
+            status, result = await self.__bulk_load(table_name, data)
+        elif op == DB_OPERATION_ENTITY_MULTI_DEL:
+            status, result = await self.__multi_del(table_name, data)
+        elif op == DB_OPERATION_STATS:
+            status, result = await self.__stats(table_name)
+        else:
+            status, result = False, json.dumps({"_error": UNSUPPORTED_DB_OPERATION.format(op)})
+        return status, result
+
+    async def run(self):
+        try:
+            worker_count = await self.req_queue.get()
+            loop = asyncio.get_running_loop()
+            # Spawned, forking a process which already runs threads is unsafe
+            ctx = multiprocessing.get_context("spawn")
+            for i in range(self.shard_count):
+                self.shards.append(ShardConnection(i, ctx, loop, self.__shard_data_dir(i), worker_count,
+                                                   self.log_level, tracing.slow_ops.threshold_ms))
+            for shard in self.shards:
+                status, result = await shard.ready
+                if not status:
+                    raise RuntimeError(f"Shard:{shard.shard_id} failed to start, {result}")
+                logger.info(f"DB shard:{shard.shard_id} is successfully started")
+
+            self.req_queue.task_done()
+
+            while True:
+                db_req = await self.req_queue.get()
+                logger.debug(f"Receieved new db access request:{db_req}")
+                if not isinstance(db_req, DBAccessReq):
+                    logger.error("Received invalid db access request")
+                    continue
+
+                # Requests are routed concurrently, shards serve them in parallel
+                task = asyncio.create_task(self.__route(db_req))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            for shard in self.shards:
+                shard.conn.close()
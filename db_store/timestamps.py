@@ -0,0 +1,34 @@
+import datetime
+import time
+
+from db_store import TIMESTAMP_FORMAT
+
+
+def now_epoch():
+    return int(time.time())
+
+
+def to_epoch(value):
+    """ Seconds since epoch of a timestamp, None if value is not one. Records store
+        integers, TIMESTAMP_FORMAT strings of records saved before are still accepted.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if not isinstance(value, str) or not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(datetime.datetime.strptime(value, TIMESTAMP_FORMAT).timestamp())
+    except ValueError:
+        return None
+
+
+def format_epoch(value):
+    """ Local time of a timestamp for display, value as is if it is not a timestamp """
+    epoch = to_epoch(value)
+    if epoch is None:
+        return value
+    return datetime.datetime.fromtimestamp(epoch).strftime(TIMESTAMP_FORMAT)
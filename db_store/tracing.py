@@ -0,0 +1,86 @@
+import contextvars
+import itertools
+import os
+
+from db_store import DEFAULT_SLOW_OP_MS, SLOW_OP_DATA_LIMIT, DB_OPERATION_ENTITY_SAVE, DB_OPERATION_ENTITY_SAVE_IF, \
+    DB_OPERATION_ENTITY_MULTI_SAVE, DB_OPERATION_ENTITY_BULK_LOAD
+from db_store.metrics import DB_OPERATION_NAMES
+
+logger = None
+
+_trace_ids = itertools.count(1)
+
+# Trace id of the request a coroutine works for, requests it sends on (e.g. to shards) carry it along
+current_trace_id = contextvars.ContextVar("current_trace_id", default=None)
+
+
+def new_trace_id():
+    # Process id keeps ids of clients, db server and shards apart
+    return f"{os.getpid():x}-{next(_trace_ids):x}"
+
+
+def describe_request(op, data):
+    """ Data of a request as logged, values of saved content are left out as they may be secrets """
+    if op in (DB_OPERATION_ENTITY_SAVE, DB_OPERATION_ENTITY_MULTI_SAVE):
+        contents = data if isinstance(data, list) else [data]
+        fields = sorted({f for c in contents if isinstance(c, dict) for f in c})
+        description = f"{len(contents)} record(s) with fields {fields}"
+    elif op == DB_OPERATION_ENTITY_SAVE_IF and isinstance(data, dict):
+        content = data.get("content") or {}
+        description = f"fields {sorted(content)} none_match {data.get('none_match')} version {data.get('version')}"
+    elif op == DB_OPERATION_ENTITY_BULK_LOAD and isinstance(data, list):
+        fields = sorted({f for s in data if isinstance(s, dict) for f in s.get("content") or {}})
+        description = f"{len(data)} record(s) with fields {fields}"
+    else:
+        description = repr(data)
+    if len(description) > SLOW_OP_DATA_LIMIT:
+        description = description[:SLOW_OP_DATA_LIMIT] + "..."
+    return description
+
+
+def result_size(result):
+    if isinstance(result, (bytes, bytearray, memoryview)):
+        return f"{len(result)} bytes"
+    if isinstance(result, tuple):
+        # Page of a scan and its cursor
+        return result_size(result[0]) if result else "empty"
+    if isinstance(result, list):
+        return f"{len(result)} items"
+    if isinstance(result, str):
+        return f"{len(result)} chars"
+    if result is None:
+        return "none"
+    return type(result).__name__
+
+
+class SlowOpLog(object):
+    """ Logs requests which took longer than threshold_ms from submission to reply, with
+        the time spent up to each stage from the previous one. Stages are marked on the
+        DBAccessReq by
+        - DBClient: submitted (request created), sent (taken up on db event loop)
+        - db server: received (admitted to a lane of its RequestScheduler), started (taken
+          by a worker), locked (locks acquired in thread mode), executed (store and index work
+          done, result about to be encoded), handled, durable (wal fsynced), replied
+        A threshold of None disables the log.
+    """
+
+    def __init__(self, threshold_ms=DEFAULT_SLOW_OP_MS):
+        self.threshold_ms = threshold_ms
+
+    def check(self, req, status, result, where):
+        if self.threshold_ms is None or len(req.stages) < 2:
+            return False
+        elapsed = req.stages[-1][1] - req.stages[0][1]
+        if elapsed * 1000 < self.threshold_ms:
+            return False
+
+        breakdown = ", ".join(f"{stage} +{(at - req.stages[i][1]) * 1000:.3f}ms"
+                              for i, (stage, at) in enumerate(req.stages[1:]))
+        logger.warning(f"Slow op trace:{req.trace_id} at {where}: {DB_OPERATION_NAMES.get(req.op, req.op)} "
+                       f"on {req.entity_name or '-'} took {elapsed * 1000:.3f}ms [{breakdown}] "
+                       f"request: {describe_request(req.op, req.op_data)} "
+                       f"result: {'ok' if status else 'failed'}, {result_size(result)}")
+        return True
+
+
+slow_ops = SlowOpLog()
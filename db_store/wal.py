@@ -0,0 +1,181 @@
+import asyncio
+import json
+import os
+import threading
+
+from db_store import WAL_FILE_NAME, SNAPSHOT_FILE_NAME, WAL_SNAPSHOT_INTERVAL, \
+    WAL_OP_CREATE_TABLE, WAL_OP_SAVE_RECORD, WAL_OP_DEL_RECORD
+
+logger = None
+
+
+class WriteAheadLog(object):
+    """ Append only log of db mutations with periodic compacted snapshots.
+        Entries are queued by the workers and written by a single writer task,
+        so one fsync covers every request queued while the previous one ran.
+        A snapshot is taken once the log holds snapshot_interval entries and
+        at least as many as the last snapshot has records, so snapshots of a
+        growing db (e.g. by bulk loads) take time linear in the entries logged.
+    """
+
+    def __init__(self, data_dir, snapshot_interval=WAL_SNAPSHOT_INTERVAL):
+        self.data_dir = data_dir
+        self.wal_path = os.path.join(data_dir, WAL_FILE_NAME)
+        self.snapshot_path = os.path.join(data_dir, SNAPSHOT_FILE_NAME)
+        self.snapshot_interval = snapshot_interval
+        self.last_lsn = 0
+        self.durable_lsn = 0
+        self.entries_since_snapshot = 0
+        # Records covered by the last snapshot, a snapshot is taken once as many entries were logged after it
+        self.snapshot_records = 0
+        self.pending = []
+        self.waiters = []
+        self.wal_file = None
+        self.flush_event = None
+        self.loop = None
+        # Workers log from pool threads in thread worker mode
+        self.lock = threading.Lock()
+
+    def open(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.wal_file = open(self.wal_path, "ab")
+        self.flush_event = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+
+    def close(self):
+        if self.wal_file:
+            self.wal_file.close()
+            self.wal_file = None
+
+    def replay(self, db):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                snapshot = json.load(f)
+            for table_name, table in snapshot["tables"].items():
+                db.register_table(table_name, table["indexes"], table.get("expires_on"), table.get("availability"))
+                ts = db.get_table(table_name)
+                with ts.bulk_indexing():
+                    for record_id, content in table["records"].items():
+                        ts.restore_record(record_id, content)
+            self.snapshot_records = sum(len(table["records"]) for table in snapshot["tables"].values())
+            logger.info(f"Loaded snapshot with {len(snapshot['tables'])} tables")
+
+        if not os.path.exists(self.wal_path):
+            return
+
+        replayed = 0
+        with open(self.wal_path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn write at the tail of the log, everything after it was never acknowledged
+                    logger.warning(f"Ignoring incomplete wal entry after {replayed} entries")
+                    break
+                self.apply(db, entry)
+                replayed += 1
+        self.entries_since_snapshot = replayed
+        logger.info(f"Replayed {replayed} wal entries")
+
+    @staticmethod
+    def apply(db, entry):
+        if entry["op"] == WAL_OP_CREATE_TABLE:
+            db.register_table(entry["table"], entry["indexes"], entry.get("expires_on"), entry.get("availability"))
+            return
+
+        table = db.get_table(entry["table"])
+        if not table:
+            logger.error(f"Wal entry for unknown table:{entry['table']}")
+            return
+        if entry["op"] == WAL_OP_SAVE_RECORD:
+            table.restore_record(entry["id"], entry["content"])
+        elif entry["op"] == WAL_OP_DEL_RECORD:
+            table.del_record(entry["id"])
+
+    def log(self, entry):
+        # Serialize now, the record content may change before the writer picks it up
+        line = json.dumps(entry).encode("utf-8") + b"\n"
+        with self.lock:
+            self.pending.append(line)
+            self.last_lsn += 1
+            lsn = self.last_lsn
+        self.loop.call_soon_threadsafe(self.flush_event.set)
+        return lsn
+
+    async def wait_durable(self, lsn):
+        if lsn <= self.durable_lsn:
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append((lsn, fut))
+        self.flush_event.set()
+        await fut
+
+    def __write_and_sync(self, lines):
+        self.wal_file.write(b"".join(lines))
+        self.wal_file.flush()
+        os.fsync(self.wal_file.fileno())
+
+    def __write_snapshot(self, snapshot):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        # Every entry written so far is covered by the snapshot, start a fresh log
+        self.wal_file.close()
+        self.wal_file = open(self.wal_path, "wb")
+        os.fsync(self.wal_file.fileno())
+
+    @staticmethod
+    def __capture_snapshot(db):
+        tables = {}
+        for table_name, table in db.get_tables().items():
+            tables[table_name] = {
+                "indexes": {i: o.kind for i, o in table.indexes.items()},
+                "expires_on": table.expires_on,
+                "availability": db.get_availability(table_name).spec if db.get_availability(table_name) else None,
+                "records": {r.id: r.content for r in table.iter_records()},
+            }
+        return {"tables": tables}
+
+    def __locked_snapshot(self, db, locks):
+        with locks.read_catalog():
+            return json.dumps(self.__capture_snapshot(db))
+
+    async def run(self, db, locks=None):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.flush_event.wait()
+            self.flush_event.clear()
+            if not self.pending:
+                continue
+
+            with self.lock:
+                lines, self.pending = self.pending, []
+                lsn = self.last_lsn
+            await loop.run_in_executor(None, self.__write_and_sync, lines)
+            self.durable_lsn = lsn
+            logger.debug(f"Group committed {len(lines)} wal entries upto lsn:{lsn}")
+
+            waiters = []
+            for waiter_lsn, fut in self.waiters:
+                if waiter_lsn > lsn:
+                    waiters.append((waiter_lsn, fut))
+                elif not fut.done():
+                    fut.set_result(None)
+            self.waiters = waiters
+
+            self.entries_since_snapshot += len(lines)
+            if self.entries_since_snapshot >= max(self.snapshot_interval, self.snapshot_records):
+                # Entries logged while the snapshot is written are replayed on top of it,
+                # which is safe as every wal entry is idempotent
+                if locks:
+                    snapshot = await loop.run_in_executor(None, self.__locked_snapshot, db, locks)
+                else:
+                    snapshot = json.dumps(self.__capture_snapshot(db))
+                await loop.run_in_executor(None, self.__write_snapshot, snapshot)
+                self.entries_since_snapshot = 0
+                self.snapshot_records = sum(t.record_count() for t in list(db.get_tables().values()))
+                logger.info(f"Wal compacted into snapshot at lsn:{lsn}")
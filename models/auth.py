@@ -0,0 +1,92 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import namedtuple
+
+# Stored password format - kdf$iterations$salt hex$digest hex
+PASSWORD_KDF = "pbkdf2_sha256"
+PASSWORD_KDF_ITERATIONS = 200000
+PASSWORD_SALT_BYTES = 16
+
+SESSION_TTL_SECONDS = 30 * 60
+SESSION_TOKEN_BYTES = 32
+
+
+def hash_password(password, salt=None, iterations=PASSWORD_KDF_ITERATIONS):
+    salt = salt or os.urandom(PASSWORD_SALT_BYTES)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"{PASSWORD_KDF}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password, stored):
+    try:
+        kdf, iterations, salt, digest = stored.split("$")
+    except ValueError:
+        # Credentials saved before the KDF was introduced are unsalted sha224 hex digests
+        return hmac.compare_digest(hashlib.sha224(password.encode("utf-8")).hexdigest(), stored)
+    if kdf != PASSWORD_KDF:
+        return False
+    expected = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(expected.hex(), digest)
+
+
+def needs_rehash(stored):
+    return not stored.startswith(f"{PASSWORD_KDF}${PASSWORD_KDF_ITERATIONS}$")
+
+
+# The KDF is slow by design, coroutines on the DB event loop hand it to the default executor
+async def ahash_password(password):
+    return await asyncio.get_running_loop().run_in_executor(None, hash_password, password)
+
+
+async def averify_password(password, stored):
+    return await asyncio.get_running_loop().run_in_executor(None, verify_password, password, stored)
+
+
+class Session(namedtuple("Session", ["token", "email_address", "role", "expires_at"])):
+    __slots__ = ()
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+
+class SessionStore(object):
+    """ In memory sessions of authenticated operators. A token stands for the
+        operator until its TTL runs out, so no credential lookup or hashing is
+        needed to resume. Expired sessions are dropped when they are met or
+        when a new one is issued.
+    """
+
+    def __init__(self, ttl=SESSION_TTL_SECONDS):
+        self.ttl = ttl
+        self.sessions = {}
+        # Used by the cli thread and by coroutines of the DB event loop
+        self.lock = threading.Lock()
+
+    def issue(self, email_address, role):
+        session = Session(secrets.token_urlsafe(SESSION_TOKEN_BYTES), email_address, role,
+                          time.monotonic() + self.ttl)
+        with self.lock:
+            for token in [t for t, s in self.sessions.items() if s.expired()]:
+                del self.sessions[token]
+            self.sessions[session.token] = session
+        return session
+
+    def resolve(self, token):
+        with self.lock:
+            session = self.sessions.get(token)
+            if session and session.expired():
+                del self.sessions[token]
+                return None
+        return session
+
+    def revoke(self, token):
+        with self.lock:
+            self.sessions.pop(token, None)
+
+
+sessions = SessionStore()
@@ -1,20 +1,23 @@
-import datetime
-
-
 from db_lib.base_dao import BaseDAO
+from db_store.timestamps import now_epoch, to_epoch
 
 
 class BaseDO(object):
     dao = None
     authorization = set()
+    available_by = None
+    # Attributes holding epoch seconds, extended per entity by the timestamps option of DAOHelper
+    timestamps = ("created_at", "modified_at")
 
-    def __init__(self, id="", created_at="", modified_at="", created_by="", updated_by="", managed_by=""):
+    def __init__(self, id="", created_at="", modified_at="", created_by="", updated_by="", managed_by="", version=0):
         self.id = id
-        self.created_at = datetime.datetime.now().strftime("%d/%m/%YT%H:%M:%S") if not created_at else created_at
-        self.modified_at = datetime.datetime.now().strftime("%d/%m/%YT%H:%M:%S") if not modified_at else modified_at
+        now = now_epoch()
+        self.created_at = to_epoch(created_at) or now
+        self.modified_at = to_epoch(modified_at) or now
         self.created_by = created_by
         self.updated_by = updated_by
         self.managed_by = managed_by or self.updated_by
+        self.version = version
 
     @classmethod
     def verify_authorization(cls, role):
@@ -22,9 +25,37 @@ class BaseDO(object):
             return True
         return role in cls.authorization
 
+    @classmethod
+    def encode_timestamps(cls, args):
+        """ Timestamps of args, plain values or filter conditions, as epoch seconds """
+        def encode(value):
+            if isinstance(value, dict):
+                return {op: encode(v) for op, v in value.items()}
+            if isinstance(value, list):
+                return [encode(v) for v in value]
+            epoch = to_epoch(value)
+            return value if epoch is None else epoch
+
+        return {k: encode(v) if k in cls.timestamps else v for k, v in args.items()}
+
+    @classmethod
+    def encode_args(cls, args):
+        """ Values entered by an operator in the form they are stored in, e.g. password hashes """
+        return cls.encode_timestamps(args)
+
     def validate(self, obj=None):
         return True, None
 
+    async def avalidate(self, obj=None):
+        return self.validate(obj)
+
+    def save_condition(self):
+        """ Filters no other entity may match for this one to be saved, checked by db server along the save """
+        return None
+
+    def conflict_reason(self, conflict):
+        return f'{type(self).__name__} conflicts with existing entity with id:{conflict["id"]}'
+
 class DAOHelper(type):
     _meta_instance = {}
 
@@ -37,7 +68,16 @@ class DAOHelper(type):
 
     def __call__(cls, *args, **kwargs):
         if cls._meta_instance.get(cls, None):
-            cls.dao = BaseDAO(cls.__name__, cls._meta_instance[cls].get("indexes", {}))
+            cls.availability = cls._meta_instance[cls].get("availability")
+            cls.timestamps = BaseDO.timestamps + tuple(cls._meta_instance[cls].get("timestamps", ()))
+            availability_spec = None
+            if cls.availability:
+                # Resource entity is referred by class, db server only knows it by its table name
+                availability_spec = {**cls.availability, "of": cls.availability["of"].__name__}
+                cls.availability["of"].available_by = cls
+            cls.dao = BaseDAO(cls.__name__, cls._meta_instance[cls].get("indexes", {}),
+                              cls._meta_instance[cls].get("expires_on"), availability_spec,
+                              cls._meta_instance[cls].get("shard_key"), cls.timestamps)
             cls.authorization = cls._meta_instance[cls].get("authorization")
             cls.dependent_by = {}
             cls.relations = cls._meta_instance[cls].get("relations", {})
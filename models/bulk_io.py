@@ -0,0 +1,175 @@
+import csv
+import itertools
+import json
+import os
+
+from models.base_data_object import BaseDO
+
+# Formats of files read / written by bulk import and export, taken from the file extension unless given
+BULK_FORMAT_CSV = "csv"
+BULK_FORMAT_NDJSON = "ndjson"
+BULK_FORMAT_EXTENSIONS = {".csv": BULK_FORMAT_CSV, ".ndjson": BULK_FORMAT_NDJSON, ".jsonl": BULK_FORMAT_NDJSON}
+# Rows validated and saved per db request by an import, records fetched per page by an export
+BULK_CHUNK_SIZE = 1000
+BULK_EXPORT_PAGE_SIZE = 1000
+
+
+def file_format(path, fmt=None):
+    """ Format of a bulk file, None when it is not a supported one """
+    fmt = fmt or BULK_FORMAT_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    return fmt if fmt in (BULK_FORMAT_CSV, BULK_FORMAT_NDJSON) else None
+
+
+def read_rows(path, fmt):
+    """ Generator of (line number, row, error) of every row of a file, read as rows are consumed """
+    # utf-8-sig skips the byte order mark spreadsheet tools put in front of csv files
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        if fmt == BULK_FORMAT_CSV:
+            reader = csv.DictReader(f)
+            for row in reader:
+                # Cells beyond the header are collected under None
+                if None in row:
+                    yield reader.line_num, None, "More values than columns in header"
+                    continue
+                yield reader.line_num, row, None
+            return
+
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_no, None, "Invalid JSON"
+                continue
+            if not isinstance(row, dict):
+                yield line_no, None, "Row is not a JSON object"
+                continue
+            yield line_no, row, None
+
+
+def chunked(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BulkImport(object):
+    """ Saves rows of a file as new entities of entity_class, one chunk at a time. Rows of
+        a chunk are validated as register command does, related entities are looked up once
+        per distinct value of the chunk and valid rows are saved by one bulk load request.
+        System attributes of rows (id, created_at ...), e.g. of an exported file, are ignored.
+    """
+
+    def __init__(self, entity_class, attributes, mandatory, operator, failure_reason, chunk_size=BULK_CHUNK_SIZE):
+        self.entity_class = entity_class
+        self.attributes = set(attributes)
+        self.mandatory = set(mandatory)
+        self.operator = operator
+        # failure_reason(obj, result) explains a failed save of obj
+        self.failure_reason = failure_reason
+        self.chunk_size = chunk_size
+        self.system_attributes = set(BaseDO().__dict__)
+        self.rows = 0
+        self.imported = 0
+
+    def __content(self, row):
+        """ (content, None) of a row, or (None, reason) it can not be imported """
+        content = {k: v for k, v in row.items() if k not in self.system_attributes and v not in ("", None)}
+        missing = self.mandatory - set(content)
+        if missing:
+            return None, f"Missing mandatory attributes {sorted(missing)}"
+        unsupported = set(content) - self.attributes
+        if unsupported:
+            return None, f"Unsupported attributes {sorted(unsupported)}"
+        if any(isinstance(v, (dict, list)) for v in content.values()):
+            return None, "Only plain values are supported"
+        return content, None
+
+    def __related(self, contents, failures):
+        """ contents whose related entities exist """
+        for k, e in self.entity_class.relations.items():
+            if not contents:
+                break
+            values = list({content.get(k, "") for _, content in contents})
+            res, found = e.dao.get_many([{k: v} for v in values])
+            if not res:
+                failures.extend((line, f"Failed to query : {e.__name__}") for line, _ in contents)
+                return []
+            existing = {v for v, (status, records) in zip(values, found) if status and records}
+            for line, content in contents:
+                if content.get(k, "") not in existing:
+                    failures.append((line, f"{e.__name__} with {k}={content.get(k)} does not exist"))
+            contents = [(line, content) for line, content in contents if content.get(k, "") in existing]
+        return contents
+
+    def validate(self, chunk):
+        """ ([(line, entity)] of valid rows, [(line, reason)] of the others) """
+        contents, failures = [], []
+        for line, row, error in chunk:
+            content, error = self.__content(row) if not error else (None, error)
+            if error:
+                failures.append((line, error))
+                continue
+            contents.append((line, content))
+
+        valid = []
+        for line, content in self.__related(contents, failures):
+            content["created_by"] = content["updated_by"] = content["managed_by"] = self.operator
+            obj = self.entity_class(**self.entity_class.encode_args(content))
+            status, reason = obj.validate()
+            if not status:
+                failures.append((line, reason))
+                continue
+            valid.append((line, obj))
+        return valid, failures
+
+    def write(self, valid):
+        """ [(line, reason)] of the entities which could not be saved """
+        if not valid:
+            return []
+        res, results = self.entity_class.dao.bulk_load((obj.__dict__, obj.save_condition()) for _, obj in valid)
+        if not res:
+            return [(line, self.failure_reason(obj, results)) for line, obj in valid]
+
+        failures = []
+        for (line, obj), (status, result) in zip(valid, results):
+            if status:
+                self.imported += 1
+            else:
+                failures.append((line, self.failure_reason(obj, result)))
+        return failures
+
+    def run(self, rows):
+        """ Generator of the failures [(line, reason)] of every chunk, yielded once the chunk is saved """
+        for chunk in chunked(rows, self.chunk_size):
+            self.rows += len(chunk)
+            valid, failures = self.validate(chunk)
+            yield sorted(failures + self.write(valid))
+
+
+def export_records(entity_class, path, fmt, filters=None, page_size=BULK_EXPORT_PAGE_SIZE):
+    """ Records of entity_class matching filters written to path as they are fetched, page by
+        page. Result is (True, records written) or (False, error of the failed page).
+    """
+    written = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = None
+        if fmt == BULK_FORMAT_CSV:
+            # Columns of the entity, fields of records unknown to it are left out
+            writer = csv.DictWriter(f, list(entity_class().__dict__), extrasaction="ignore")
+            writer.writeheader()
+        for status, records in entity_class.dao.scan(filters, page_size):
+            if not status:
+                return False, records
+            for record in records:
+                if writer:
+                    writer.writerow(record.content)
+                else:
+                    # Content of records of the native result format is a read only mapping
+                    f.write(json.dumps(dict(record.content)) + "\n")
+            written += len(records)
+    return True, written
@@ -1,13 +1,14 @@
-import json
-import time
-import datetime
+from db_lib import INDEX_ORDERED, RECORD_STATE_FIELD, RECORD_STATE_ACTIVE
+from db_store.timestamps import now_epoch, to_epoch, format_epoch
 from models.base_data_object import BaseDO, DAOHelper
 
 DEFAULT_BOOKING_PERIOD_HOURS = 2
 
 
 class CarDO(BaseDO, metaclass=DAOHelper,
-            indexes={"model_name": False, "reg_no": True},
+            indexes={"model_name": False, "reg_no": True, "launch_year": INDEX_ORDERED,
+                     ("model_name", "launch_year"): False},
+            shard_key="reg_no",
             authorization={"manager"}):
 
     def __init__(self, model_name="N/A", launch_year="N/A", reg_no=None, **kwargs):
@@ -18,34 +19,29 @@ class CarDO(BaseDO, metaclass=DAOHelper,
 
 
 class CarStateDO(BaseDO, metaclass=DAOHelper,
-                 indexes={"reg_no": False},
+                 indexes={"reg_no": False, "booked_till": INDEX_ORDERED, "created_at": INDEX_ORDERED,
+                          ("reg_no", "booked_by"): False},
                  relations={"reg_no": CarDO},
+                 expires_on="booked_till",
+                 timestamps=("booked_till",),
+                 availability={"of": CarDO, "key": "reg_no", "group_by": "model_name"},
+                 shard_key="reg_no",
                  authorization={"customer"}):
-    def __init__(self, reg_no="", booked_by="", booked_till="", **kwargs):
+    def __init__(self, reg_no="", booked_by="", booked_till="", state="", **kwargs):
         super().__init__(**kwargs)
         self.reg_no = reg_no
         self.booked_by = booked_by or kwargs.get("last_updated_by", "")
-        self.booked_till = booked_till or CarStateDO.get_datetime_till_booked().strftime("%d/%m/%YT%H:%M:%S")
+        self.booked_till = to_epoch(booked_till) or CarStateDO.get_epoch_till_booked()
+        self.state = state
 
     @staticmethod
-    def get_datetime_till_booked():
-        dt = datetime.datetime.now()
-        delta = datetime.timedelta(hours=DEFAULT_BOOKING_PERIOD_HOURS)
-        return dt + delta
-
-    def validate(self, obj=None):
-        res, objects = CarStateDO.dao.get({"reg_no" : self.reg_no})
-
-        if not res or not objects:
-            return True, None
-
-        current_datetime = datetime.datetime.now().strftime("%d/%m/%YT%H:%M:%S")
-        for obj in objects:
-            booked_till = json.loads(obj)["content"]["booked_till"]
-            #print(booked_till)
-            #print(current_datetime)
-            if time.strptime(booked_till, "%d/%m/%YT%H:%M:%S") >= \
-                time.strptime(current_datetime, "%d/%m/%YT%H:%M:%S"):
-                return False, f'Car with reg_no:{self.reg_no} is already reserved till:{booked_till}'
-
-        return True, None
+    def get_epoch_till_booked():
+        return now_epoch() + DEFAULT_BOOKING_PERIOD_HOURS * 3600
+
+    def save_condition(self):
+        # A car has at most one active reservation, enforced by db server atomically with the save
+        return {"reg_no": self.reg_no, RECORD_STATE_FIELD: RECORD_STATE_ACTIVE}
+
+    def conflict_reason(self, conflict):
+        return f'Car with reg_no:{self.reg_no} is already reserved till:' \
+               f'{format_epoch(conflict["content"]["booked_till"])}'
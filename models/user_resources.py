@@ -1,8 +1,10 @@
+from models.auth import hash_password, verify_password, needs_rehash, averify_password, ahash_password
 from models.base_data_object import BaseDO, DAOHelper
-import hashlib
+
 
 class UserDO(BaseDO, metaclass=DAOHelper,
-             indexes={"email_address": True, "role": False}):
+             indexes={"email_address": True, "role": False, ("last_name", "first_name"): False},
+             shard_key="email_address"):
 
     def __init__(self, first_name="N/A", last_name="N/A", email_address=None, role="", **kwargs):
         super().__init__(**kwargs)
@@ -15,10 +17,53 @@ class UserDO(BaseDO, metaclass=DAOHelper,
 class UserCredentialsDO(BaseDO, metaclass=DAOHelper,
                         indexes={"email_address": True},
                         relations={"email_address" : UserDO},
+                        shard_key="email_address",
                         authorization={"master", "customer", "manager"}):
     def __init__(self, email_address="", password="", **kwargs):
         kwargs['managed_by'] = email_address
         super().__init__(**kwargs)
         self.email_address = email_address
-        self.password = hashlib.sha224(password.encode('utf-8')).hexdigest()
+        # KDF hash of the password, see encode_args
+        self.password = password
+
+    @classmethod
+    def encode_args(cls, args):
+        args = super().encode_args(args)
+        if "password" not in args:
+            return args
+        return {**args, "password": hash_password(args["password"])}
+
+    @classmethod
+    def authenticate(cls, email_address, password):
+        """ (UserDO of the operator, None) if password is the one stored, else (None, reason) """
+        res, users = UserDO.dao.get({"email_address": email_address})
+        if not res or not users:
+            return None, "Failed to fetch operator"
+        res, credentials = cls.dao.get({"email_address": email_address})
+        if not res or not credentials:
+            return None, "Failed to fetch operator credentials"
+
+        stored = credentials[0].content
+        if not verify_password(password, stored["password"]):
+            return None, f"Invalid credential for operator:{email_address}"
+        if needs_rehash(stored["password"]):
+            # Best effort upgrade of a legacy hash, a concurrent modification wins
+            cls.dao.save_if({**stored, "password": hash_password(password)}, None, stored.get("version"))
+        return UserDO(**users[0].content), None
+
+    @classmethod
+    async def aauthenticate(cls, email_address, password):
+        """ Awaitable authenticate for coroutines on the DB event loop, the KDF runs in an executor """
+        res, users = await UserDO.dao.aget({"email_address": email_address})
+        if not res or not users:
+            return None, "Failed to fetch operator"
+        res, credentials = await cls.dao.aget({"email_address": email_address})
+        if not res or not credentials:
+            return None, "Failed to fetch operator credentials"
 
+        stored = credentials[0].content
+        if not await averify_password(password, stored["password"]):
+            return None, f"Invalid credential for operator:{email_address}"
+        if needs_rehash(stored["password"]):
+            await cls.dao.asave_if({**stored, "password": await ahash_password(password)}, None, stored.get("version"))
+        return UserDO(**users[0].content), None
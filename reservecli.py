@@ -1,21 +1,36 @@
 import asyncio
 import cmd
+import cProfile
+import csv
+import io
 import json
+import os
+import pstats
+import tracemalloc
 import threading
 import signal
 import logging
 import sys
 import re
+import time
 from termcolor import colored
 from collections import ChainMap
 from prettytable import PrettyTable
 import readline
 
-from db_lib import base_dao
+from db_lib import base_dao, INDEX_ORDERED, INDEX_ORDERED_UNIQUE, FILTER_OP_GT, FILTER_OP_GTE, FILTER_OP_LT, \
+    FILTER_OP_LTE, DEFAULT_PAGE_SIZE
 from db_lib.base_dao import DBClient
-from db_store import datastore_workers
+from db_store import datastore_workers, wal, expiry, planner, shards, network, tracing, scheduler, \
+    WORKER_MODE_ASYNC, WORKER_MODE_THREAD, DEFAULT_DB_ADDRESS, DEFAULT_SLOW_OP_MS
 from db_store.datastore_workers import DBStoreWorkers
+from db_store.shards import ShardedDBStoreWorkers
+from db_store.network import DBNetworkServer, DBConnectionPool
+from db_store.scheduler import RequestScheduler
+from db_store.timestamps import format_epoch
+from models.auth import sessions
 from models.base_data_object import BaseDO
+from models.bulk_io import BulkImport, file_format, read_rows, export_records
 from models.car_resources import CarDO, CarStateDO
 from models.user_resources import UserDO, UserCredentialsDO
 
@@ -27,11 +42,38 @@ supported_entities = {"cars": CarDO,
                       }
 
 FULL_CMD_EXP = re.compile('(?:(?P<command>[a-zA-Z0-9_-]+)*)\s*(?:(?P<entity>[a-zA-Z0-9_-]+)*)\s*(?:(?P<args>.+)*)')
-CMD_ARGS_EXP = re.compile('(?P<key>\w+)=(?P<value>[^\s]+)')
+CMD_ARGS_EXP = re.compile('(?P<key>\w+)(?P<op>>=|<=|>|<|=)(?P<value>[^\s]+)')
+CMD_ARG_LIMIT = "limit"
+CMD_ARG_ORDER_BY = "order_by"
+CMD_ARG_TOKEN = "token"
+# import / export <entity> file=<path> [format=csv|ndjson]
+CMD_ARG_FILE = "file"
+CMD_ARG_FORMAT = "format"
+BULK_FAILURES_SHOWN = 20
+# Roles allowed to inspect runtime metrics of db
+CMD_STATS_ROLES = {"master", "manager"}
+# profile cpu|memory <command> runs a single command under cProfile / tracemalloc
+CMD_PROFILE_CPU = "cpu"
+CMD_PROFILE_MEMORY = "memory"
+CMD_PROFILE_UNSUPPORTED = {"profile", "login", "exit"}
+PROFILE_TOP_ENTRIES = 20
+CMD_ARGS_FILTER_OPS = {">": FILTER_OP_GT, ">=": FILTER_OP_GTE, "<": FILTER_OP_LT, "<=": FILTER_OP_LTE}
 
 DEFAULT_DB = "QuickReserve_DB"
+DEFAULT_DB_DATA_DIR = "qr_data"
 DB_WORKER_POOL_SIZE = 4
-MAX_REQ_QUEUE_SIZE = 100
+# With -S records are sharded over one db process per core, otherwise db runs within the cli process
+db_shard_count = 1
+# With -T db workers run operations in parallel on a thread pool
+db_worker_mode = WORKER_MODE_ASYNC
+# With -L db of this cli is served to other consoles at db_address, with -C the cli uses the db served there
+db_address = os.environ.get("QR_DB_ADDRESS", DEFAULT_DB_ADDRESS)
+db_listen = False
+db_connect = False
+db_setup_error = None
+# Requests slower than this many milliseconds are logged with their trace, "off" disables the log
+slow_op_ms = os.environ.get("QR_SLOW_OP_MS", str(DEFAULT_SLOW_OP_MS))
+log_level = logging.INFO
 
 
 # SIGINT handler
@@ -53,6 +95,10 @@ class EntitiesMetaInfo(object):
     def __str__(self):
         return "[ " + " ".join([self.name, str(self.attributes), str(self.indexes)]) + " ]"
 
+    def mandatory_attributes(self):
+        # Ordered indexes serve range queries on optional / generated attributes
+        return {i for i, kind in self.indexes.items() if kind not in (INDEX_ORDERED, INDEX_ORDERED_UNIQUE)}
+
 
 #####  MAIN MENU FOR ALL Entities ####
 #        /              \   ######
@@ -69,7 +115,8 @@ class MainMenu(cmd.Cmd):
         self.parent_role = parent_role
         self.parent_label = parent_label
         self.singleton_cmds = {}
-        self.entity_cmds = {"register", "modify", "show", "unregister", "query"}
+        self.entity_cmds = {"register", "modify", "show", "unregister", "query", "available", "explain", "stats",
+                            "import", "export"}
         self.entities_meta_info_map = {}
 
         cmd.Cmd.prompt = f"{colored(self.label, 'green', attrs=['bold'])}:({colored(self.role, 'cyan', attrs=['bold'])})#"
@@ -84,10 +131,42 @@ class MainMenu(cmd.Cmd):
         if not args:
             return command, entity, None
 
-        args = [{m.groupdict()["key"]: m.groupdict()["value"]} for m in CMD_ARGS_EXP.finditer(m.group("args"))]
-        args = dict(ChainMap(*args))
+        filters = {}
+        for a in CMD_ARGS_EXP.finditer(m.group("args")):
+            key, op, value = a.group("key"), a.group("op"), a.group("value")
+            if op == "=":
+                continue
+            # Comparisons on the same attribute are merged, e.g. launch_year>=2018 launch_year<2021
+            filters.setdefault(key, {})[CMD_ARGS_FILTER_OPS[op]] = value
+
+        args = [{m.groupdict()["key"]: m.groupdict()["value"]} for m in CMD_ARGS_EXP.finditer(m.group("args"))
+                if m.groupdict()["op"] == "="]
+        args = dict(ChainMap(filters, *args))
         return command, entity, args
 
+    @staticmethod
+    def display_value(entity_class, key, value):
+        # Timestamps are kept as epoch seconds, formatted only when printed
+        return format_epoch(value) if key in entity_class.timestamps else value
+
+    @staticmethod
+    def save_failure_reason(obj, result, message):
+        try:
+            error = json.loads(result)
+        except (TypeError, ValueError):
+            return message
+        # A conflict with the entity itself is a concurrent modification of it
+        if error.get("conflict") and error["conflict"]["id"] != obj.id:
+            return obj.conflict_reason(error["conflict"])
+        return f'{message} - reason:{error.get("_error")}'
+
+    @staticmethod
+    def has_filter_args(args):
+        if any(isinstance(v, dict) for v in args.values()):
+            print("Comparison operators are supported only for show and query commands")
+            return True
+        return False
+
     def do_query(self, arg):
         command, entity, args = self.parse_cmd_entity_args("query " + arg)
         entities = list(self.entities_meta_info_map.keys())
@@ -99,7 +178,7 @@ class MainMenu(cmd.Cmd):
         for e in supported_entities[entity].relations.values():
             attrs.extend(list(e.dao.indexes.keys()))
             attrs = set(attrs)
-            attrs.remove("id")
+            attrs.discard("id")
 
         if not set(list(args.keys())).issubset(attrs):
             print(f"Unsupported attributes provided for querying :{entity}")
@@ -112,29 +191,25 @@ class MainMenu(cmd.Cmd):
             self.do_show(arg)
             return
 
-        join_info = {}
-        for k, e in (relations or {}).items():
-            res, related_entities = e.dao.get(args)
-            if res and related_entities:
-                join_info[k] = [json.loads(e)["content"][k] for e in related_entities]
-
-        if not join_info:
-            print(f'No instances found for {entity} for the filter specified')
-            return
+        args = entity_class.encode_timestamps(args)
+        for e in relations.values():
+            args = e.encode_timestamps(args)
 
-        logger.debug(f'Join values: {join_info} for entity {entity}')
+        # Filters are ANDed, each one is applied on the entity which owns the attribute,
+        # the join with related entity is resolved by db server in a single request
+        main_args = {k: v for k, v in args.items() if k in self.entities_meta_info_map[entity].indexes}
         found = False
         t = PrettyTable(['key', 'value'])
-        for join_key, join_values in join_info.items():
-            for v in join_values:
-                res, objects = entity_class.dao.get({join_key: v})
-                if not res or not objects:
-                    continue
-                for obj in objects:
-                    for key, val in json.loads(obj)["content"].items():
-                        found = True
-                        t.add_row([key, val])
-                    t.add_row(["\n\n", "\n\n"])
+        for join_key, e in relations.items():
+            related_args = {a: v for a, v in args.items() if a in e.dao.indexes and a not in main_args}
+            res, objects = entity_class.dao.join(e.__name__, join_key, related_args, main_args)
+            if not res or not objects:
+                continue
+            for obj in objects:
+                for key, val in obj.content.items():
+                    found = True
+                    t.add_row([key, self.display_value(entity_class, key, val)])
+                t.add_row(["\n\n", "\n\n"])
 
         if not found:
             print(f'No instances found for {entity} for the filter specified')
@@ -157,11 +232,11 @@ class MainMenu(cmd.Cmd):
 
         entity_class = supported_entities[entity]
         res, objects = entity_class.dao.get(args)
-        if not res:
+        if not res or not objects:
             print(f'Failed to query : {entity})')
             return
 
-        obj = json.loads(objects[0])["content"]
+        obj = objects[0].content
         if self.label != entity_class(**obj).created_by:
             print('Unauthorized: Permission denied for executing this operation')
             return
@@ -180,6 +255,210 @@ class MainMenu(cmd.Cmd):
         print(f'{entity} with id:{args["id"]} unregistered successfully')
         self.lastcmd = ""
 
+    def do_explain(self, arg):
+        command, entity, args = self.parse_cmd_entity_args("explain " + arg)
+        entities = list(self.entities_meta_info_map.keys())
+        if not entity or entity not in entities or not args:
+            print("Incomplete command - Please use autocomplete(tab) to check for supported options")
+            return
+
+        entity_class = supported_entities[entity]
+        res, plan = entity_class.dao.explain(entity_class.encode_timestamps(args))
+        if not res:
+            print(f'Failed to explain query on : {entity}')
+            return
+
+        # A query fanned out to db shards is planned by every shard on its own
+        for shard, shard_plan in enumerate(plan.get("shards", [plan])):
+            if "shards" in plan:
+                print(f'Shard: {shard}')
+            t = PrettyTable(['step', 'access', 'attribute', 'condition', 'estimated rows'])
+            for i, step in enumerate(shard_plan["steps"]):
+                t.add_row([i + 1, step["access"], step["field"] or "-", step["condition"] or "-",
+                           step["estimated_rows"] if step["estimated_rows"] is not None else "-"])
+            print(t)
+        print(f'Estimated rows: {plan["estimated_rows"]}')
+        self.lastcmd = ""
+
+    @staticmethod
+    def print_op_stats(title, ops, busy=False):
+        if not ops:
+            return
+        t = PrettyTable(['op', 'table', 'count', 'errors', 'mean ms', 'p50 ms', 'p99 ms', 'max ms'] +
+                        (['busy ms'] if busy else []))
+        for o in ops:
+            t.add_row([o["op"], o["table"] or "-", o["count"], o["errors"], o.get("mean_ms", "-"),
+                       o.get("p50_ms", "-"), o.get("p99_ms", "-"), o.get("max_ms", "-")] +
+                      ([o["busy_ms"]] if busy else []))
+        print(title)
+        print(t)
+
+    def print_server_stats(self, stats, title):
+        t = PrettyTable(['metric', 'value'])
+        t.add_row(["server", stats.get("server")])
+        t.add_row(["uptime sec", stats.get("uptime_sec")])
+        if "workers" in stats:
+            t.add_row(["workers", f'{stats["workers"]} ({stats["worker_mode"]})'])
+            t.add_row(["utilization", f'{stats["utilization"] * 100:.1f}%'])
+        for lane, queue in stats.get("queues", {}).items():
+            t.add_row([f"{lane} queue", f'{queue["queued"]} waiting, peak {queue["peak"]}, '
+                                        f'{queue["shed"]} shed, {queue["expired"]} timed out'])
+        if "snapshots" in stats:
+            snapshots = stats["snapshots"]
+            t.add_row(["snapshots", f'{snapshots["open"]} open, {snapshots["leased"]} held by scans, '
+                                    f'{snapshots["versions"]} old record versions kept'])
+        if "routing" in stats:
+            t.add_row(["routing", stats["routing"]])
+        print(title)
+        print(t)
+        self.print_op_stats(f"{title} operations", stats.get("ops"), busy="workers" in stats)
+
+        if stats.get("tables"):
+            t = PrettyTable(['table', 'records', 'index', 'kind', 'distinct values', 'avg rows per value'])
+            for name, table in stats["tables"].items():
+                t.add_row([name, table["records"], "-", "-", "-", "-"])
+                for field, index in table["indexes"].items():
+                    # Hash indexes are declared unique / non-unique by True / False
+                    kind = {True: "unique", False: "non-unique"}.get(index["kind"], index["kind"])
+                    t.add_row(["", "", field, kind, index["distinct"], index["avg_rows"]])
+            print(f"{title} tables")
+            print(t)
+
+        for i, shard in enumerate(stats.get("shards", [])):
+            self.print_server_stats(shard, f"DB shard {i}")
+
+    def do_stats(self, arg):
+        command, entity, args = self.parse_cmd_entity_args("stats " + arg)
+        if self.role not in CMD_STATS_ROLES:
+            print('Permission denied for executing this operation')
+            return
+
+        if entity and entity not in self.entities_meta_info_map:
+            print("Unsupported entity - Please use autocomplete(tab) to check for supported options")
+            return
+        table_name = supported_entities[entity].__name__ if entity else ""
+
+        db = DBClient.get_instance()
+        client = db.metrics.as_dict(table_name)
+        print(f'DB client, up for {client["uptime_sec"]} sec')
+        self.print_op_stats("DB client operations (round trip)", client["ops"])
+
+        t = PrettyTable(['entity', 'cached results', 'hits', 'misses'])
+        for name, e in supported_entities.items():
+            if e.dao and e.dao.cache and (not entity or name == entity):
+                t.add_row([name, len(e.dao.cache.entries), e.dao.cache.hits, e.dao.cache.misses])
+        if t.rows:
+            print("DAO read cache")
+            print(t)
+
+        resp = db.stats_async(table_name)
+        if not resp.status:
+            print('Failed to fetch stats of DB server')
+            return
+        self.print_server_stats(resp.result, "DB server")
+        self.lastcmd = ""
+
+    @staticmethod
+    def profile_cpu(line, run):
+        cli_profiler, db_profiler = cProfile.Profile(), cProfile.Profile()
+        profilers = [("CLI thread", cli_profiler)]
+        cli_profiler.enable()
+        try:
+            # A profiler covers the thread enabling it, db requests are served on the db event loop thread
+            DBClient.get_instance().call_on_loop(db_profiler.enable)
+            profilers.append(("DB event loop thread", db_profiler))
+        except ValueError:
+            # Only one profiler can be active since python 3.12, it covers every thread
+            pass
+        try:
+            run(line)
+        finally:
+            cli_profiler.disable()
+            if len(profilers) > 1:
+                DBClient.get_instance().call_on_loop(db_profiler.disable)
+
+        for title, profiler in profilers:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP_ENTRIES)
+            print(f"Profile of {title}")
+            print(out.getvalue())
+
+    @staticmethod
+    def profile_memory(line, run):
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        skip_tracemalloc = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        before = tracemalloc.take_snapshot().filter_traces(skip_tracemalloc)
+        tracemalloc.reset_peak()
+        try:
+            run(line)
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot().filter_traces(skip_tracemalloc)
+            if started:
+                tracemalloc.stop()
+
+        t = PrettyTable(['allocated at', 'size diff KiB', 'count diff'])
+        for stat in after.compare_to(before, "lineno")[:PROFILE_TOP_ENTRIES]:
+            frame = stat.traceback[0]
+            t.add_row([f"{frame.filename}:{frame.lineno}", round(stat.size_diff / 1024, 1), stat.count_diff])
+        print(f"Peak of traced memory while running the command: {peak / 1024:.1f} KiB")
+        print(t)
+
+    def do_profile(self, arg):
+        mode, _, line = arg.strip().partition(" ")
+        line = line.strip()
+        if mode not in (CMD_PROFILE_CPU, CMD_PROFILE_MEMORY) or not line:
+            print(f"Incomplete command - Please use profile {CMD_PROFILE_CPU}|{CMD_PROFILE_MEMORY} <command>, "
+                  f"e.g. profile {CMD_PROFILE_CPU} show cars")
+            return
+        if line.split()[0] in CMD_PROFILE_UNSUPPORTED:
+            print(f"Command {line.split()[0]} can not be profiled")
+            return
+
+        if mode == CMD_PROFILE_CPU:
+            self.profile_cpu(line, self.onecmd)
+        else:
+            self.profile_memory(line, self.onecmd)
+        self.lastcmd = ""
+
+    def do_available(self, arg):
+        command, entity, args = self.parse_cmd_entity_args("available " + arg)
+        entities = list(self.entities_meta_info_map.keys())
+        if not entity or entity not in entities or not args:
+            print("Incomplete command - Please use autocomplete(tab) to check for supported options")
+            return
+
+        tracker = supported_entities[entity].available_by
+        if not tracker:
+            print(f"Availability is not tracked for :{entity}")
+            return
+
+        group_by = tracker.availability["group_by"]
+        if set(list(args.keys())) != {group_by} or self.has_filter_args(args):
+            print(f"Availability of {entity} can be queried only by {group_by}")
+            return
+
+        res, objects = tracker.dao.get_available(args[group_by])
+        if not res:
+            print(f'Failed to query : {entity})')
+            return
+
+        if not objects:
+            print(f'No {entity} with {group_by}={args[group_by]} is available')
+            return
+
+        entity_class = supported_entities[entity]
+        t = PrettyTable(['key', 'value'])
+        for obj in objects:
+            for key, val in obj.content.items():
+                t.add_row([key, self.display_value(entity_class, key, val)])
+            t.add_row(["\n\n", "\n\n"])
+        print(t)
+
+        self.lastcmd = ""
+
     def do_show(self, arg):
         command, entity, args = self.parse_cmd_entity_args("show " + arg)
         entities = list(self.entities_meta_info_map.keys())
@@ -187,36 +466,134 @@ class MainMenu(cmd.Cmd):
             print("Incomplete command - Please use autocomplete(tab) to check for supported options")
             return
 
+        # Paging options, results are fetched and printed one page at a time
+        args = args or {}
+        limit = args.pop(CMD_ARG_LIMIT, DEFAULT_PAGE_SIZE)
+        order_by = args.pop(CMD_ARG_ORDER_BY, None)
+        if not str(limit).isdigit() or not int(limit):
+            print(f"Invalid {CMD_ARG_LIMIT}:{limit} - Please provide a positive number")
+            return
+
+        # Non indexed attributes are served by the planner with a residual scan
         indexes = {"id"}
-        indexes.union(set(list(self.entities_meta_info_map[entity].indexes.keys()).copy()))
+        indexes = indexes.union(set(list(self.entities_meta_info_map[entity].indexes.keys()).copy()))
+        indexes = indexes.union(set(self.entities_meta_info_map[entity].attributes))
         if args and not set(list(args.keys())).issubset(indexes):
             print(f"Unsupported attributes provided for querying :{entity}")
             return
 
+        if order_by and self.entities_meta_info_map[entity].indexes.get(order_by) not in (INDEX_ORDERED,
+                                                                                            INDEX_ORDERED_UNIQUE):
+            print(f"Unsupported {CMD_ARG_ORDER_BY}:{order_by} - Please use an attribute with ordered index")
+            return
+
         entity_class = supported_entities[entity]
-        res, objects = entity_class.dao.get(args)
-        if not res:
-            print(f'Failed to query : {entity})')
+        args = entity_class.encode_timestamps(args)
+        cursor = None
+        while True:
+            res, page = entity_class.dao.get_page(args, int(limit), cursor, order_by)
+            if not res:
+                print(f'Failed to query : {entity})')
+                return
+
+            objects, cursor = page
+            if not objects:
+                print(f'No instances of {entity} is registered in system')
+                return
+
+            t = PrettyTable(['key', 'value'])
+            for obj in objects:
+                for key, val in obj.content.items():
+                    t.add_row([key, self.display_value(entity_class, key, val)])
+                t.add_row(["\n\n", "\n\n"])
+            print(t)
+
+            if cursor is None or input("Press enter for next page, q to stop:").strip().lower() == "q":
+                break
+
+        self.lastcmd = ""
+
+    def do_import(self, arg):
+        command, entity, args = self.parse_cmd_entity_args("import " + arg)
+        if not entity or entity not in self.entities_meta_info_map or not args or CMD_ARG_FILE not in args:
+            print(f"Incomplete command - Please use import <entity> {CMD_ARG_FILE}=<path of .csv or .ndjson file>")
             return
 
-        if not objects:
-            print(f'No instances of {entity} is registered in system')
+        entity_class = supported_entities[entity]
+        if not entity_class.verify_authorization(self.role):
+            print('Permission denied for executing this operation')
             return
 
-        t = PrettyTable(['key', 'value'])
+        path = args[CMD_ARG_FILE]
+        if not os.path.isfile(path):
+            print(f"File {path} does not exist")
+            return
+        fmt = file_format(path, args.get(CMD_ARG_FORMAT))
+        if not fmt:
+            print(f"Unsupported file format - Please use a .csv or .ndjson file, or {CMD_ARG_FORMAT}=csv|ndjson")
+            return
+
+        # Rows are streamed from the file, validated and saved chunk by chunk
+        meta = self.entities_meta_info_map[entity]
+        bulk = BulkImport(entity_class, meta.attributes, meta.mandatory_attributes(), self.label,
+                          lambda obj, result: self.save_failure_reason(obj, result, f'Failed to import {entity}'))
+        started = time.perf_counter()
+        failed, shown = 0, []
+        try:
+            for failures in bulk.run(read_rows(path, fmt)):
+                failed += len(failures)
+                shown.extend(failures[:BULK_FAILURES_SHOWN - len(shown)])
+        except (OSError, UnicodeDecodeError, csv.Error) as e:
+            print(f"Failed to read {path}: {e}")
+
+        if shown:
+            t = PrettyTable(['line', 'reason'])
+            for line, reason in shown:
+                t.add_row([line, reason])
+            print(f"First {len(shown)} of {failed} rows not imported")
+            print(t)
+        print(f"Imported {bulk.imported} of {bulk.rows} rows of {entity} in {time.perf_counter() - started:.2f} sec")
+        self.lastcmd = ""
 
-        for obj in objects:
-            for key, val in json.loads(obj)["content"].items():
-                t.add_row([key, val])
-            t.add_row(["\n\n", "\n\n"])
-        print(t)
+    def do_export(self, arg):
+        command, entity, args = self.parse_cmd_entity_args("export " + arg)
+        if not entity or entity not in self.entities_meta_info_map or not args or CMD_ARG_FILE not in args:
+            print(f"Incomplete command - Please use export <entity> {CMD_ARG_FILE}=<path of .csv or .ndjson file>")
+            return
+
+        path = args.pop(CMD_ARG_FILE)
+        fmt = file_format(path, args.pop(CMD_ARG_FORMAT, None))
+        if not fmt:
+            print(f"Unsupported file format - Please use a .csv or .ndjson file, or {CMD_ARG_FORMAT}=csv|ndjson")
+            return
 
+        # Remaining arguments filter the exported entities as for show command
+        attrs = {"id"}.union(self.entities_meta_info_map[entity].indexes, self.entities_meta_info_map[entity].attributes)
+        if not set(args).issubset(attrs):
+            print(f"Unsupported attributes provided for querying :{entity}")
+            return
+
+        entity_class = supported_entities[entity]
+        started = time.perf_counter()
+        try:
+            res, result = export_records(entity_class, path, fmt, entity_class.encode_timestamps(args))
+        except OSError as e:
+            print(f"Failed to write {path}: {e}")
+            return
+        if not res:
+            print(f'Failed to query : {entity}')
+            return
+
+        print(f"Exported {result} {entity} to {path} in {time.perf_counter() - started:.2f} sec")
         self.lastcmd = ""
 
     def validate_input(self, entity_meta_info, args):
-        if not set(list(entity_meta_info.indexes.keys())).issubset(set(list(args.keys()))):
+        if self.has_filter_args(args):
+            return False
+
+        if not entity_meta_info.mandatory_attributes().issubset(set(list(args.keys()))):
             print("Incomplete command - Please provide all mandatory parameters for registering entity")
-            print(f"Expected:{set(list(entity_meta_info.indexes.keys()))}")
+            print(f"Expected:{entity_meta_info.mandatory_attributes()}")
             print(f"Given:{set(list(set(list(args.keys()))))}")
             return False
 
@@ -244,45 +621,61 @@ class MainMenu(cmd.Cmd):
             print(f"Unsupported attributes provided for modification of :{entity}")
             return
 
+        if self.has_filter_args(args):
+            return
+
         relations = entity_class.relations
         for k, e in (relations or {}).items():
             res, related_entity = e.dao.get({k: args.get(k, "")})
-            if not res or not related_entity or json.loads(related_entity[0])["content"].get(k) != args.get(k):
+            if not res or not related_entity or related_entity[0].content.get(k) != args.get(k):
                 print(f"{e.__name__} with {k}={args.get(k)} does not exist")
                 return
 
-        res, objects = entity_class.dao.get(args)
+        # Entity to modify is identified by its unique attributes, remaining ones are the new values
+        unique_args = {k: v for k, v in args.items()
+                       if self.entities_meta_info_map[entity].indexes.get(k) in (True, INDEX_ORDERED_UNIQUE)}
+        if not unique_args:
+            print(f"Please provide a unique attribute to identify :{entity}")
+            return
+
+        res, objects = entity_class.dao.get(unique_args)
         if not res:
             print(f'Failed to query : {entity}')
             return
 
+        if not objects:
+            print(f'No instance of {entity} found for {unique_args}')
+            return
+
         if len(objects) > 1:
             print(f'Internal server error:Duplicate entities with same unique key found')
             return
 
         entity_class = supported_entities[entity]
-        old = json.loads(objects[0])["content"]
+        old = objects[0].content
         old_obj = entity_class(**old)
 
         if self.label not in [old_obj.created_by, old_obj.managed_by]:
             print(f'Unauthorized: Permission denied for executing this operation')
             return
 
-        merge_content = {**old, **args, "updated_by": self.label}
+        merge_content = {**old, **entity_class.encode_args(args), "updated_by": self.label}
         final_obj = entity_class(**merge_content)
         status, reason = old_obj.validate(final_obj)
         if not status:
             print(reason)
             return
 
-        res, obj = entity_class.dao.save(final_obj.__dict__)
+        # Saved only if nobody modified the entity since it was read
+        res, result = entity_class.dao.save_if(final_obj.__dict__, final_obj.save_condition(), old_obj.version)
         if not res:
-            print(f'Failed to modify : {entity} with id:{arg["id"]}: reason:{json.loads(obj)["_error"]}')
+            print(self.save_failure_reason(final_obj, result, f'Failed to modify : {entity} with id:{final_obj.id}'))
             return
+        obj = result
 
         t = PrettyTable(['key', 'value'])
-        for key, val in json.loads(obj)["content"].items():
-            t.add_row([key, val])
+        for key, val in obj.content.items():
+            t.add_row([key, self.display_value(entity_class, key, val)])
         print(t)
         self.lastcmd = ""
 
@@ -313,20 +706,21 @@ class MainMenu(cmd.Cmd):
                 return
 
         args["created_by"] = args["updated_by"] = args["managed_by"] = self.label
-        obj = entity_class(**args)
+        obj = entity_class(**entity_class.encode_args(args))
         status, reason = obj.validate()
         if not status:
             print(reason)
             return
 
-        res, obj = entity_class.dao.save(obj.__dict__)
+        res, result = entity_class.dao.save_if(obj.__dict__, obj.save_condition())
         if not res:
-            print(f'Failed to register new  {entity}- reason:{json.loads(obj)["_error"]}')
+            print(self.save_failure_reason(obj, result, f'Failed to register new  {entity}'))
             return
+        obj = result
 
         t = PrettyTable(['key', 'value'])
-        for key, val in json.loads(obj)["content"].items():
-            t.add_row([key, val])
+        for key, val in obj.content.items():
+            t.add_row([key, self.display_value(entity_class, key, val)])
         print(t)
         self.lastcmd = ""
 
@@ -347,7 +741,8 @@ class MainMenu(cmd.Cmd):
 
         if not entity:
             if command in self.singleton_cmds:
-                return [attr + "=" for attr in self.singleton_cmds[command].attributes if
+                attrs = self.singleton_cmds[command].attributes + ([CMD_ARG_TOKEN] if command == "login" else [])
+                return [attr + "=" for attr in attrs if
                         attr.startswith(filter_text) and attr not in list(args.keys())]
             logger.info(list(self.entities_meta_info_map.keys()))
             return list(self.entities_meta_info_map.keys())
@@ -372,11 +767,29 @@ class MainMenu(cmd.Cmd):
             for e in supported_entities[entity].relations.values():
                 attrs.extend(list(e.dao.indexes.keys()))
                 attrs = set(attrs)
-                attrs.remove("id")
+                attrs.discard("id")
 
-        elif command == "show":
-            attrs = list(self.entities_meta_info_map[entity].indexes.keys()).copy()
-            attrs.append("id")
+        elif command in ("show", "explain"):
+            attrs = set(list(self.entities_meta_info_map[entity].indexes.keys()))
+            attrs = attrs.union(set(self.entities_meta_info_map[entity].attributes))
+            attrs.add("id")
+            if command == "show":
+                attrs.update({CMD_ARG_LIMIT, CMD_ARG_ORDER_BY})
+
+        elif command == "available":
+            tracker = supported_entities[entity].available_by
+            attrs = [tracker.availability["group_by"]] if tracker else []
+
+        elif command == "stats":
+            attrs = []
+
+        elif command == "import":
+            attrs = [CMD_ARG_FILE, CMD_ARG_FORMAT]
+
+        elif command == "export":
+            attrs = set(list(self.entities_meta_info_map[entity].indexes.keys()))
+            attrs = attrs.union(set(self.entities_meta_info_map[entity].attributes))
+            attrs.update({"id", CMD_ARG_FILE, CMD_ARG_FORMAT})
 
         return [attr + "=" for attr in attrs if attr.startswith(filter_text) and attr not in list(args.keys())]
 
@@ -407,6 +820,17 @@ class OperatorMenu(MainMenu):
 
     def do_login(self, arg):
         command, entity, args = self.parse_cmd_entity_args("login singleton_entity " + arg)
+        if entity == "singleton_entity" and args and args.get(CMD_ARG_TOKEN):
+            # Session of an earlier login, no credential lookup or hashing needed
+            session = sessions.resolve(args[CMD_ARG_TOKEN])
+            if not session:
+                print("Session is expired or invalid, please login with credentials")
+                return
+            ReservationMenu(label=session.email_address, role=session.role, parent_label=self.label,
+                            parent_role=self.role).cmdloop()
+            self.lastcmd = ""
+            return
+
         if entity != "singleton_entity" or not args or not args.get("email_address") or not args.get("password"):
             print("Incomplete command - Please provide all mandatory parameters for operator login")
             return
@@ -415,25 +839,14 @@ class OperatorMenu(MainMenu):
         if not self.validate_input(entity_meta_info, args):
             return
 
-        entity_class = supported_entities["operators"]
-        res, objects = entity_class.dao.get({"email_address": args["email_address"]})
-        if not res or not len(objects):
-            print(f'Failed to fetch operator')
-            return
-
-        op = UserDO(**(json.loads(objects[0])["content"]))
-        entity_class = supported_entities["op-credentials"]
-        res, objects = entity_class.dao.get({"email_address": op.email_address})
-        if not res or not len(objects):
-            print(f'Failed to fetch operator credentials')
-            return
-
-        op_password = json.loads(objects[0])["content"]["password"]
-        entered_cred = UserCredentialsDO(email_address=op.email_address, password=args["password"])
-        if op_password != entered_cred.password:
-            print(f'Invalid credential for operator:{args["email_address"]}')
+        op, reason = UserCredentialsDO.authenticate(args["email_address"], args["password"])
+        if not op:
+            print(reason)
             return
 
+        session = sessions.issue(op.email_address, op.role)
+        print(f"Session token:{session.token} (login {CMD_ARG_TOKEN}=<session token> for next "
+              f"{sessions.ttl // 60} minutes)")
         ReservationMenu(label=op.email_address, role=op.role, parent_label=self.label, parent_role=self.role).cmdloop()
         self.lastcmd = ""
 
@@ -455,12 +868,33 @@ def setup_entities_metadata(entities):
 # ENTRY POINT for EVEN LOOP FOR HANDLING DB REQUEST FRO CLIENTS / CLI
 async def ev_loop_main(entities):
     loop = asyncio.get_running_loop()
-    req_queue = asyncio.Queue(MAX_REQ_QUEUE_SIZE)
-    DBClient(req_queue, loop)
-    db_server = DBStoreWorkers(DEFAULT_DB, req_queue)
+    if db_connect:
+        pool = DBConnectionPool(db_address)
+        try:
+            await pool.connect()
+        except OSError as e:
+            global db_setup_error
+            db_setup_error = f"DB server at {db_address} is not reachable, {e}"
+            setup_event.set()
+            return
+        DBClient(None, loop, pool)
+        setup_entities_metadata(entities)
+        setup_event.set()
+        await loop.create_future()  # Serve requests of cli until it exits
+
+    req_queue = RequestScheduler()
+    if db_shard_count > 1:
+        # Writes happen in shard processes, reads can not be cached against their versions
+        db_server = ShardedDBStoreWorkers(DEFAULT_DB, req_queue, DEFAULT_DB_DATA_DIR, db_shard_count, log_level)
+        DBClient(req_queue, loop)
+    else:
+        db_server = DBStoreWorkers(DEFAULT_DB, req_queue, DEFAULT_DB_DATA_DIR, worker_mode=db_worker_mode)
+        DBClient(req_queue, loop, versions=db_server.versions)
     server_worker = asyncio.create_task(db_server.run())
     await req_queue.put(DB_WORKER_POOL_SIZE)
     await req_queue.join()  # All workers are initialized correctly
+    if db_listen:
+        asyncio.create_task(DBNetworkServer(req_queue, db_address).run())
     setup_entities_metadata(entities)
     setup_event.set()
     await server_worker
@@ -472,17 +906,32 @@ def start_ev_loop(entities):
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, signal_handler)
-    log_level = logging.INFO
-    if len(sys.argv) > 1 and sys.argv[1] == '-D':
+    if '-D' in sys.argv[1:]:
         log_level = logging.DEBUG
+    if '-S' in sys.argv[1:]:
+        db_shard_count = os.cpu_count() or 1
+    if '-T' in sys.argv[1:]:
+        db_worker_mode = WORKER_MODE_THREAD
+    if '-L' in sys.argv[1:]:
+        db_listen = True
+    if '-C' in sys.argv[1:]:
+        db_connect = True
     logging.basicConfig(level=log_level, filename='quick_reserve.log', filemode='w',
                         format='%(name)s - %(levelname)s - %(message)s')
     logger = logging.getLogger()
     clilogger = logging.getLogger()
     clilogger.setLevel(logging.INFO)
-    base_dao.logger = datastore_workers.logger = logger  # FIXME: Find better way using custom logger and module level logging support
+    base_dao.logger = datastore_workers.logger = wal.logger = expiry.logger = planner.logger = shards.logger = network.logger = tracing.logger = scheduler.logger = logger  # FIXME: Find better way using custom logger and module level logging support
+    try:
+        tracing.slow_ops.threshold_ms = None if slow_op_ms == "off" else float(slow_op_ms)
+    except ValueError:
+        print(colored(f"Invalid QR_SLOW_OP_MS:{slow_op_ms} - Please provide milliseconds or off", "red"))
+        sys.exit(1)
     setup_event = threading.Event()
     threading.Thread(target=start_ev_loop, args=(list(supported_entities.keys()),), daemon=True).start()
     setup_event.wait()  # Event thread is successfully initialized, now start cli
+    if db_setup_error:
+        print(colored(db_setup_error, "red"))
+        sys.exit(1)
 
     OperatorMenu("abhishek@qr.com", "master").cmdloop()